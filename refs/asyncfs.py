@@ -0,0 +1,171 @@
+import errno
+import functools
+import logging
+
+import llfuse
+import pyfuse3
+import trio
+
+logger = logging.getLogger(__name__)
+
+ENTRY_ATTRIBUTES = [
+    "st_ino",
+    "generation",
+    "entry_timeout",
+    "attr_timeout",
+    "st_mode",
+    "st_nlink",
+    "st_uid",
+    "st_gid",
+    "st_rdev",
+    "st_size",
+    "st_blksize",
+    "st_blocks",
+    "st_atime_ns",
+    "st_ctime_ns",
+    "st_mtime_ns",
+]
+
+STATVFS_ATTRIBUTES = [
+    "f_bsize",
+    "f_frsize",
+    "f_blocks",
+    "f_bfree",
+    "f_bavail",
+    "f_files",
+    "f_ffree",
+    "f_favail",
+    "f_namemax",
+]
+
+
+class AsyncReFs(pyfuse3.Operations):
+    """Serves a :class:`ReFs` (or :class:`MultiReFs`) with pyfuse3 and trio.
+
+    Requests are handled concurrently: each one runs the corresponding
+    operation of ``operations`` in a worker thread, with at most ``workers``
+    operations at a time. Requests that only wait for the reMarkable (e.g.,
+    lookups in different folders, loading different documents) thus overlap,
+    instead of being served one after another as by ``llfuse.main``.
+    """
+
+    def __init__(self, operations, workers=16):
+        super().__init__()
+        self.operations = operations
+        self.limiter = trio.CapacityLimiter(workers)
+        operations.set_invalidate_inode(pyfuse3.invalidate_inode)
+
+    async def statfs(self, ctx):
+        stat = await self.__call(self.operations.statfs, ctx)
+        return _convert(stat, pyfuse3.StatvfsData(), STATVFS_ATTRIBUTES)
+
+    async def lookup(self, parent_inode, name, ctx=None):
+        attrs = await self.__call(self.operations.lookup, parent_inode, name, ctx)
+        return _convert_attrs(attrs)
+
+    async def forget(self, inode_list):
+        await self.__call(self.operations.forget, inode_list)
+
+    async def getattr(self, inode, ctx=None):
+        return _convert_attrs(await self.__call(self.operations.getattr, inode, ctx))
+
+    async def setattr(self, inode, attr, fields, fh, ctx):
+        attrs = await self.__call(self.operations.setattr, inode, attr, fields, fh, ctx)
+        return _convert_attrs(attrs)
+
+    async def setxattr(self, inode, name, value, ctx):
+        await self.__call(self.operations.setxattr, inode, name, value, ctx)
+
+    async def getxattr(self, inode, name, ctx):
+        return await self.__call(self.operations.getxattr, inode, name, ctx)
+
+    async def listxattr(self, inode, ctx):
+        return await self.__call(self.operations.listxattr, inode, ctx)
+
+    async def open(self, inode, flags, ctx):
+        fh = await self.__call(self.operations.open, inode, flags, ctx)
+        # like llfuse, keep cached data across opens
+        return pyfuse3.FileInfo(fh=fh, keep_cache=True)
+
+    async def release(self, fh):
+        await self.__call(self.operations.release, fh)
+
+    async def flush(self, fh):
+        await self.__call(self.operations.flush, fh)
+
+    async def fsync(self, fh, datasync):
+        await self.__call(self.operations.fsync, fh, datasync)
+
+    async def opendir(self, inode, ctx):
+        return await self.__call(self.operations.opendir, inode, ctx)
+
+    async def read(self, fh, off, size):
+        return await self.__call(self.operations.read, fh, off, size)
+
+    async def readdir(self, fh, start_id, token):
+        entries = await self.__call(lambda: list(self.operations.readdir(fh, start_id)))
+        for name, attrs, next_id in entries:
+            if not pyfuse3.readdir_reply(token, name, _convert_attrs(attrs), next_id):
+                break
+            # the kernel now holds a reference, as if it had looked it up
+            self.operations.add_lookup(attrs.st_ino)
+
+    async def create(self, parent_inode, name, mode, flags, ctx):
+        fh, attrs = await self.__call(
+            self.operations.create, parent_inode, name, mode, flags, ctx
+        )
+        return pyfuse3.FileInfo(fh=fh, keep_cache=True), _convert_attrs(attrs)
+
+    async def mkdir(self, parent_inode, name, mode, ctx):
+        attrs = await self.__call(self.operations.mkdir, parent_inode, name, mode, ctx)
+        return _convert_attrs(attrs)
+
+    async def write(self, fh, off, buf):
+        return await self.__call(self.operations.write, fh, off, buf)
+
+    async def rename(
+        self, parent_inode_old, name_old, parent_inode_new, name_new, flags, ctx
+    ):
+        if flags != 0:
+            # no atomic exchange or no-replace renames
+            raise pyfuse3.FUSEError(errno.EINVAL)
+        await self.__call(
+            self.operations.rename,
+            parent_inode_old,
+            name_old,
+            parent_inode_new,
+            name_new,
+            ctx,
+        )
+
+    async def unlink(self, parent_inode, name, ctx):
+        await self.__call(self.operations.unlink, parent_inode, name, ctx)
+
+    async def rmdir(self, parent_inode, name, ctx):
+        await self.__call(self.operations.rmdir, parent_inode, name, ctx)
+
+    async def __call(self, func, *args):
+        """Run a (blocking) operation in a worker thread."""
+        try:
+            return await trio.to_thread.run_sync(
+                functools.partial(func, *args), limiter=self.limiter
+            )
+        except llfuse.FUSEError as e:
+            raise pyfuse3.FUSEError(e.errno)
+        except OSError as e:
+            # like report_os_errors, for operations that don't report them
+            if e.errno is None:
+                raise
+            logger.error("[AsyncReFs::%s] %s", func.__name__, e)
+            raise pyfuse3.FUSEError(e.errno) from e
+
+
+def _convert(source, target, names):
+    for name in names:
+        setattr(target, name, getattr(source, name))
+    return target
+
+
+def _convert_attrs(attrs):
+    """Convert llfuse entry attributes to pyfuse3 entry attributes."""
+    return _convert(attrs, pyfuse3.EntryAttributes(), ENTRY_ATTRIBUTES)
@@ -0,0 +1,116 @@
+import logging
+import os
+import statistics
+import time
+
+import requests
+
+from .connection import SshConnection
+from .constants import WEB_INTERFACE_URL
+from .filesystem import SshFileSystem
+
+logger = logging.getLogger(__name__)
+
+# where to put the test file on the reMarkable
+BENCH_DIR = "/tmp"
+BENCH_FILE = "refs-bench.bin"
+
+
+def bench_profile(address, profile, username="root", size=8 * 1024**2, rounds=20):
+    """Measure the SFTP link to the reMarkable with a transport profile.
+
+    Returns a dict with the time to connect, the median latency of a ``stat``
+    round trip (in seconds), and the write and read throughput of a file with
+    ``size`` random bytes (in bytes per second).
+    """
+    start = time.perf_counter()
+    connection = SshConnection(address, username, profile=profile)
+    connect = time.perf_counter() - start
+
+    try:
+        # don't cache anything, every call is a round trip
+        fs = SshFileSystem(connection, BENCH_DIR, cache_ttl=0)
+
+        latencies = []
+        for _ in range(rounds):
+            start = time.perf_counter()
+            fs.stat("")
+            latencies.append(time.perf_counter() - start)
+
+        data = os.urandom(size)
+
+        start = time.perf_counter()
+        fs.write_file(data, BENCH_FILE, overwrite=True)
+        write = size / (time.perf_counter() - start)
+
+        start = time.perf_counter()
+        read_data = fs.read_file(BENCH_FILE, binary=True)
+        read = size / (time.perf_counter() - start)
+
+        fs.remove_file(BENCH_FILE)
+        if read_data != data:
+            raise RuntimeError("Data read back differs from data written")
+    finally:
+        connection.close()
+
+    return {
+        "profile": profile.name,
+        "connect": connect,
+        "latency": statistics.median(latencies),
+        "write": write,
+        "read": read,
+    }
+
+
+def bench_http(rounds=20):
+    """Measure the web interface of the reMarkable (only reachable via USB).
+
+    Returns a dict with the median latency and throughput of fetching the
+    document list, or None if the web interface can not be reached.
+    """
+    url = f"{WEB_INTERFACE_URL}/documents/"
+    latencies = []
+    throughputs = []
+    with requests.Session() as session:
+        for _ in range(rounds):
+            start = time.perf_counter()
+            try:
+                # the web interface lists documents on POST requests
+                response = session.post(url, timeout=5)
+            except requests.RequestException as e:
+                logger.info("Web interface not reachable: %s", e)
+                return None
+            duration = time.perf_counter() - start
+            latencies.append(duration)
+            throughputs.append(len(response.content) / duration)
+
+    return {
+        "latency": statistics.median(latencies),
+        "read": statistics.median(throughputs),
+    }
+
+
+def bench_link(address, profiles, username="root", size=8 * 1024**2):
+    """Measure the link to the reMarkable with each of the given profiles.
+
+    Returns a tuple ``(results, http, best)`` of the results of
+    :func:`bench_profile` for each profile that could connect, the result of
+    :func:`bench_http`, and the name of the profile with the shortest time to
+    write and read the test file (or None).
+    """
+    results = []
+    for profile in profiles:
+        logger.info("Measuring profile %s...", profile.name)
+        try:
+            results.append(bench_profile(address, profile, username, size))
+        except Exception as e:
+            logger.error("Profile %s failed: %s", profile.name, e)
+
+    http = bench_http()
+
+    best = None
+    if results:
+        best = min(results, key=lambda r: size / r["write"] + size / r["read"])
+        best = best["profile"]
+
+    return results, http, best
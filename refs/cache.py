@@ -0,0 +1,222 @@
+import fcntl
+import hashlib
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+from .utils import from_json, to_json
+
+logger = logging.getLogger(__name__)
+
+
+def default_cache_dir():
+    """Get the directory to store cached data in."""
+    cache_home = os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
+    return Path(cache_home) / "refs"
+
+
+class PdfCache:
+    """An on-disk cache of rendered PDFs.
+
+    Each PDF is stored together with the version (the ``lastModified``
+    timestamp) of the document it was rendered from, such that outdated PDFs
+    are never returned.
+
+    PDFs are stored by the hash of their content. Documents with the same PDF
+    (e.g., the same paper on several reMarkables that share the cache) are
+    stored only once.
+
+    Once the PDFs take more than ``max_bytes``, the least recently used ones
+    are dropped.
+
+    The cache can be shared by several processes (e.g., two mounts). Changes
+    are made under a lock file, on the index as it is on disk.
+    """
+
+    def __init__(self, cache_dir, max_bytes=2 * 1024**3):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.index_file = self.cache_dir / "index.json"
+        self.lock_file = self.cache_dir / "index.lock"
+        self.lock = threading.Lock()
+
+        with self.__locked():
+            self.__load_index()
+
+    def get(self, document):
+        """Get the cached PDF data of a document, or None if not cached."""
+        info = self.__get_info(document)
+        if info is None:
+            return None
+
+        path = self.__get_path(info["digest"])
+        try:
+            data = path.read_bytes()
+        except FileNotFoundError:
+            # dropped (maybe by another process)
+            return None
+        # the modification time tells which PDFs were used recently
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return data
+
+    def put(self, document, data):
+        """Store the PDF data of a document."""
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.__get_path(digest)
+
+        with self.__locked():
+            # other processes may have changed the index since we read it
+            self.__load_index()
+
+            if path.exists():
+                os.utime(path)
+            else:
+                tmp_path = path.with_suffix(".tmp")
+                tmp_path.write_bytes(data)
+                os.replace(tmp_path, path)
+
+            previous = self.index.get(document.uid)
+            self.index[document.uid] = {
+                "version": document.last_modified,
+                "size": len(data),
+                "digest": digest,
+            }
+            if previous is not None:
+                self.__release(previous["digest"])
+            self.__evict()
+            self.__save_index()
+
+    def size(self, document):
+        """Get the size of the cached PDF of a document, or None if not cached."""
+        info = self.__get_info(document)
+        if info is None:
+            return None
+        return info["size"]
+
+    def __get_info(self, document):
+        with self.lock:
+            info = self.index.get(document.uid)
+        if info is None or info["version"] != document.last_modified:
+            return None
+        return info
+
+    @contextmanager
+    def __locked(self):
+        """Lock the cache against other threads and processes."""
+        with self.lock, open(self.lock_file, "a") as lock_file:
+            # released when the file is closed
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def __load_index(self):
+        try:
+            self.index = from_json(self.index_file.read_text())
+        except FileNotFoundError:
+            self.index = {}
+        except ValueError:
+            logger.error("PDF cache index %s is corrupt, ignoring", self.index_file)
+            self.index = {}
+
+        # PDFs cached by an earlier version were stored by document UID
+        for uid, info in list(self.index.items()):
+            if "digest" not in info:
+                del self.index[uid]
+                (self.cache_dir / (uid + ".pdf")).unlink(missing_ok=True)
+
+    def __release(self, digest):
+        """Drop a PDF if no document in the index uses it anymore."""
+        if all(info["digest"] != digest for info in self.index.values()):
+            self.__get_path(digest).unlink(missing_ok=True)
+
+    def __evict(self):
+        """Drop the least recently used PDFs until the cache fits ``max_bytes``."""
+        sizes = {info["digest"]: info["size"] for info in self.index.values()}
+        total = sum(sizes.values())
+        if total <= self.max_bytes:
+            return
+
+        def last_used(digest):
+            try:
+                return self.__get_path(digest).stat().st_mtime
+            except FileNotFoundError:
+                return 0
+
+        for digest in sorted(sizes, key=last_used):
+            if total <= self.max_bytes:
+                break
+            logger.debug("[PdfCache::evict] dropping %s", digest)
+            for uid, info in list(self.index.items()):
+                if info["digest"] == digest:
+                    del self.index[uid]
+            self.__get_path(digest).unlink(missing_ok=True)
+            total -= sizes[digest]
+
+    def __get_path(self, digest):
+        return self.cache_dir / (digest + ".pdf")
+
+    def __save_index(self):
+        tmp_file = self.index_file.with_suffix(".tmp")
+        tmp_file.write_text(to_json(self.index))
+        os.replace(tmp_file, self.index_file)
+
+
+class PageCache:
+    """An on-disk cache of per-page images (rendered pages or thumbnails).
+
+    Images are stored per document, keyed by their page ID and a key that
+    identifies the version of the image (e.g., the version of the page and
+    the scale it was rendered with).
+    """
+
+    def __init__(self, cache_dir, suffix=".png"):
+        self.cache_dir = Path(cache_dir)
+        self.suffix = suffix
+
+    def get(self, uid, page_id, key):
+        """Get the cached image of a page, or None if not cached."""
+        try:
+            return self.__get_path(uid, page_id, key).read_bytes()
+        except FileNotFoundError:
+            return None
+
+    def put(self, uid, page_id, key, data):
+        """Store the image of a page, replacing older versions."""
+        path = self.__get_path(uid, page_id, key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        for outdated in path.parent.glob(page_id + "-*" + self.suffix):
+            outdated.unlink()
+
+        tmp_path = path.with_suffix(".tmp")
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)
+
+    def size(self, uid, page_id, key):
+        """Get the size of a cached page, or None if not cached."""
+        try:
+            return self.__get_path(uid, page_id, key).stat().st_size
+        except FileNotFoundError:
+            return None
+
+    def __get_path(self, uid, page_id, key):
+        return self.cache_dir / uid / f"{page_id}-{key}{self.suffix}"
+
+
+class Caches:
+    """The on-disk caches of PDFs, rendered pages, and thumbnails.
+
+    Can be shared by the clients of several reMarkables: entries are keyed
+    by document UIDs, and PDFs by their content.
+    """
+
+    def __init__(self, cache_dir, max_pdf_bytes=2 * 1024**3):
+        self.cache_dir = Path(cache_dir)
+        self.pdf = PdfCache(self.cache_dir / "pdf", max_pdf_bytes)
+        self.pages = PageCache(self.cache_dir / "pages")
+        self.thumbnails = PageCache(self.cache_dir / "thumbnails", ".jpg")
@@ -4,13 +4,21 @@ import argparse
 import logging
 import platform
 import sys
+import threading
+from pathlib import Path
 
-import llfuse
+from . import trace
+from .constants import FORMATS
+from .dedup import DEDUP_POLICIES
+from .profiles import PROFILES, get_profile, save_profile_name
 
-from .find import find_remarkable
-from .refs import ReFs
+# everything else (and with it paramiko, llfuse, requests, ...) is imported
+# only when needed, such that the command line starts fast
 
-parser = argparse.ArgumentParser()
+parser = argparse.ArgumentParser(
+    epilog="Other commands: refs {bench-link,purge-trash,backup,restore}, see "
+    "refs COMMAND --help."
+)
 parser.add_argument(
     "remarkable_address",
     type=str,
@@ -24,9 +32,223 @@ parser.add_argument(
 parser.add_argument(
     "-v", "--verbose", action="store_true", help="Enable debug logging."
 )
+parser.add_argument(
+    "--trace",
+    type=str,
+    metavar="FILE",
+    help="Record a trace of all filesystem calls and write it as Chrome "
+    "trace-event JSON to FILE on unmount (view with chrome://tracing or "
+    "https://ui.perfetto.dev).",
+)
+parser.add_argument(
+    "--attr-timeout",
+    type=float,
+    default=300,
+    help="Seconds for which the kernel may cache file attributes.",
+)
+parser.add_argument(
+    "--entry-timeout",
+    type=float,
+    default=300,
+    help="Seconds for which the kernel may cache directory entries.",
+)
+parser.add_argument(
+    "--memory-budget",
+    type=int,
+    default=512,
+    metavar="MIB",
+    help="Maximal memory (in MiB) to use for the data of documents that are "
+    "not currently open.",
+)
+parser.add_argument(
+    "--spill-threshold",
+    type=int,
+    default=256,
+    metavar="MIB",
+    help="Size (in MiB) above which file data is held in temporary files "
+    "instead of memory.",
+)
+parser.add_argument(
+    "--page-scale",
+    type=float,
+    default=1.0,
+    help="Resolution of the page images in <notebook>.pages folders, relative "
+    "to the reMarkable's screen resolution.",
+)
+parser.add_argument(
+    "--populate-thumbnails",
+    action="store_true",
+    help="After mounting, store the thumbnails of all documents in the "
+    "freedesktop.org thumbnail cache (requires Pillow).",
+)
+parser.add_argument(
+    "--index-content",
+    action="store_true",
+    help="Index the text of documents (in the background) for searches in "
+    "/.search, not only their names, tags, and metadata.",
+)
+parser.add_argument(
+    "--allow-offline",
+    action="store_true",
+    help="If the reMarkable can not be reached, mount the last known state "
+    "of its documents. Only documents that were opened before can be read; "
+    "changes are stored and written to the reMarkable on the next mount.",
+)
+parser.add_argument(
+    "--profile",
+    choices=list(PROFILES),
+    help="Tuning profile for the SSH transport. Defaults to the profile "
+    "saved with 'refs bench-link --save', or 'default'.",
+)
+
+parser.add_argument(
+    "--dedup",
+    choices=DEDUP_POLICIES,
+    default="off",
+    help="What to do with new PDFs that are already on the reMarkable: "
+    "transfer them anyway (off), copy or hard-link the existing PDF on the "
+    "reMarkable instead of transferring it (copy, link), or refuse to import "
+    "them (refuse). Hashes of the PDFs on the reMarkable are cached locally.",
+)
+parser.add_argument(
+    "--formats",
+    default=",".join(FORMATS),
+    metavar="LIST",
+    help="Comma-separated formats to show e-books in: their original EPUB "
+    "(read straight from the reMarkable, without rendering; unannotated "
+    "e-books only if 'pdf' is given as well), and/or the rendered PDF. Other "
+    f"documents are always PDFs. Defaults to {','.join(FORMATS)}.",
+)
+parser.add_argument(
+    "--device",
+    action="append",
+    metavar="NAME=ADDRESS",
+    help="Mount the reMarkable at ADDRESS in the subdirectory NAME. Can be "
+    "given several times to serve several reMarkables from one process, with "
+    "shared caches. Replaces the remarkable_address argument.",
+)
+parser.add_argument(
+    "--engine",
+    choices=["llfuse", "pyfuse3"],
+    default="llfuse",
+    help="The FUSE engine: llfuse serves one request at a time, pyfuse3 "
+    "(requires pyfuse3 and trio) serves up to --workers requests "
+    "concurrently.",
+)
+parser.add_argument(
+    "--workers",
+    type=int,
+    default=16,
+    help="Number of requests to serve concurrently with the pyfuse3 engine.",
+)
+
+# all commands other than mounting, e.g., "refs backup ..."
+command_parser = argparse.ArgumentParser(prog="refs")
+subcommands = command_parser.add_subparsers(
+    dest="command", required=True, metavar="COMMAND"
+)
+
+bench_parser = subcommands.add_parser(
+    "bench-link",
+    help="Measure the link to the reMarkable.",
+    description="Measure SFTP and HTTP throughput and latency to the reMarkable "
+    "with each transport profile, and recommend the fastest.",
+)
+bench_parser.add_argument(
+    "remarkable_address",
+    type=str,
+    nargs="?",
+    help="The host name or IP address of the reMarkable tablet. If not given, "
+    "will try to find the reMarkable.",
+)
+bench_parser.add_argument(
+    "--size",
+    type=int,
+    default=8,
+    metavar="MIB",
+    help="Size (in MiB) of the test file to transfer.",
+)
+bench_parser.add_argument(
+    "--save",
+    action="store_true",
+    help="Use the fastest profile for future mounts.",
+)
+
+purge_parser = subcommands.add_parser(
+    "purge-trash",
+    help="Remove the trash for good.",
+    description="Remove all documents and folders in the trash of the "
+    "reMarkable for good.",
+)
+purge_parser.add_argument(
+    "remarkable_address",
+    type=str,
+    nargs="?",
+    help="The host name or IP address of the reMarkable tablet. If not given, "
+    "will try to find the reMarkable.",
+)
+purge_parser.add_argument(
+    "--dry-run",
+    action="store_true",
+    help="Only list what would be removed.",
+)
+
+backup_parser = subcommands.add_parser(
+    "backup",
+    help="Back up the reMarkable.",
+    description="Back up the raw files of all documents and folders on the "
+    "reMarkable as a single compressed tar archive.",
+)
+backup_parser.add_argument(
+    "remarkable_address",
+    type=str,
+    nargs="?",
+    help="The host name or IP address of the reMarkable tablet. If not given, "
+    "will try to find the reMarkable.",
+)
+backup_parser.add_argument(
+    "archive", type=str, help="The archive to write (.tar.gz), or - for stdout."
+)
+backup_parser.add_argument(
+    "--incremental",
+    type=str,
+    metavar="PREVIOUS",
+    help="Only back up entries modified since the backup PREVIOUS (an archive "
+    "written by 'refs backup' of the same reMarkable, full or incremental). "
+    "Entries removed since are not recorded.",
+)
+
+restore_parser = subcommands.add_parser(
+    "restore",
+    help="Restore a backup.",
+    description="Restore a backup made with 'refs backup' to the reMarkable, "
+    "and restart xochitl.",
+)
+restore_parser.add_argument(
+    "remarkable_address",
+    type=str,
+    nargs="?",
+    help="The host name or IP address of the reMarkable tablet. If not given, "
+    "will try to find the reMarkable.",
+)
+restore_parser.add_argument(
+    "archive", type=str, help="The archive to restore, or - for stdin."
+)
 
 
 def main():
+    # mounting takes no command, such that "refs [ADDRESS] MOUNT_DIR" works as
+    # it always did
+    if sys.argv[1:2] and sys.argv[1] in subcommands.choices:
+        args = command_parser.parse_args()
+        commands = {
+            "bench-link": bench_link_main,
+            "purge-trash": purge_trash_main,
+            "backup": backup_main,
+            "restore": restore_main,
+        }
+        return commands[args.command](args)
+
     args = parser.parse_args()
 
     logging.basicConfig(level=logging.INFO)
@@ -37,22 +259,257 @@ def main():
     remarkable_address = args.remarkable_address
     mount_dir = args.mount_dir
 
+    formats = [f.strip() for f in args.formats.split(",") if f.strip()]
+    if not formats or set(formats) - set(FORMATS):
+        logging.error("Invalid --formats %s, expected some of pdf,epub", args.formats)
+        sys.exit(1)
+    args.formats = formats
+
+    if args.device:
+        if remarkable_address is not None:
+            logging.error("Give either a remarkable_address or --device options.")
+            sys.exit(1)
+        # several reMarkables, as a dict from names to addresses
+        remarkable_address = parse_devices(args.device)
+
     if remarkable_address is None:
+        from .find import find_remarkable
+
         remarkable_address = find_remarkable()
 
+    if remarkable_address is None and args.allow_offline:
+        # the address the reMarkable has when connected via USB
+        remarkable_address = "10.11.99.1"
+
     if remarkable_address is None:
         logging.error("reMarkable not found, please provide a hostname or address.")
         sys.exit(1)
 
     logging.info("Mounting %s to %s", remarkable_address, mount_dir)
 
-    fs = ReFs(remarkable_address, "root", "/home/root/.local/share/remarkable/xochitl")
+    if args.trace:
+        trace.start_tracing()
+
+    try:
+        mount(remarkable_address, mount_dir, args)
+    finally:
+        if args.trace:
+            trace.stop_tracing(args.trace)
+
+
+def parse_devices(device_args):
+    """Parse ``--device NAME=ADDRESS`` arguments into a dict."""
+    devices = {}
+    for device_arg in device_args:
+        name, _, address = device_arg.partition("=")
+        if not name or not address or "/" in name or name in devices:
+            logging.error("Invalid --device %s, expected NAME=ADDRESS", device_arg)
+            sys.exit(1)
+        devices[name] = address
+    return devices
+
+
+def mount(remarkable_address, mount_dir, args):
+    """Mount one reMarkable, or several given as a dict from names to addresses."""
+    import llfuse
+
+    from .thumbnails import populate_thumbnail_cache
+
+    options = dict(
+        username="root",
+        document_root="/home/root/.local/share/remarkable/xochitl",
+        attr_timeout=args.attr_timeout,
+        entry_timeout=args.entry_timeout,
+        memory_budget=args.memory_budget * 1024**2,
+        spill_threshold=args.spill_threshold * 1024**2,
+        page_scale=args.page_scale,
+        index_content=args.index_content,
+        allow_offline=args.allow_offline,
+        profile=get_profile(args.profile),
+        dedup=args.dedup,
+        formats=args.formats,
+    )
+    if isinstance(remarkable_address, dict):
+        from .multi import MultiReFs
+
+        fs = MultiReFs(remarkable_address, **options)
+    else:
+        from .refs import ReFs
 
-    fuse_options = set(llfuse.default_options)
+        fs = ReFs(remarkable_address, **options)
+
+    if args.engine == "pyfuse3":
+        import pyfuse3
+        import trio
+
+        from .asyncfs import AsyncReFs
+
+        fuse_options = set(pyfuse3.default_options)
+    else:
+        fuse_options = set(llfuse.default_options)
     fuse_options.add("fsname=ReFs")
     # fuse_options.discard("default_permissions")
     if platform.system() == "Darwin":
         fuse_options.add("noappledouble")
-    llfuse.init(fs, mount_dir, fuse_options)
-    llfuse.main(workers=1)
-    llfuse.close()
+    elif args.engine == "llfuse":
+        # let the kernel send writes of up to 128 KiB instead of single pages
+        # (always the case with FUSE 3)
+        fuse_options.add("big_writes")
+
+    if args.engine == "pyfuse3":
+        pyfuse3.init(AsyncReFs(fs, args.workers), mount_dir, fuse_options)
+    else:
+        llfuse.init(fs, mount_dir, fuse_options)
+    if args.populate_thumbnails:
+        threading.Thread(
+            target=populate_thumbnail_cache, args=(mount_dir,), daemon=True
+        ).start()
+
+    if args.engine == "pyfuse3":
+        try:
+            trio.run(pyfuse3.main)
+        except BaseException:
+            pyfuse3.close(unmount=False)
+            raise
+        # pyfuse3 has no destroy handler
+        fs.destroy()
+        pyfuse3.close()
+    else:
+        llfuse.main(workers=1)
+        llfuse.close()
+
+
+def bench_link_main(args):
+    """Run ``refs bench-link``."""
+    logging.basicConfig(level=logging.INFO)
+
+    from .bench import bench_link
+    from .find import find_remarkable
+
+    remarkable_address = args.remarkable_address
+    if remarkable_address is None:
+        remarkable_address = find_remarkable()
+    if remarkable_address is None:
+        logging.error("reMarkable not found, please provide a hostname or address.")
+        sys.exit(1)
+
+    size = args.size * 1024**2
+    results, http, best = bench_link(
+        remarkable_address, list(PROFILES.values()), size=size
+    )
+
+    print(f"{'profile':<12} {'connect':>9} {'latency':>9} {'write':>12} {'read':>12}")
+    for result in results:
+        print(
+            f"{result['profile']:<12} "
+            f"{result['connect'] * 1000:>7.0f}ms "
+            f"{result['latency'] * 1000:>7.1f}ms "
+            f"{result['write'] / 1024**2:>8.2f}MiB/s "
+            f"{result['read'] / 1024**2:>8.2f}MiB/s"
+        )
+    if http is not None:
+        print(
+            f"{'http':<12} {'':>9} "
+            f"{http['latency'] * 1000:>7.1f}ms {'':>12} "
+            f"{http['read'] / 1024**2:>8.2f}MiB/s"
+        )
+
+    if best is None:
+        logging.error("No profile could connect to the reMarkable.")
+        sys.exit(1)
+
+    print(f"Fastest profile: {best}")
+    if args.save:
+        save_profile_name(best)
+        print("Saved, future mounts will use it.")
+    else:
+        print(f"Use it with 'refs --profile {best}', or save it with --save.")
+
+
+def connect_client(remarkable_address):
+    """Connect to a reMarkable and read all its entries.
+
+    If no address is given, the reMarkable is searched on the local network.
+    """
+    from .client import RemarkableClient
+    from .find import find_remarkable
+
+    if remarkable_address is None:
+        remarkable_address = find_remarkable()
+    if remarkable_address is None:
+        logging.error("reMarkable not found, please provide a hostname or address.")
+        sys.exit(1)
+
+    client = RemarkableClient(remarkable_address, profile=get_profile())
+    client.scan()
+    return client
+
+
+def purge_trash_main(args):
+    """Run ``refs purge-trash``."""
+    logging.basicConfig(level=logging.INFO)
+
+    client = connect_client(args.remarkable_address)
+
+    if args.dry_run:
+        entries = [e for e in client.store.entries_by_uid.values() if e.deleted]
+        for entry in sorted(entries, key=lambda e: e.name):
+            print(f"{entry.uid}  {entry.name}")
+        print(f"{len(entries)} entries in the trash (not counting their content)")
+        return
+
+    removed = client.purge_trash()
+    if removed:
+        client.restart()
+    print(f"Removed {len(removed)} entries.")
+
+
+def backup_main(args):
+    """Run ``refs backup``."""
+    from .client import RemarkableClient
+
+    logging.basicConfig(level=logging.INFO)
+
+    since = None
+    if args.incremental is not None:
+        with open(args.incremental, "rb") as previous:
+            since = RemarkableClient.get_backup_timestamp(previous)
+
+    client = connect_client(args.remarkable_address)
+
+    if args.archive == "-":
+        count = client.backup(sys.stdout.buffer, since=since)
+    else:
+        archive = Path(args.archive)
+        with archive.open("wb") as output:
+            try:
+                count = client.backup(output, since=since)
+            except BaseException:
+                # don't leave a truncated archive behind
+                output.close()
+                archive.unlink(missing_ok=True)
+                raise
+        if count == 0:
+            archive.unlink(missing_ok=True)
+
+    if count == 0:
+        logging.info("Nothing changed since the last backup.")
+    else:
+        logging.info("Backed up %d entries.", count)
+
+
+def restore_main(args):
+    """Run ``refs restore``."""
+    logging.basicConfig(level=logging.INFO)
+
+    client = connect_client(args.remarkable_address)
+
+    if args.archive == "-":
+        client.restore(sys.stdin.buffer)
+    else:
+        with open(args.archive, "rb") as input:
+            client.restore(input)
+
+    # xochitl only picks up the restored files after a restart
+    client.restart()
+    logging.info("Restored %s.", args.archive)
@@ -1,51 +1,430 @@
 import logging
+import posixpath
+import tarfile
+import threading
+import time
+from pathlib import Path
 
 import paramiko
 
-from .entries import Pdf
+from .cache import Caches, default_cache_dir
+from .connection import SshConnection
+from .constants import RENDERED_PAGE_SIZE_ESTIMATE, ROOT_ID, TRASH_ID
+from .dedup import DEDUP_POLICIES, ContentHashIndex, DuplicateContent
+from .entries import Document, EBook, Pdf
 from .filesystem import SshFileSystem
+from .lines import read_strokes, render_png
+from .offline import MetadataSnapshot, OfflineError, OfflineFileSystem, WriteJournal
 from .render import render_document
 from .store import RemarkableStore
+from .trace import traced
+from .utils import from_json, get_timestamp
+from .web import UploadNotFound, WebInterface
 
 logger = logging.getLogger(__name__)
 
 
 class RemarkableClient:
-    """Client to access documents and their associated PDF data."""
+    """Client to access documents and their associated PDF data.
+
+    While connected, the metadata of all entries is kept in a snapshot in the
+    cache directory. If ``allow_offline`` is set and the reMarkable can not be
+    reached, the client works offline from that snapshot: PDFs and thumbnails
+    are only available if cached, and writes are recorded in a journal that is
+    replayed the next time the client connects.
+
+    A lost connection is re-established on the next access. Changes made on
+    the reMarkable in the meantime are picked up by :meth:`revalidate`. The
+    SSH transport is tuned with the :class:`TransportProfile` ``profile``.
+
+    New PDFs are uploaded through the web interface if it is reachable, such
+    that xochitl shows them right away. All other changes are written via
+    SFTP and need a :meth:`restart` of xochitl, see ``restart_pending``.
+
+    ``dedup`` sets what happens when a new PDF is identical to a PDF already
+    on the reMarkable (see ``DEDUP_POLICIES``): it is either transferred
+    anyway (``off``), copied or hard-linked on the reMarkable (``copy``,
+    ``link``), or not imported at all (``refuse``).
+
+    The raw files of all entries can be backed up (and restored) as a single
+    tar stream, see :meth:`backup`.
+
+    Clients of several reMarkables can share ``caches`` (see :class:`Caches`)
+    and the ``executor`` used for concurrent transfers. Everything else in
+    ``cache_dir`` (snapshot, journal, indexes) belongs to a single reMarkable.
+    """
 
     document_root = "/home/root/.local/share/remarkable/xochitl"
     restart_command = "/bin/systemctl restart xochitl"
 
-    def __init__(self, address, username="root", document_root=None):
-        self.ssh_client = None
-        self.__connect(address, username)
-
+    def __init__(
+        self,
+        address,
+        username="root",
+        document_root=None,
+        cache_dir=None,
+        allow_offline=False,
+        profile=None,
+        dedup="off",
+        caches=None,
+        executor=None,
+    ):
+        if dedup not in DEDUP_POLICIES:
+            raise ValueError(f"Unknown dedup policy {dedup}")
         if document_root is not None:
             self.document_root = document_root
+        if cache_dir is None:
+            cache_dir = default_cache_dir()
+        self.cache_dir = Path(cache_dir)
+
+        self.snapshot = MetadataSnapshot(self.cache_dir / "metadata.json")
+        self.journal = WriteJournal(self.cache_dir / "journal")
+        self.web = WebInterface()
+        self.restart_pending = False
+        self.dedup = dedup
+        self.hash_index = ContentHashIndex(self.cache_dir / "hashes.json")
+
+        self.connection = None
+        try:
+            self.connection = SshConnection(address, username, profile=profile)
+        except (OSError, paramiko.SSHException) as e:
+            if not allow_offline or not self.snapshot.entries:
+                raise
+            logger.warning("Can not reach %s (%s), working offline", address, e)
+
+        if self.offline:
+            self.fs = OfflineFileSystem(self.snapshot, self.journal)
+        else:
+            self.fs = SshFileSystem(
+                self.connection, self.document_root, executor=executor
+            )
+            if self.journal.replay(self.fs):
+                # make xochitl pick up the offline changes
+                self.restart()
 
-        self.fs = SshFileSystem(self.ssh_client, self.document_root)
         self.store = RemarkableStore(self.fs)
+        if not self.offline:
+            self.__store_generation = self.connection.generation
+
+        if caches is None:
+            caches = Caches(self.cache_dir)
+        self.pdf_cache = caches.pdf
+        self.page_cache = caches.pages
+        self.thumbnail_cache = caches.thumbnails
+
+        # map from (document UID, version) to (PDF size, exact)
+        self.__pdf_sizes = {}
+        # map from (document UID, version) to whether it has annotations
+        self.__annotated = {}
+        self.__annotated_lock = threading.Lock()
+
+    @property
+    def offline(self):
+        return self.connection is None
+
+    def scan(self, background=False):
+        """Read all entries into the store, optionally in a background thread.
+
+        See :meth:`RemarkableStore.scan`.
+        """
+        if background:
+            threading.Thread(target=self.scan, name="scan", daemon=True).start()
+            return
+
+        self.store.scan()
+        if not self.offline:
+            self.snapshot.update_all(self.store.entries_by_uid.values())
+            self.store.add_listener(self.__update_snapshot)
+
+    def revalidate(self):
+        """Update the store with changes made while the connection was lost.
+
+        Cheap if the connection was not re-established since the last call.
+        """
+        if self.offline or self.connection.generation == self.__store_generation:
+            return
+        if not self.store.scan_complete.is_set():
+            # the scan is reading fresh entries anyway
+            return
+        generation = self.connection.generation
+        self.store.revalidate()
+        self.__store_generation = generation
 
+    @traced
     def restart(self):
         """Restart ``xochitl`` (the GUI) on the remarkable.
 
         This is necessary to see changes made to the document tree.
         """
-        _, out, _ = self.ssh_client.exec_command(self.restart_command)
+        if self.offline:
+            logger.info("Offline, xochitl will be restarted after replaying changes")
+            return
+        _, out, _ = self.connection.exec_command(self.restart_command)
         if out.channel.recv_exit_status() != 0:
             logger.error("Could not restart xochitl")
+            return
+        self.restart_pending = False
+
+    @traced
+    def purge_trash(self):
+        """Remove everything in the trash from the reMarkable for good.
+
+        Returns the removed entries. Needs a :meth:`restart` afterwards.
+        """
+        removed = self.store.purge_trash()
+        if removed:
+            self.restart_pending = True
+        return removed
+
+    @traced
+    def backup(self, output, since=None):
+        """Write the raw files of the reMarkable to ``output``.
+
+        ``output`` is a binary file, the files are written to it as a
+        gzip-compressed tar, streamed in a single remote command.
+
+        With ``since`` (a ``lastModified`` timestamp, e.g., of an earlier
+        backup, see :meth:`get_backup_timestamp`), only entries modified later
+        are included (entries removed since are not recorded). Returns the
+        number of entries backed up; if that is 0, nothing was written.
+        """
+        self.store.wait_until_scanned()
+        entries = [
+            entry
+            for uid, entry in list(self.store.entries_by_uid.items())
+            if uid not in (ROOT_ID, TRASH_ID)
+        ]
+        if not entries:
+            return 0
+
+        if since is None:
+            logger.info("Backing up all %d entries...", len(entries))
+            self.fs.export_archive(output)
+        else:
+            entries = [entry for entry in entries if get_timestamp(entry) > since]
+            if not entries:
+                return 0
+            logger.info("Backing up %d changed entries...", len(entries))
+            self.fs.export_archive(output, [entry.uid for entry in entries])
+
+        return len(entries)
 
+    @staticmethod
+    def get_backup_timestamp(input):
+        """Get the newest ``lastModified`` of the entries in a backup.
+
+        ``input`` is a binary file with a backup made by :meth:`backup` (full
+        or incremental). Backups made from there on only need the entries
+        modified later.
+        """
+        newest = 0.0
+        with tarfile.open(fileobj=input, mode="r|gz") as archive:
+            for member in archive:
+                name = posixpath.normpath(member.name)
+                if "/" in name or not name.endswith(".metadata"):
+                    continue
+                if not member.isfile():
+                    continue
+                metadata = from_json(archive.extractfile(member).read())
+                try:
+                    newest = max(newest, float(metadata["lastModified"]))
+                except (KeyError, TypeError, ValueError):
+                    continue
+        return newest
+
+    @traced
+    def restore(self, input):
+        """Restore a backup made with :meth:`backup` from the binary ``input``.
+
+        Restored entries replace the entries with the same UIDs, all others
+        are kept. The store is updated with the restored entries. Needs a
+        :meth:`restart` afterwards.
+        """
+        logger.info("Restoring backup...")
+        self.fs.import_archive(input)
+        self.restart_pending = True
+        # pick up the restored entries
+        self.store.wait_until_scanned()
+        self.store.revalidate()
+
+    @traced
     def get_pdf(self, document):
         """Get PDF data associated with a document."""
         logger.debug("[RemarkableClient::get_pdf] %s", document)
 
-        return render_document(document)
+        data = self.pdf_cache.get(document)
+        if data is not None:
+            return data
+        if self.offline:
+            raise OfflineError(document.uid + ".pdf")
+
+        if self.is_plain_pdf(document):
+            # no need to render, the original is what we want
+            data = self.fs.read_file(document.uid + ".pdf", binary=True)
+        else:
+            data = render_document(document, self.web.session)
+
+        self.pdf_cache.put(document, data)
+        self.__pdf_sizes[(document.uid, document.last_modified)] = (len(data), True)
+
+        return data
+
+    def get_pdf_size(self, document):
+        """Get the size of the PDF data of a document, without rendering it.
 
+        Returns a tuple ``(size, exact)``. If the size is not known (the
+        document was never rendered), ``size`` is an estimate and ``exact`` is
+        ``False``.
+        """
+        key = (document.uid, document.last_modified)
+        if key in self.__pdf_sizes:
+            return self.__pdf_sizes[key]
+
+        size = self.pdf_cache.size(document)
+        if size is not None:
+            result = (size, True)
+        elif self.offline:
+            # can't be read, don't remember the size for when we are back
+            return 0, True
+        else:
+            # list the document root at once, to have the attributes of all
+            # PDFs cached
+            self.fs.list("/")
+            if self.is_plain_pdf(document):
+                result = (self.fs.stat(document.uid + ".pdf").st_size, True)
+            else:
+                result = (self.__estimate_pdf_size(document), False)
+
+        self.__pdf_sizes[key] = result
+        return result
+
+    @traced
+    def get_page_png(self, document, page_id, scale=1.0):
+        """Get a single page of a document, rendered as a PNG image."""
+        logger.debug("[RemarkableClient::get_page_png] %s %s", document, page_id)
+
+        key = f"{self.get_page_version(document, page_id)}-{scale}"
+        data = self.page_cache.get(document.uid, page_id, key)
+        if data is not None:
+            return data
+
+        try:
+            lines = self.fs.read_file(f"{document.uid}/{page_id}.rm", binary=True)
+            strokes = read_strokes(lines)
+        except FileNotFoundError:
+            # pages without any strokes don't have a lines file
+            strokes = []
+        data = render_png(strokes, scale)
+
+        self.page_cache.put(document.uid, page_id, key, data)
+        return data
+
+    def get_page_png_size(self, document, page_id, scale=1.0):
+        """Get the size of a rendered page as a tuple ``(size, exact)``."""
+        key = f"{self.get_page_version(document, page_id)}-{scale}"
+        size = self.page_cache.size(document.uid, page_id, key)
+        if size is not None:
+            return size, True
+        return RENDERED_PAGE_SIZE_ESTIMATE, False
+
+    def get_page_version(self, document, page_id):
+        """Get the version (modification time of the lines file) of a page."""
+        try:
+            # list all pages at once, to have their attributes cached
+            self.fs.list(document.uid)
+            return self.fs.stat(f"{document.uid}/{page_id}.rm").st_mtime
+        except FileNotFoundError:
+            return "blank"
+
+    def has_thumbnail(self, document):
+        """Check whether the reMarkable created thumbnails for a document."""
+        if self.offline:
+            page_id = self.__get_thumbnail_page_id(document)
+            key = document.last_modified
+            return (
+                page_id is not None
+                and self.thumbnail_cache.size(document.uid, page_id, key) is not None
+            )
+        return document.uid + ".thumbnails" in self.fs.list("/")
+
+    @traced
+    def get_thumbnail(self, document):
+        """Get the JPEG thumbnail of the first page of a document.
+
+        Returns None if there is no thumbnail.
+        """
+        self.prefetch_thumbnails([document])
+        page_id = self.__get_thumbnail_page_id(document)
+        if page_id is None:
+            return None
+        return self.thumbnail_cache.get(document.uid, page_id, document.last_modified)
+
+    def get_thumbnail_size(self, document):
+        """Get the size of a document's thumbnail as a tuple ``(size, exact)``."""
+        page_id = self.__get_thumbnail_page_id(document)
+        if page_id is not None:
+            size = self.thumbnail_cache.size(
+                document.uid, page_id, document.last_modified
+            )
+            if size is not None:
+                return size, True
+            try:
+                path = f"{document.uid}.thumbnails/{page_id}.jpg"
+                return self.fs.stat(path).st_size, True
+            except (FileNotFoundError, OfflineError):
+                pass
+        return 0, True
+
+    @traced
+    def prefetch_thumbnails(self, documents):
+        """Fetch the thumbnails of several documents concurrently."""
+        paths = {}
+        for document in documents:
+            if not self.has_thumbnail(document):
+                continue
+            page_id = self.__get_thumbnail_page_id(document)
+            if page_id is None:
+                continue
+            key = document.last_modified
+            if self.thumbnail_cache.size(document.uid, page_id, key) is not None:
+                continue
+            paths[f"{document.uid}.thumbnails/{page_id}.jpg"] = (document, page_id)
+
+        thumbnails = self.fs.read_files(paths, binary=True)
+
+        for path, data in thumbnails.items():
+            if data is None:
+                continue
+            document, page_id = paths[path]
+            self.thumbnail_cache.put(
+                document.uid, page_id, document.last_modified, data
+            )
+
+    def is_plain_pdf(self, document):
+        """Check whether a document is a PDF without annotations."""
+        return isinstance(document, Pdf) and not self.__has_annotations(document)
+
+    def is_plain_ebook(self, document):
+        """Check whether a document is an e-book without annotations."""
+        return isinstance(document, EBook) and not self.__has_annotations(document)
+
+    def get_epub_size(self, document):
+        """Get the size of the original EPUB of an e-book."""
+        return self.fs.stat(document.uid + ".epub").st_size
+
+    @traced
+    def read_epub(self, document, offset, size):
+        """Read a range of the original EPUB of an e-book from the reMarkable."""
+        return self.fs.read_range(document.uid + ".epub", offset, size)
+
+    @traced
     def put_pdf(self, pdf_data, folder=None, name=None, document=None):
         """Set the PDF data of a document.
 
         This either creates a new PDF document in the given folder and name or
-        replaces the PDF of an existing document.
+        replaces the PDF of an existing document. Documents that don't have
+        a PDF on the reMarkable yet are uploaded through the web interface, if
+        possible, in which case the document gets a new UID.
 
         Returns the (newly created) document.
         """
@@ -61,26 +440,181 @@ class RemarkableClient:
                     "Writing entries other than Pdf not yet implemented"
                 )
 
-        self.fs.write_file(pdf_data, document.uid + ".pdf")
-        self.fs.write_file("", document.uid + ".pagedata")
-        self.fs.make_dir(document.uid)
+        digest = None
+        source = None
+        if self.dedup != "off" and pdf_data and not self.offline:
+            if not self.fs.exists(document.uid + ".pdf"):
+                digest = self.hash_index.get_digest(pdf_data)
+                source = self.__find_duplicate(digest, document)
+
+        uploaded_uid = None
+        if source is None:
+            uploaded_uid = self.__upload_pdf(pdf_data, document)
+        if uploaded_uid is None:
+            if source is not None:
+                logger.info("Copying PDF of %s instead of transferring it", source)
+                self.fs.copy_file(
+                    source + ".pdf", document.uid + ".pdf", link=self.dedup == "link"
+                )
+            else:
+                # sends only the changed blocks if the document had a PDF
+                self.fs.update_file(pdf_data, document.uid + ".pdf")
+            self.fs.write_file("", document.uid + ".pagedata")
+            self.fs.make_dir(document.uid)
+            self.restart_pending = True
+
+        if digest is not None:
+            # uploaded documents continue under the UID the reMarkable gave them
+            self.__add_hash(uploaded_uid or document.uid, digest)
+
+        self.pdf_cache.put(document, pdf_data)
+        self.__pdf_sizes[(document.uid, document.last_modified)] = (len(pdf_data), True)
 
         return document
 
-    def __connect(self, address, username):
-        logger.info("Connecting to %s...", address)
+    def __find_duplicate(self, digest, document):
+        """Find a document on the reMarkable with the same PDF.
+
+        Returns the UID of that document, or None. With the ``refuse``
+        policy, ``document`` is removed instead and :class:`DuplicateContent`
+        raised.
+        """
+        self.hash_index.refresh(self.fs)
+        uids = sorted(self.hash_index.find(digest) - {document.uid})
+        if not uids:
+            return None
+
+        if self.dedup == "refuse":
+            # duplicates in the trash don't count
+            for uid in uids:
+                entry = self.store.entries_by_uid.get(uid)
+                if entry is not None and not entry.deleted:
+                    logger.error("%s has the same PDF as %s, refusing", document, entry)
+                    self.store.remove(document)
+                    raise DuplicateContent(document.name, uid)
+            return None
+
+        logger.info("%s has the same PDF as document %s", document, uids[0])
+        return uids[0]
 
-        if self.ssh_client is not None:
-            logger.error("Already connected")
+    def __add_hash(self, uid, digest):
+        path = uid + ".pdf"
+        # the attributes cached after writing don't have the remote mtime
+        self.fs.invalidate(path)
+        try:
+            attrs = self.fs.stat(path)
+        except FileNotFoundError:
+            logger.error("Can not find the PDF of %s to index its hash", uid)
             return
+        self.hash_index.add(uid, attrs.st_size, attrs.st_mtime, digest)
+
+    def __upload_pdf(self, pdf_data, document):
+        """Upload a new PDF document through the web interface.
+
+        Returns the new UID if the upload succeeded and the document was
+        replaced by the one the reMarkable created, None if the PDF was not
+        uploaded. Raises :class:`UploadNotFound` (and removes ``document``) if
+        the uploaded document can't be found.
+        """
+        if self.offline or not pdf_data or document.parent_uid == TRASH_ID:
+            return None
+        if self.fs.exists(document.uid + ".pdf") or not self.web.available:
+            return None
+
+        known_files = set(self.fs.list("/"))
+        if not self.web.upload(document.parent_uid, document.name + ".pdf", pdf_data):
+            return None
 
-        ssh_client = paramiko.SSHClient()
-        ssh_client.load_system_host_keys()
-        ssh_client.connect(address, username=username, look_for_keys=True)
+        uid = self.__find_uploaded(document, len(pdf_data), known_files)
+        if uid is None:
+            # don't write the PDF again, the reMarkable might still create the
+            # uploaded document, which is then picked up as a new entry
+            logger.error("Uploaded %s, but can't find it on reMarkable", document)
+            self.store.remove(document)
+            raise UploadNotFound(document.name)
 
-        logger.info("...connected.")
-        self.ssh_client = ssh_client
+        self.store.adopt(document, uid)
+        return uid
 
-    def __disconnect(self):
-        self.ssh_client.close()
-        self.ssh_client = None
+    def __find_uploaded(self, document, size, known_files, timeout=30):
+        """Find the UID of a document that was just uploaded.
+
+        The document is matched by its name, folder, and PDF size. Returns None
+        if it didn't show up within ``timeout`` seconds.
+        """
+        deadline = time.monotonic() + timeout
+        # whether the metadata of new files matches the name and folder
+        candidates = {}
+        while True:
+            self.fs.invalidate("/")
+            files = set(self.fs.list("/"))
+            for filename in sorted(files - known_files):
+                if not filename.endswith(".metadata"):
+                    continue
+                if filename not in candidates:
+                    metadata = from_json(self.fs.read_file(filename))
+                    candidates[filename] = (
+                        metadata.get("visibleName") == document.name
+                        and metadata.get("parent") == document.parent_uid
+                    )
+                if not candidates[filename]:
+                    continue
+                # the PDF is written after the metadata
+                uid = filename[: -len(".metadata")]
+                path = uid + ".pdf"
+                if path in files and self.fs.stat(path).st_size == size:
+                    return uid
+            if time.monotonic() > deadline:
+                return None
+            time.sleep(0.5)
+
+    def __get_thumbnail_page_id(self, document):
+        if document.pages:
+            return document.pages[0]
+
+        # documents without a page list, look for any thumbnail
+        try:
+            files = sorted(self.fs.list(document.uid + ".thumbnails"))
+        except (FileNotFoundError, OfflineError):
+            return None
+        thumbnails = [f for f in files if f.endswith(".jpg")]
+        return thumbnails[0][: -len(".jpg")] if thumbnails else None
+
+    def __has_annotations(self, document):
+        # annotating a document changes its version, no need to check it again
+        # until then
+        key = (document.uid, document.last_modified)
+        with self.__annotated_lock:
+            annotated = self.__annotated.get(key)
+            if annotated is not None:
+                return annotated
+
+            # check all documents at once, instead of listing each folder
+            annotated_uids = self.fs.list_annotated()
+            self.__annotated = {
+                (entry.uid, entry.last_modified): entry.uid in annotated_uids
+                for entry in list(self.store.entries_by_uid.values())
+                if isinstance(entry, Document)
+            }
+            annotated = document.uid in annotated_uids
+            self.__annotated[key] = annotated
+            return annotated
+
+    def __estimate_pdf_size(self, document):
+        size = max(len(document.pages), 1) * RENDERED_PAGE_SIZE_ESTIMATE
+
+        # annotations are rendered on top of the original
+        source = {Pdf: ".pdf", EBook: ".epub"}.get(type(document))
+        if source is not None:
+            try:
+                size += self.fs.stat(document.uid + source).st_size
+            except FileNotFoundError:
+                pass
+
+        return size
+
+    def __update_snapshot(self, entry):
+        if entry.uid in self.store.entries_by_uid:
+            self.snapshot.update(entry)
+        else:
+            self.snapshot.remove(entry.uid)
@@ -0,0 +1,140 @@
+import logging
+import socket
+import threading
+import time
+
+import paramiko
+
+from .offline import OfflineError
+from .profiles import PROFILES
+from .trace import traced
+
+logger = logging.getLogger(__name__)
+
+
+class SshConnection:
+    """An SSH connection to the reMarkable that can re-establish itself.
+
+    A keepalive is sent every ``keepalive`` seconds, such that dead transports
+    (e.g., after Wi-Fi went to sleep or the tablet was suspended) are noticed.
+    :meth:`reconnect` retries with exponential backoff (up to ``max_backoff``
+    seconds between attempts) for at most ``reconnect_timeout`` seconds.
+
+    ``generation`` counts the connections made so far, such that users of the
+    connection can tell whether they need to re-open their channels.
+
+    Ciphers, MACs, compression, and SFTP window and packet sizes are taken
+    from the :class:`TransportProfile` ``profile``.
+    """
+
+    def __init__(
+        self,
+        address,
+        username="root",
+        keepalive=15,
+        connect_timeout=10,
+        reconnect_timeout=60,
+        max_backoff=8,
+        profile=None,
+    ):
+        if profile is None:
+            profile = PROFILES["default"]
+
+        self.address = address
+        self.profile = profile
+        self.username = username
+        self.keepalive = keepalive
+        self.connect_timeout = connect_timeout
+        self.reconnect_timeout = reconnect_timeout
+        self.max_backoff = max_backoff
+
+        self.ssh_client = None
+        self.generation = 0
+        self.lock = threading.RLock()
+
+        self.__connect()
+
+    @property
+    def is_alive(self):
+        """Whether the underlying transport is still usable."""
+        if self.ssh_client is None:
+            return False
+        transport = self.ssh_client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def open_sftp(self):
+        kwargs = {}
+        if self.profile.window_size is not None:
+            kwargs["window_size"] = self.profile.window_size
+        if self.profile.max_packet_size is not None:
+            kwargs["max_packet_size"] = self.profile.max_packet_size
+        return paramiko.SFTPClient.from_transport(
+            self.ssh_client.get_transport(), **kwargs
+        )
+
+    def exec_command(self, command):
+        return self.ssh_client.exec_command(command)
+
+    @traced
+    def reconnect(self, generation):
+        """Re-establish the connection.
+
+        Does nothing if the connection was already re-established after
+        ``generation`` (e.g., by another thread). Raises :class:`OfflineError`
+        if the reMarkable can not be reached within ``reconnect_timeout``
+        seconds.
+        """
+        with self.lock:
+            if generation != self.generation and self.is_alive:
+                return
+
+            logger.warning("Connection to %s lost, reconnecting...", self.address)
+            self.close()
+
+            start = time.monotonic()
+            delay = 0.5
+            while True:
+                try:
+                    self.__connect()
+                    return
+                except (OSError, paramiko.SSHException) as e:
+                    if time.monotonic() - start + delay > self.reconnect_timeout:
+                        logger.error("Can not reconnect to %s: %s", self.address, e)
+                        raise OfflineError(self.address) from e
+                    logger.debug("Reconnecting failed (%s), retrying in %ss", e, delay)
+                    time.sleep(delay)
+                    delay = min(delay * 2, self.max_backoff)
+
+    def close(self):
+        if self.ssh_client is not None:
+            self.ssh_client.close()
+            self.ssh_client = None
+
+    @traced
+    def __connect(self):
+        logger.info("Connecting to %s (%s)...", self.address, self.profile.name)
+
+        # the algorithms paramiko supports, of a transport that never connects
+        with socket.socket() as sock:
+            security_options = paramiko.Transport(sock).get_security_options()
+
+        ssh_client = paramiko.SSHClient()
+        ssh_client.load_system_host_keys()
+        ssh_client.connect(
+            self.address,
+            username=self.username,
+            look_for_keys=True,
+            timeout=self.connect_timeout,
+            compress=self.profile.compress,
+            disabled_algorithms=self.profile.get_disabled_algorithms(security_options),
+        )
+        transport = ssh_client.get_transport()
+        transport.set_keepalive(self.keepalive)
+        if self.profile.window_size is not None:
+            transport.default_window_size = self.profile.window_size
+        if self.profile.max_packet_size is not None:
+            transport.default_max_packet_size = self.profile.max_packet_size
+
+        logger.info("...connected.")
+        self.ssh_client = ssh_client
+        self.generation += 1
@@ -24,6 +24,12 @@ ANYTHING = 0xFF
 ROOT_ID = ""
 TRASH_ID = "trash"
 
+# the web interface of the reMarkable, only available via USB
+WEB_INTERFACE_URL = "http://10.11.99.1"
+
+# formats documents can be shown in (e-books can be shown in both)
+FORMATS = ["pdf", "epub"]
+
 PDF_BASE_METADATA = {
     "deleted": False,
     "metadatamodified": True,
@@ -71,6 +77,10 @@ FOLDER_BASE_METADATA = {
 }
 FOLDER_BASE_CONTENT = {}
 
+# rough size of a rendered page, used to estimate the size of documents that
+# have not been rendered yet
+RENDERED_PAGE_SIZE_ESTIMATE = 128 * 1024
+
 WIDTH_PX = 1404
 HEIGHT_PX = 1872
 WIDTH_MM = 206
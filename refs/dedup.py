@@ -0,0 +1,144 @@
+import errno
+import hashlib
+import logging
+import os
+import threading
+from pathlib import Path
+from typing import ClassVar
+
+from .trace import traced
+from .utils import from_json, to_json
+
+logger = logging.getLogger(__name__)
+
+# what to do when importing a PDF that is already on the reMarkable:
+#   off:    don't check, always transfer
+#   copy:   copy the existing PDF on the reMarkable instead of transferring it
+#   link:   hard-link the existing PDF (no transfer, no additional storage)
+#   refuse: don't import the PDF
+DEDUP_POLICIES = ["off", "copy", "link", "refuse"]
+
+
+class DuplicateContent(OSError):
+    """Raised when importing a PDF that is already on the reMarkable.
+
+    Only with the ``refuse`` policy.
+    """
+
+    def __init__(self, name, uid):
+        super().__init__(errno.EEXIST, f"Same PDF as document {uid}", name)
+        self.uid = uid
+
+
+class ContentHashIndex:
+    """An index of the hashes of all PDFs on the reMarkable.
+
+    Hashes are computed on the reMarkable (see
+    :meth:`SshFileSystem.hash_files`) and kept in ``index_file`` together
+    with the size and modification time of the PDF they were computed from,
+    such that only new or changed PDFs are hashed again.
+    """
+
+    hash_commands: ClassVar[dict] = {"sha256": "sha256sum", "md5": "md5sum"}
+
+    def __init__(self, index_file, algorithm="sha256"):
+        if algorithm not in self.hash_commands:
+            raise ValueError(f"Unsupported hash algorithm {algorithm}")
+
+        self.index_file = Path(index_file)
+        self.algorithm = algorithm
+        self.lock = threading.Lock()
+
+        # map from UIDs to (size, mtime, digest)
+        self.hashes = {}
+        # map from digests to UIDs
+        self.uids = {}
+
+        self.__load()
+
+    def get_digest(self, data):
+        return hashlib.new(self.algorithm, data).hexdigest()
+
+    @traced
+    def refresh(self, fs):
+        """Hash the PDFs that were added or changed on the reMarkable."""
+        pdfs = {}
+        for filename in fs.list("/"):
+            if filename.endswith(".pdf"):
+                attrs = fs.stat(filename)
+                pdfs[filename[: -len(".pdf")]] = (attrs.st_size, attrs.st_mtime)
+
+        with self.lock:
+            removed = set(self.hashes) - set(pdfs)
+            changed = [
+                uid
+                for uid, (size, mtime) in pdfs.items()
+                if self.hashes.get(uid, (None, None))[:2] != (size, mtime)
+            ]
+            for uid in removed | set(changed):
+                self.__remove(uid)
+
+        if not removed and not changed:
+            return
+
+        logger.info("Hashing %d PDFs on the reMarkable...", len(changed))
+        digests = fs.hash_files(
+            [uid + ".pdf" for uid in changed], self.hash_commands[self.algorithm]
+        )
+        with self.lock:
+            for uid in changed:
+                digest = digests[uid + ".pdf"]
+                if digest is not None:
+                    self.__add(uid, *pdfs[uid], digest)
+        self.save()
+
+    def find(self, digest):
+        """Get the UIDs of all documents with a PDF of the given digest."""
+        with self.lock:
+            return set(self.uids.get(digest, ()))
+
+    def add(self, uid, size, mtime, digest):
+        """Record the digest of the PDF of a document."""
+        with self.lock:
+            self.__remove(uid)
+            self.__add(uid, size, mtime, digest)
+        self.save()
+
+    def save(self):
+        with self.lock:
+            index = {
+                "algorithm": self.algorithm,
+                "hashes": {uid: list(h) for uid, h in self.hashes.items()},
+            }
+        self.index_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = self.index_file.with_suffix(".tmp")
+        tmp_file.write_text(to_json(index))
+        os.replace(tmp_file, self.index_file)
+
+    def __add(self, uid, size, mtime, digest):
+        self.hashes[uid] = (size, mtime, digest)
+        self.uids.setdefault(digest, set()).add(uid)
+
+    def __remove(self, uid):
+        hashes = self.hashes.pop(uid, None)
+        if hashes is None:
+            return
+        uids = self.uids[hashes[2]]
+        uids.discard(uid)
+        if not uids:
+            del self.uids[hashes[2]]
+
+    def __load(self):
+        try:
+            index = from_json(self.index_file.read_text())
+        except FileNotFoundError:
+            return
+        except ValueError:
+            logger.error("Hash index %s is corrupt, ignoring", self.index_file)
+            return
+
+        if index.get("algorithm") != self.algorithm:
+            # hashed with another algorithm, start over
+            return
+        for uid, (size, mtime, digest) in index["hashes"].items():
+            self.__add(uid, size, mtime, digest)
@@ -9,6 +9,7 @@ from .constants import (
     ROOT_ID,
     TRASH_ID,
 )
+from .trace import traced
 from .utils import from_json, to_json
 import arrow
 import logging
@@ -52,6 +53,11 @@ class Entry:
             logger.error("Failed to read content JSON for entry with UID %s", uid)
             raise e
 
+        return Entry.create(uid, filesystem, metadata, content)
+
+    @staticmethod
+    def create(uid, filesystem, metadata, content):
+        """Create an entry of the right type from its metadata and content."""
         entry_type = metadata["type"]
 
         if entry_type == FOLDER_TYPE:
@@ -91,10 +97,15 @@ class Entry:
         self.__modified()
         self.__write()
 
+    @property
+    def last_modified(self):
+        return self.metadata.get("lastModified")
+
     @property
     def deleted(self):
         return self.metadata.get("deleted", False) or self.parent_uid == TRASH_ID
 
+    @traced
     def __write(self):
         if not self.modified:
             return
@@ -202,6 +213,12 @@ class Document(Entry):
 
         if "pages" in content:
             self.pages = content["pages"]
+        elif "cPages" in content:
+            self.pages = [
+                page["id"]
+                for page in content["cPages"]["pages"]
+                if "deleted" not in page
+            ]
         else:
             self.pages = []
 
@@ -1,117 +1,741 @@
-import os
-from stat import S_ISREG, S_ISDIR
+import errno
+import hashlib
 import logging
+import os
+import posixpath
+import queue
+import shlex
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from stat import S_IFDIR, S_IFREG, S_ISDIR, S_ISREG
+
+import paramiko
+
+from .offline import OfflineError
+from .trace import span
 
 logger = logging.getLogger(__name__)
 
 
-class SshFileSystem:
-    """An SSH client to interact with the remakable filesystem."""
+class SftpPool:
+    """A pool of SFTP sessions, multiplexed over a single SSH connection.
+
+    Sessions are grouped in lanes (given as a dict from lane names to the
+    number of sessions), such that, e.g., a large upload in one lane never
+    blocks a metadata lookup in another. Each session is used by a single
+    thread at a time, see :meth:`session`. Sessions are opened on first use,
+    and re-opened if the connection was re-established since.
+    """
+
+    def __init__(self, connection, lanes):
+        self.connection = connection
+        self.lanes = dict(lanes)
+        self.__slots = {}
+        for lane, count in self.lanes.items():
+            slots = queue.LifoQueue()
+            for _ in range(count):
+                slots.put((None, None))
+            self.__slots[lane] = slots
+
+    @contextmanager
+    def session(self, lane):
+        """Check out a session of ``lane``, waiting until one is free."""
+        slots = self.__slots[lane]
+        generation, sftp = slots.get()
+        try:
+            if generation != self.connection.generation:
+                if sftp is not None:
+                    sftp.close()
+                sftp = self.connection.open_sftp()
+                generation = self.connection.generation
+            yield sftp
+        finally:
+            slots.put((generation, sftp))
 
-    def __init__(self, ssh_client, root_dir=None):
-        self.sftp = ssh_client.open_sftp()
+
+class SshFileSystem:
+    """An SSH client to interact with the remakable filesystem.
+
+    File attributes and directory listings are cached for ``cache_ttl``
+    seconds. The cache is filled from ``listdir_attr`` (a single round trip
+    for a whole directory) and kept up-to-date by our own writes, such that
+    existence checks before writing do not need another round trip.
+
+    SFTP sessions are pooled in two lanes: ``metadata_sessions`` sessions for
+    listings, attributes, and small files, and ``bulk_sessions`` sessions for
+    larger transfers. Files larger than ``range_size`` are transferred in
+    ranges of that size, concurrently over the bulk sessions. Many small
+    files can be read at once with :meth:`read_files`. Concurrent transfers
+    run in ``executor``, if given (e.g., to share one thread pool between the
+    filesystems of several reMarkables).
+
+    If the :class:`SshConnection` is lost during an operation, it is
+    re-established and the SFTP sessions are re-opened. Idempotent operations
+    (reads, listings, and writes of whole files) are then retried; others
+    raise ``ConnectionResetError``.
+    """
+
+    # files up to this size are transferred in the metadata lane
+    small_file_size = 64 * 1024
+    # size of the chunks streamed to and from remote commands
+    stream_chunk_size = 1024**2
+    # files from this size on are updated by sending changed blocks only, in
+    # blocks of at least delta_block_size bytes (and at most max_delta_blocks
+    # blocks per file)
+    delta_min_size = 1024**2
+    delta_block_size = 64 * 1024
+    max_delta_blocks = 2048
+
+    def __init__(
+        self,
+        connection,
+        root_dir=None,
+        cache_ttl=60,
+        metadata_sessions=1,
+        bulk_sessions=4,
+        range_size=4 * 1024**2,
+        executor=None,
+    ):
+        self.connection = connection
+        self.executor = executor
+        self.bulk_sessions = bulk_sessions
+        self.range_size = range_size
+        self.pool = SftpPool(
+            connection, {"metadata": metadata_sessions, "bulk": bulk_sessions}
+        )
+        self.__cache_generation = connection.generation
 
         if root_dir is None:
             root_dir = "/"
         self.root_dir = root_dir
+        self.cache_ttl = cache_ttl
+
+        # map from remote paths to (timestamp, attributes), where attributes
+        # are None for paths known not to exist
+        self.__attrs = {}
+        # map from remote directory paths to (timestamp, set of names)
+        self.__listings = {}
+        self.__cache_lock = threading.RLock()
 
     def put_file(self, local, remote, overwrite=False):
         """Copy file ``local`` to ``remote`` (relative to document root)"""
-
         path = self.__to_remote_path(remote)
 
-        if overwrite or not self.__is_file(path):
-            self.sftp.put(local, path)
-            return True
+        def put():
+            if overwrite or not self.__is_file(path):
+                with open(local, "rb") as f:
+                    size = os.fstat(f.fileno()).st_size
+                    with span("sftp.put", path=path, size=size):
+                        self.__upload(
+                            path, size, lambda o, n: os.pread(f.fileno(), n, o)
+                        )
+                self.__cache_attrs(path, self.__make_attrs(S_IFREG | 0o644, size))
+                return True
+            return False
 
-        return False
+        return self.__run(put, path)
 
     def get_file(self, remote, local, overwrite=False):
         """Copy file ``remote`` (relative to document root) to ``local``"""
-
         path = self.__to_remote_path(remote)
 
         if overwrite or not os.path.exists(local):
-            self.sftp.get(path, local)
+            with span("sftp.get", path=path):
+                content = self.read_file(remote, binary=True)
+            with open(local, "wb") as f:
+                f.write(content)
             return True
 
         return False
 
     def read_file(self, remote, binary=False):
         """Read file ``remote`` (relative to document root)."""
-
         path = self.__to_remote_path(remote)
 
-        content = "" if not binary else b""
-        mode = "r" if not binary else "rb"
-        for line in self.sftp.open(path, mode):
-            content += line
+        attrs = self.__get_attrs(path)
+        if attrs is None:
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
 
-        return content
+        content = self.__run(lambda: self.__download(path, attrs.st_size), path)
 
-    def write_file(self, content, remote, overwrite=False):
-        """Create file ``remote`` (relative to document root) with the given
-        content."""
+        return content if binary else content.decode()
+
+    def read_range(self, remote, offset, length):
+        """Read ``length`` bytes at ``offset`` of file ``remote``.
 
+        ``remote`` is relative to document root. The rest of the file is not
+        read.
+        """
         path = self.__to_remote_path(remote)
 
-        if overwrite or not self.__is_file(path):
-            try:
-                with self.sftp.open(path, "w") as f:
-                    f.write(content)
-            except Exception:
-                logger.error("Could not open %s for writing", path)
-                raise
-            return True
+        def read():
+            with self.pool.session("bulk") as sftp:
+                with span("sftp.read_range", path=path, offset=offset, size=length):
+                    with sftp.open(path, "rb") as f:
+                        f.seek(offset)
+                        f.prefetch(offset + length)
+                        return f.read(length)
+
+        return self.__run(read, path)
+
+    def read_files(self, remotes, binary=False):
+        """Read several files (relative to document root) concurrently.
+
+        Returns a dict from each of ``remotes`` to its content, or None if the
+        file does not exist.
+        """
+        remotes = list(remotes)
+        if not remotes:
+            return {}
+
+        batches = [remotes[i :: self.bulk_sessions] for i in range(self.bulk_sessions)]
+
+        def read_batch(batch):
+            contents = {}
+            with self.pool.session("bulk") as sftp:
+                for remote in batch:
+                    path = self.__to_remote_path(remote)
+                    try:
+                        content = self.__read(sftp, path)
+                    except FileNotFoundError:
+                        self.__cache_attrs(path, None)
+                        contents[remote] = None
+                        continue
+                    contents[remote] = content if binary else content.decode()
+            return contents
+
+        def read_batches():
+            contents = {}
+            for batch_contents in self.__map(read_batch, batches):
+                contents.update(batch_contents)
+            return contents
+
+        return self.__run(read_batches, self.root_dir)
 
-        logger.error("File %s already exists, not overwriting it", path)
-        return False
+    def write_file(self, content, remote, overwrite=False):
+        """Create file ``remote`` (relative to document root) with ``content``."""
+        path = self.__to_remote_path(remote)
+
+        if isinstance(content, str):
+            content = content.encode()
+
+        def write():
+            exists = self.__is_file(path)
+            if overwrite or not exists:
+                # existing files are replaced instead of written into, they
+                # might be hard-linked to a file of another document (see
+                # copy_file)
+                target = path + ".tmp" if exists else path
+                try:
+                    with span("sftp.write", path=path, size=len(content)):
+                        self.__upload(
+                            target, len(content), lambda o, n: content[o : o + n]
+                        )
+                    if exists:
+                        self.__replace(target, path)
+                except Exception:
+                    logger.error("Could not open %s for writing", path)
+                    self.invalidate(remote)
+                    raise
+                attrs = self.__make_attrs(S_IFREG | 0o644, len(content))
+                self.__cache_attrs(path, attrs)
+                return True
+
+            logger.error("File %s already exists, not overwriting it", path)
+            return False
+
+        return self.__run(write, path)
+
+    def update_file(self, content, remote):
+        """Overwrite file ``remote``, sending only the blocks that changed.
+
+        The checksums of the blocks of the existing file are computed on the
+        reMarkable by a single command. Small or new files are just written
+        (see :meth:`write_file`).
+        """
+        path = self.__to_remote_path(remote)
+
+        if isinstance(content, str):
+            content = content.encode()
+
+        # a cached size might be outdated, and the update would keep the end
+        # of a file that grew in the meantime
+        self.invalidate(remote)
+        attrs = self.__get_attrs(path)
+        if attrs is None or max(attrs.st_size, len(content)) < self.delta_min_size:
+            return self.write_file(content, remote, overwrite=True)
+        old_size = attrs.st_size
+
+        # changes go into a copy that replaces the file in the end, the file
+        # might be hard-linked to a file of another document (see copy_file)
+        copy = path + ".tmp"
+        block_size = self.__get_block_size(old_size)
+        num_blocks = -(-old_size // block_size)
+        checksums = self.run_command(
+            f'c={shlex.quote(copy)}; cp -f {shlex.quote(path)} "$c" && '
+            f"i=0; while [ $i -lt {num_blocks} ]; do "
+            f'dd if="$c" bs={block_size} skip=$i count=1 2>/dev/null | md5sum; '
+            "i=$((i + 1)); done"
+        )
+        checksums = [line.split()[0] for line in checksums.decode().splitlines()]
+        if len(checksums) != num_blocks:
+            logger.error("Could not get block checksums of %s", path)
+            self.__discard(copy)
+            return self.write_file(content, remote, overwrite=True)
+
+        # ranges of consecutive changed blocks, and everything that was
+        # appended
+        ranges = []
+        for offset in range(0, len(content), block_size):
+            block = offset // block_size
+            if block < num_blocks:
+                checksum = hashlib.md5(content[offset : offset + block_size])
+                if checksum.hexdigest() == checksums[block]:
+                    continue
+            length = min(block_size, len(content) - offset)
+            if ranges and sum(ranges[-1]) == offset:
+                ranges[-1] = (ranges[-1][0], ranges[-1][1] + length)
+            else:
+                ranges.append((offset, length))
+        ranges = [
+            (offset + sub_offset, sub_length)
+            for offset, length in ranges
+            for sub_offset, sub_length in self.__get_ranges(length)
+        ]
+
+        def update():
+            self.__write_ranges(copy, ranges, lambda o, n: content[o : o + n])
+            if len(content) < old_size:
+                with self.pool.session("metadata") as sftp:
+                    sftp.truncate(copy, len(content))
+            self.__replace(copy, path)
+
+        changed = sum(length for _, length in ranges)
+        logger.info("Updating %s: %d of %d bytes changed", path, changed, len(content))
+        try:
+            with span("sftp.update", path=path, size=len(content), changed=changed):
+                self.__run(update, path)
+        except Exception:
+            self.__discard(copy)
+            self.invalidate(remote)
+            raise
+        self.__cache_attrs(path, self.__make_attrs(S_IFREG | 0o644, len(content)))
+        return True
 
     def make_dir(self, remote):
         """Create the directory ``remote``."""
-
         path = self.__to_remote_path(remote)
 
+        def mkdir():
+            with self.pool.session("metadata") as sftp:
+                sftp.mkdir(path)
+
         try:
-            self.sftp.mkdir(path)
-            return True
+            with span("sftp.mkdir", path=path):
+                # if the first attempt went through, the retry fails and we
+                # don't know anymore whether we created it, which is fine here
+                self.__run(mkdir, path)
+        except (ConnectionResetError, OfflineError):
+            raise
         except Exception:
             return False
 
+        self.__cache_attrs(path, self.__make_attrs(S_IFDIR | 0o755, 0))
+        return True
+
     def remove_file(self, remote):
         path = self.__to_remote_path(remote)
-        self.sftp.remove(path)
+
+        def remove():
+            with self.pool.session("metadata") as sftp:
+                sftp.remove(path)
+
+        with span("sftp.remove", path=path):
+            self.__run(remove, path, idempotent=False)
+        self.__cache_attrs(path, None)
 
     def remove_dir(self, remote):
         path = self.__to_remote_path(remote)
-        self.sftp.rmdir(path)
+
+        def rmdir():
+            with self.pool.session("metadata") as sftp:
+                sftp.rmdir(path)
+
+        with span("sftp.rmdir", path=path):
+            self.__run(rmdir, path, idempotent=False)
+        self.__cache_attrs(path, None)
 
     def exists(self, remote):
         """Check if ``remote`` is a file."""
-
         path = self.__to_remote_path(remote)
 
         return self.__is_file(path)
 
+    def stat(self, remote):
+        """Get the (possibly cached) attributes of ``remote``.
+
+        Raises ``FileNotFoundError`` if ``remote`` does not exist.
+        """
+        path = self.__to_remote_path(remote)
+
+        attrs = self.__get_attrs(path)
+        if attrs is None:
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+        return attrs
+
     def list(self, remote):
         """List all entries in ``remote``."""
-
         path = self.__to_remote_path(remote)
-        return list(self.sftp.listdir(path))
+
+        with self.__cache_lock:
+            cached = self.__listings.get(path)
+            if cached is not None and self.__is_fresh(cached[0]):
+                return list(cached[1])
+
+        def listdir():
+            with self.pool.session("metadata") as sftp:
+                return sftp.listdir_attr(path)
+
+        with span("sftp.listdir_attr", path=path):
+            all_attrs = self.__run(listdir, path)
+
+        now = time.monotonic()
+        with self.__cache_lock:
+            for attrs in all_attrs:
+                self.__attrs[posixpath.join(path, attrs.filename)] = (now, attrs)
+            self.__listings[path] = (now, {attrs.filename for attrs in all_attrs})
+
+        return [attrs.filename for attrs in all_attrs]
+
+    def run_command(self, command, input=None, output=None, idempotent=True):
+        """Run a shell command in the document root on the reMarkable.
+
+        ``input`` (bytes, or a binary file to stream from) is sent to the
+        standard input of the command. Returns the standard output, or streams
+        it to the binary file ``output``, if given. Raises ``OSError`` if the
+        command fails.
+        """
+        full_command = f"cd {shlex.quote(self.root_dir)} && {command}"
+
+        def run():
+            stdin, stdout, stderr = self.connection.exec_command(full_command)
+
+            def write_input():
+                if isinstance(input, bytes):
+                    stdin.write(input)
+                elif input is not None:
+                    for chunk in iter(lambda: input.read(self.stream_chunk_size), b""):
+                        stdin.write(chunk)
+                stdin.channel.shutdown_write()
+
+            # write while reading, the command might not consume all of its
+            # input before its output fills the channel window
+            writer = threading.Thread(target=write_input, daemon=True)
+            writer.start()
+            if output is None:
+                result = stdout.read()
+            else:
+                result = None
+                for chunk in iter(lambda: stdout.read(self.stream_chunk_size), b""):
+                    output.write(chunk)
+            writer.join()
+
+            status = stdout.channel.recv_exit_status()
+            if status != 0:
+                error = stderr.read().decode(errors="replace").strip()
+                raise OSError(errno.EIO, f"{command} failed ({status}): {error}")
+            return result
+
+        with span("ssh.exec", command=command):
+            return self.__run(run, self.root_dir, idempotent)
+
+    def list_annotated(self):
+        """Get the UIDs of all entries that have lines (``.rm``) files.
+
+        All entries are checked by a single remote command.
+        """
+        output = self.run_command(
+            'for d in */; do for f in "$d"*.rm; do '
+            '[ -e "$f" ] && echo "${d%/}"; break; done; done'
+        )
+        return set(output.decode().split())
+
+    def hash_files(self, remotes, command="sha256sum"):
+        """Hash files on the reMarkable (with ``sha256sum`` or ``md5sum``).
+
+        All files are hashed by a single remote command. Returns a dict from
+        each of ``remotes`` to its hex digest (or None, if it could not be
+        hashed).
+        """
+        remotes = list(remotes)
+        digests = dict.fromkeys(remotes)
+        if not remotes:
+            return digests
+
+        # files that can't be hashed (e.g., because they were removed in the
+        # meantime) are just missing from the output
+        names = "\n".join(remotes).encode()
+        output = self.run_command(f"xargs {command} || true", input=names)
+        for line in output.decode().splitlines():
+            digest, _, remote = line.partition("  ")
+            if remote in digests:
+                digests[remote] = digest
+
+        return digests
+
+    def remove_all(self, uids):
+        """Remove all files of entries with a single remote command.
+
+        These are ``<uid>`` and ``<uid>.*`` for each UID in ``uids``.
+        """
+        uids = _check_uids(uids)
+        if not uids:
+            return
+
+        self.run_command(
+            'while read -r uid; do rm -rf -- "$uid" "$uid".*; done',
+            input="".join(uid + "\n" for uid in uids).encode(),
+        )
+        # attributes of all kinds of files are outdated now
+        self.invalidate()
+
+    def export_archive(self, output, uids=None):
+        """Stream the document root as a gzip-compressed tar to ``output``.
+
+        ``output`` is a binary file. If ``uids`` are given, only the files of
+        the entries with these UIDs are included.
+        """
+        if uids is None:
+            self.run_command("tar -czf - .", output=output, idempotent=False)
+            return
+
+        uids = _check_uids(uids)
+        self.run_command(
+            'while read -r uid; do ls -d -- "$uid" "$uid".* 2>/dev/null; done'
+            " | tar -czf - -T -",
+            input="".join(uid + "\n" for uid in uids).encode(),
+            output=output,
+            idempotent=False,
+        )
+
+    def import_archive(self, input):
+        """Extract a gzip-compressed tar from ``input`` into the document root."""
+        self.run_command("tar -xzf -", input=input, idempotent=False)
+        # anything might have changed
+        self.invalidate()
+
+    def copy_file(self, source, destination, link=False):
+        """Copy (or hard-link) a file on the reMarkable, without its data."""
+        command = "ln -f" if link else "cp -f"
+        self.run_command(f"{command} {shlex.quote(source)} {shlex.quote(destination)}")
+        self.invalidate(destination)
+
+    def invalidate(self, remote=None):
+        """Drop cached attributes of ``remote`` (or everything, if not given)."""
+        with self.__cache_lock:
+            if remote is None:
+                self.__attrs.clear()
+                self.__listings.clear()
+                return
+
+            path = self.__to_remote_path(remote)
+            self.__attrs.pop(path, None)
+            self.__listings.pop(path, None)
+            self.__listings.pop(posixpath.dirname(path), None)
+
+    def __run(self, operation, path, idempotent=True):
+        """Run ``operation``, re-establishing the connection if it was lost."""
+        generation = self.connection.generation
+        try:
+            return operation()
+        except (FileNotFoundError, PermissionError):
+            raise
+        except Exception:
+            if self.connection.is_alive:
+                raise
+
+        self.connection.reconnect(generation)
+        with self.__cache_lock:
+            if self.__cache_generation != self.connection.generation:
+                # the reMarkable might have changed while we were disconnected
+                self.invalidate()
+                self.__cache_generation = self.connection.generation
+
+        if not idempotent:
+            raise ConnectionResetError(
+                errno.ECONNRESET, "Connection to reMarkable was reset", path
+            )
+        return operation()
+
+    def __download(self, path, size):
+        """Read a whole file, in concurrent ranges if it is large."""
+        if size <= self.small_file_size:
+            with self.pool.session("metadata") as sftp:
+                return self.__read(sftp, path, size)
+
+        ranges = self.__get_ranges(size)
+        if len(ranges) == 1:
+            with self.pool.session("bulk") as sftp:
+                return self.__read(sftp, path, size)
+
+        def read_range(offset_length):
+            offset, length = offset_length
+            with self.pool.session("bulk") as sftp:
+                with span("sftp.read_range", path=path, offset=offset, size=length):
+                    with sftp.open(path, "rb") as f:
+                        f.seek(offset)
+                        f.prefetch(offset + length)
+                        return f.read(length)
+
+        return b"".join(self.__map(read_range, ranges))
+
+    def __upload(self, path, size, read_range):
+        """Write a whole file, in concurrent ranges if it is large.
+
+        ``read_range(offset, length)`` provides the data to write.
+        """
+        lane = "metadata" if size <= self.small_file_size else "bulk"
+        ranges = self.__get_ranges(size)
+
+        # create (or truncate) the file, and write the first range
+        with self.pool.session(lane) as sftp:
+            with sftp.open(path, "w") as f:
+                # don't wait for the server to acknowledge each write
+                f.set_pipelined(True)
+                offset, length = ranges[0]
+                f.write(read_range(offset, length))
+        self.__write_ranges(path, ranges[1:], read_range)
+
+    def __write_ranges(self, path, ranges, read_range):
+        """Write ranges ``(offset, length)`` into an existing file concurrently."""
+        if not ranges:
+            return
+
+        def write_range(offset_length):
+            offset, length = offset_length
+            with self.pool.session("bulk") as sftp:
+                with span("sftp.write_range", path=path, offset=offset, size=length):
+                    with sftp.open(path, "r+") as f:
+                        f.set_pipelined(True)
+                        f.seek(offset)
+                        f.write(read_range(offset, length))
+
+        self.__map(write_range, ranges)
+
+    def __replace(self, source, destination):
+        """Rename ``source`` over ``destination`` (atomically)."""
+        with self.pool.session("metadata") as sftp:
+            with span("sftp.rename", path=destination):
+                sftp.posix_rename(source, destination)
+
+    def __discard(self, path):
+        """Remove a temporary file, if it exists."""
+        try:
+            with self.pool.session("metadata") as sftp:
+                sftp.remove(path)
+        except OSError:
+            pass
+
+    def __map(self, func, items):
+        """Call ``func`` on all items concurrently.
+
+        The shared executor is used, if given.
+        """
+        if self.executor is not None:
+            return list(self.executor.map(func, items))
+        with ThreadPoolExecutor(self.bulk_sessions) as executor:
+            return list(executor.map(func, items))
+
+    def __get_block_size(self, size):
+        """Get the block size for delta updates of a file of ``size`` bytes."""
+        block_size = self.delta_block_size
+        while block_size * self.max_delta_blocks < size:
+            block_size *= 2
+        return block_size
+
+    def __get_ranges(self, size):
+        if size <= self.range_size:
+            return [(0, size)]
+        return [
+            (offset, min(self.range_size, size - offset))
+            for offset in range(0, size, self.range_size)
+        ]
+
+    def __read(self, sftp, path, size=None):
+        with span("sftp.read", path=path, size=size):
+            with sftp.open(path, "rb") as f:
+                # request all chunks of the file at once instead of waiting
+                # for each read to complete
+                f.prefetch(size)
+                return f.read()
 
     def __to_remote_path(self, path):
-        return os.path.join(self.root_dir, path.lstrip("/"))
+        return posixpath.normpath(posixpath.join(self.root_dir, path.lstrip("/")))
 
     def __is_file(self, path):
-        try:
-            p = self.sftp.stat(path)
-        except Exception:
-            return False
-        return S_ISREG(p.st_mode) != 0
+        attrs = self.__get_attrs(path)
+        return attrs is not None and S_ISREG(attrs.st_mode) != 0
 
     def __is_dir(self, path):
+        attrs = self.__get_attrs(path)
+        return attrs is not None and S_ISDIR(attrs.st_mode) != 0
+
+    def __get_attrs(self, path):
+        """Get attributes of ``path``, or None if it does not exist."""
+        with self.__cache_lock:
+            cached = self.__attrs.get(path)
+            if cached is not None and self.__is_fresh(cached[0]):
+                return cached[1]
+
+            # a recent listing of the parent tells us that path doesn't exist
+            listing = self.__listings.get(posixpath.dirname(path))
+            if listing is not None and self.__is_fresh(listing[0]):
+                if posixpath.basename(path) not in listing[1]:
+                    return None
+
+        def stat():
+            with self.pool.session("metadata") as sftp:
+                return sftp.stat(path)
+
         try:
-            p = self.sftp.stat(path)
-        except Exception:
-            return False
-        return S_ISDIR(p.st_mode) != 0
+            with span("sftp.stat", path=path):
+                attrs = self.__run(stat, path)
+        except FileNotFoundError:
+            attrs = None
+
+        self.__cache_attrs(path, attrs)
+        return attrs
+
+    def __cache_attrs(self, path, attrs):
+        now = time.monotonic()
+        with self.__cache_lock:
+            self.__attrs[path] = (now, attrs)
+
+            listing = self.__listings.get(posixpath.dirname(path))
+            if listing is not None:
+                name = posixpath.basename(path)
+                if attrs is None:
+                    listing[1].discard(name)
+                else:
+                    listing[1].add(name)
+
+    def __is_fresh(self, timestamp):
+        return time.monotonic() - timestamp < self.cache_ttl
+
+    def __make_attrs(self, mode, size):
+        attrs = paramiko.SFTPAttributes()
+        attrs.st_mode = mode
+        attrs.st_size = size
+        attrs.st_mtime = int(time.time())
+        return attrs
+
+
+def _check_uids(uids):
+    uids = list(uids)
+    for uid in uids:
+        # never let an empty UID turn into a pattern like ".*"
+        if not uid or "/" in uid or uid.startswith("."):
+            raise ValueError(f"Invalid UID {uid!r}")
+    return uids
@@ -1,13 +1,11 @@
-from .filesystem import SshFileSystem
 import logging
-import netifaces
-import os
-import paramiko
 
 logger = logging.getLogger(__name__)
 
 
 def enumerate_candidates():
+    import netifaces
+
     interfaces = netifaces.interfaces()
 
     for interface in interfaces:
@@ -23,16 +21,16 @@ def enumerate_candidates():
 
 
 def is_remarkable(address):
+    from .connection import SshConnection
+    from .filesystem import SshFileSystem
+
     try:
-        ssh_client = paramiko.SSHClient()
-        ssh_client.load_system_host_keys()
-        ssh_client.load_host_keys(os.path.expanduser("~/.ssh/known_hosts"))
-        ssh_client.connect(address, username="root", look_for_keys=True, timeout=1.0)
+        connection = SshConnection(address, "root", connect_timeout=1.0)
 
-        fs = SshFileSystem(ssh_client, "/")
+        fs = SshFileSystem(connection, "/")
         has_xochitl = fs.exists("/usr/bin/xochitl")
 
-        ssh_client.close()
+        connection.close()
 
         return has_xochitl
 
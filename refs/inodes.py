@@ -0,0 +1,179 @@
+import heapq
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+
+from .constants import ROOT_ID
+from .utils import from_json, to_json
+
+logger = logging.getLogger(__name__)
+
+
+class InodeTable:
+    """A persistent map from entry UIDs to inode numbers.
+
+    Entries keep their inode across mounts. Inodes of removed entries are
+    reused (lowest first, to keep the table dense), and each reuse increments
+    the inode's generation, such that ``(inode, generation)`` never refers to
+    two different entries.
+
+    Inodes can also be allocated without a UID (e.g., for virtual files);
+    those are not persisted and are free again on the next mount.
+
+    All inodes handed out are offset by ``base``, such that several tables
+    can share one inode space (e.g., for several reMarkables in one mount).
+    The stored table does not depend on ``base``.
+    """
+
+    # save changes at most every ``save_interval`` seconds (see maybe_save)
+    save_interval = 30
+
+    def __init__(self, table_file, root_inode=1, base=0):
+        self.table_file = Path(table_file)
+        self.root_inode = root_inode
+        self.base = base
+        self.lock = threading.Lock()
+
+        # map from UIDs to inodes and back
+        self.inodes = {ROOT_ID: root_inode}
+        self.uids = {root_inode: ROOT_ID}
+        # generations of inodes that were reused (all others have 0)
+        self.generations = {}
+        # inodes below next_inode that are not in use (a heap)
+        self.free = []
+        self.next_inode = root_inode + 1
+
+        self.__dirty = False
+        self.__last_save = time.monotonic()
+
+        self.__load()
+
+    def get_inode(self, uid):
+        """Get the inode of the entry with UID ``uid``, assigning one if needed."""
+        with self.lock:
+            inode = self.inodes.get(uid)
+            if inode is None:
+                inode = self.__allocate()
+                self.inodes[uid] = inode
+                self.uids[inode] = uid
+                self.__dirty = True
+            return inode + self.base
+
+    def allocate(self):
+        """Allocate an inode that is not bound to a UID."""
+        with self.lock:
+            return self.__allocate() + self.base
+
+    def get_generation(self, inode):
+        return self.generations.get(inode - self.base, 0)
+
+    def bind(self, uid, inode):
+        """Bind an inode to a (new) UID.
+
+        E.g., after the reMarkable replaced the UID of an entry.
+        """
+        inode -= self.base
+        with self.lock:
+            if self.inodes.get(uid) == inode:
+                return
+            old_uid = self.uids.get(inode)
+            if old_uid is not None:
+                del self.inodes[old_uid]
+            self.inodes[uid] = inode
+            self.uids[inode] = uid
+            self.__dirty = True
+
+    def release(self, inode):
+        """Make an inode available for reuse."""
+        inode -= self.base
+        with self.lock:
+            uid = self.uids.pop(inode, None)
+            if uid is not None:
+                del self.inodes[uid]
+                self.__dirty = True
+            heapq.heappush(self.free, inode)
+
+    def release_uid(self, uid):
+        """Make the inode bound to ``uid`` (if any) available for reuse."""
+        with self.lock:
+            inode = self.inodes.get(uid)
+        if inode is not None and uid != ROOT_ID:
+            self.release(inode + self.base)
+
+    def prune(self, uids, in_use=()):
+        """Release the inodes of all UIDs not in ``uids``.
+
+        These are, e.g., inodes of entries removed while not mounted. Inodes in
+        ``in_use`` are kept.
+        """
+        with self.lock:
+            stale = [
+                inode + self.base
+                for uid, inode in self.inodes.items()
+                if uid != ROOT_ID and uid not in uids
+            ]
+        stale = [inode for inode in stale if inode not in in_use]
+        if stale:
+            logger.info("Releasing %d inodes of removed entries", len(stale))
+        for inode in stale:
+            self.release(inode)
+
+    def maybe_save(self):
+        """Save the table if it changed and was not saved recently."""
+        if self.__dirty and time.monotonic() - self.__last_save > self.save_interval:
+            self.save()
+
+    def save(self):
+        with self.lock:
+            table = {
+                "next_inode": self.next_inode,
+                "inodes": dict(self.inodes),
+                "generations": dict(self.generations),
+            }
+            self.__dirty = False
+            self.__last_save = time.monotonic()
+        self.table_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = self.table_file.with_suffix(".tmp")
+        tmp_file.write_text(to_json(table))
+        os.replace(tmp_file, self.table_file)
+
+    def __allocate(self):
+        if self.free:
+            inode = heapq.heappop(self.free)
+            # the inode was handed out before (maybe in an earlier mount)
+            self.generations[inode] = self.generations.get(inode, 0) + 1
+            return inode
+        inode = self.next_inode
+        self.next_inode += 1
+        return inode
+
+    def __load(self):
+        try:
+            table = from_json(self.table_file.read_text())
+            next_inode = table["next_inode"]
+            inodes = table["inodes"]
+            generations = {int(i): g for i, g in table["generations"].items()}
+        except FileNotFoundError:
+            return
+        except (ValueError, KeyError, AttributeError):
+            logger.error("Inode table %s is corrupt, ignoring", self.table_file)
+            return
+
+        if inodes.get(ROOT_ID) != self.root_inode:
+            logger.error("Inode table %s has no root, ignoring", self.table_file)
+            return
+
+        self.inodes = inodes
+        self.uids = {inode: uid for uid, inode in inodes.items()}
+        self.generations = generations
+        self.next_inode = next_inode
+        # everything not bound to a UID (e.g., inodes of virtual files in the
+        # last mount) is free again
+        self.free = [
+            inode
+            for inode in range(self.root_inode + 1, next_inode)
+            if inode not in self.uids
+        ]
+        heapq.heapify(self.free)
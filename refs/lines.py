@@ -0,0 +1,274 @@
+import logging
+import struct
+import zlib
+from collections import namedtuple
+
+from .constants import (
+    ERASE_AREA_TOOL,
+    ERASER_TOOL,
+    HEIGHT_PX,
+    HIGHLIGHTER_TOOL,
+    TOOL_ID,
+    WIDTH_PX,
+)
+
+logger = logging.getLogger(__name__)
+
+HEADER_V3 = b"reMarkable .lines file, version=3          "
+HEADER_V5 = b"reMarkable .lines file, version=5          "
+HEADER_V6 = b"reMarkable .lines file, version=6          "
+
+# block type of line items in version 6 files
+V6_LINE_ITEM_BLOCK = 0x05
+V6_LINE_ITEM_TYPE = 0x03
+
+# tag types in version 6 files
+V6_TAG_ID = 0xF
+V6_TAG_LENGTH4 = 0xC
+V6_TAG_BYTE8 = 0x8
+V6_TAG_BYTE4 = 0x4
+
+# gray values of the pen colors
+COLORS = {0: 0, 1: 125, 2: 255}
+HIGHLIGHTER_COLOR = 200
+
+# a pen stroke, points are (x, y, width) tuples in page pixels
+Stroke = namedtuple("Stroke", ["tool", "color", "points"])
+
+
+def read_strokes(data):
+    """Read all strokes from the content of a ``.rm`` (lines) file."""
+    header = bytes(data[: len(HEADER_V6)])
+
+    if header == HEADER_V3:
+        return _read_strokes_v3(data, 3)
+    if header == HEADER_V5:
+        return _read_strokes_v3(data, 5)
+    if header == HEADER_V6:
+        return _read_strokes_v6(data)
+
+    raise ValueError(f"Unsupported lines file header {header!r}")
+
+
+def render_png(strokes, scale=1.0):
+    """Render strokes into a grayscale PNG image.
+
+    The image is of size ``WIDTH_PX`` x ``HEIGHT_PX``, multiplied by ``scale``.
+    """
+    width = max(int(WIDTH_PX * scale), 1)
+    height = max(int(HEIGHT_PX * scale), 1)
+    canvas = bytearray(b"\xff") * (width * height)
+
+    # draw highlights below everything else
+    highlights = [s for s in strokes if s.tool == HIGHLIGHTER_TOOL]
+    others = [s for s in strokes if s.tool != HIGHLIGHTER_TOOL]
+
+    for stroke in highlights + others:
+        if stroke.tool == ERASE_AREA_TOOL:
+            continue
+        if stroke.tool == HIGHLIGHTER_TOOL:
+            color = HIGHLIGHTER_COLOR
+        elif stroke.tool == ERASER_TOOL:
+            color = 255
+        else:
+            color = COLORS.get(stroke.color, 0)
+        _draw_stroke(canvas, width, height, stroke.points, scale, color)
+
+    return _encode_png(canvas, width, height)
+
+
+def _read_strokes_v3(data, version):
+    offset = len(HEADER_V3)
+    strokes = []
+
+    (num_layers,) = struct.unpack_from("<i", data, offset)
+    offset += 4
+
+    for _ in range(num_layers):
+        (num_strokes,) = struct.unpack_from("<i", data, offset)
+        offset += 4
+
+        for _ in range(num_strokes):
+            if version == 3:
+                tool, color, _, _, num_points = struct.unpack_from(
+                    "<iiifi", data, offset
+                )
+                offset += 20
+            else:
+                tool, color, _, _, _, num_points = struct.unpack_from(
+                    "<iiifii", data, offset
+                )
+                offset += 24
+
+            points = []
+            for _ in range(num_points):
+                x, y, _, _, width, _ = struct.unpack_from("<ffffff", data, offset)
+                offset += 24
+                points.append((x, y, width))
+
+            strokes.append(Stroke(TOOL_ID.get(tool), color, points))
+
+    return strokes
+
+
+def _read_strokes_v6(data):
+    offset = len(HEADER_V6)
+    strokes = []
+
+    while offset + 8 <= len(data):
+        length, _, _, version, block_type = struct.unpack_from("<IBBBB", data, offset)
+        offset += 8
+        end = offset + length
+
+        if block_type == V6_LINE_ITEM_BLOCK:
+            try:
+                stroke = _read_line_item_v6(_TaggedReader(data, offset), end, version)
+            except (ValueError, struct.error):
+                logger.warning("Skipping unreadable line item at byte %d", offset)
+                stroke = None
+            if stroke is not None:
+                strokes.append(stroke)
+
+        offset = end
+
+    return strokes
+
+
+def _read_line_item_v6(reader, end, version):
+    reader.read_id(1)  # parent
+    reader.read_id(2)  # item
+    reader.read_id(3)  # left
+    reader.read_id(4)  # right
+    reader.read_int(5)  # deleted length
+
+    # deleted items have no value
+    if reader.offset >= end:
+        return None
+
+    reader.read_subblock(6)
+    (item_type,) = reader.unpack("<B")
+    if item_type != V6_LINE_ITEM_TYPE:
+        return None
+
+    tool = reader.read_int(1)
+    color = reader.read_int(2)
+    reader.read_double(3)  # thickness scale
+    reader.read_float(4)  # starting length
+    length = reader.read_subblock(5)
+
+    points = []
+    if version >= 2:
+        # widths are stored in quarter pixels
+        for _ in range(length // 14):
+            x, y, _, width, _, _ = reader.unpack("<ffHHBB")
+            points.append((x + WIDTH_PX / 2, y, width / 4))
+    else:
+        for _ in range(length // 24):
+            x, y, _, _, width, _ = reader.unpack("<ffffff")
+            points.append((x + WIDTH_PX / 2, y, width))
+
+    return Stroke(TOOL_ID.get(tool), color, points)
+
+
+class _TaggedReader:
+    """Reads tagged values from a version 6 lines file."""
+
+    def __init__(self, data, offset):
+        self.data = data
+        self.offset = offset
+
+    def unpack(self, fmt):
+        values = struct.unpack_from(fmt, self.data, self.offset)
+        self.offset += struct.calcsize(fmt)
+        return values
+
+    def read_varuint(self):
+        result = 0
+        shift = 0
+        while True:
+            byte = self.data[self.offset]
+            self.offset += 1
+            result |= (byte & 0x7F) << shift
+            shift += 7
+            if not byte & 0x80:
+                return result
+
+    def read_tag(self, index, tag_type):
+        tag = self.read_varuint()
+        if tag != (index << 4) | tag_type:
+            raise ValueError(f"Expected tag {index}/{tag_type}, got {tag:#x}")
+
+    def read_id(self, index):
+        self.read_tag(index, V6_TAG_ID)
+        (part1,) = self.unpack("<B")
+        return part1, self.read_varuint()
+
+    def read_int(self, index):
+        self.read_tag(index, V6_TAG_BYTE4)
+        return self.unpack("<I")[0]
+
+    def read_float(self, index):
+        self.read_tag(index, V6_TAG_BYTE4)
+        return self.unpack("<f")[0]
+
+    def read_double(self, index):
+        self.read_tag(index, V6_TAG_BYTE8)
+        return self.unpack("<d")[0]
+
+    def read_subblock(self, index):
+        self.read_tag(index, V6_TAG_LENGTH4)
+        return self.unpack("<I")[0]
+
+
+def _draw_stroke(canvas, width, height, points, scale, color):
+    fill = bytes([color]) * width
+
+    def stamp(x, y, size):
+        half = size / 2
+        x0 = max(int(x - half), 0)
+        x1 = min(int(x + half) + 1, width)
+        y0 = max(int(y - half), 0)
+        y1 = min(int(y + half) + 1, height)
+        if x0 >= x1:
+            return
+        for row in range(y0, y1):
+            start = row * width
+            canvas[start + x0 : start + x1] = fill[: x1 - x0]
+
+    previous = None
+    for x, y, point_width in points:
+        x *= scale
+        y *= scale
+        size = max(point_width * scale, 1.0)
+
+        if previous is None:
+            stamp(x, y, size)
+        else:
+            px, py = previous
+            # stamp along the segment, spaced by half the pen width
+            distance = max(abs(x - px), abs(y - py))
+            steps = max(int(distance / max(size / 2, 1.0)), 1)
+            for i in range(1, steps + 1):
+                t = i / steps
+                stamp(px + (x - px) * t, py + (y - py) * t, size)
+
+        previous = (x, y)
+
+
+def _encode_png(pixels, width, height):
+    def chunk(tag, content):
+        crc = zlib.crc32(tag + content) & 0xFFFFFFFF
+        return struct.pack(">I", len(content)) + tag + content + struct.pack(">I", crc)
+
+    # every row starts with its filter type (0, no filter)
+    raw = b"".join(
+        b"\x00" + pixels[row * width : (row + 1) * width] for row in range(height)
+    )
+    header = struct.pack(">IIBBBBB", width, height, 8, 0, 0, 0, 0)
+
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", header)
+        + chunk(b"IDAT", zlib.compress(raw, 6))
+        + chunk(b"IEND", b"")
+    )
@@ -2,25 +2,171 @@ import llfuse
 import logging
 import stat
 import os
+import tempfile
+import threading
+from collections import OrderedDict
 
 logger = logging.getLogger(__name__)
 
 
+class ChunkedBuffer:
+    """A growable, sparse byte buffer.
+
+    The data is held in chunks of up to ``chunk_size`` bytes, such that writes
+    (sequential or out-of-order) only touch the chunks they overlap with,
+    instead of reallocating and copying the whole buffer. Chunks only grow as
+    far as they were written, small files don't take a full chunk. Data that
+    was never written reads as zeros.
+
+    Once the buffer grows beyond ``spill_threshold`` bytes, its content is
+    moved to an anonymous temporary file and all further operations are
+    served from there.
+    """
+
+    chunk_size = 1024**2
+
+    def __init__(self, data=b"", spill_threshold=None):
+        self.spill_threshold = spill_threshold
+        self.size = 0
+        self.chunks = {}
+        self.spill_file = None
+        self.__resident_bytes = 0
+
+        if data:
+            self.write(data, 0)
+
+    @property
+    def resident_bytes(self):
+        """The number of bytes held in memory."""
+        return self.__resident_bytes
+
+    def read(self, offset, length):
+        length = max(min(length, self.size - offset), 0)
+        if length == 0:
+            return b""
+
+        if self.spill_file is not None:
+            return os.pread(self.spill_file.fileno(), length, offset)
+
+        parts = []
+        end = offset + length
+        while offset < end:
+            index, start = divmod(offset, self.chunk_size)
+            part_length = min(self.chunk_size - start, end - offset)
+            part = self.chunks.get(index, b"")[start : start + part_length]
+            if len(part) < part_length:
+                # beyond the written end of the chunk
+                part = bytes(part) + bytes(part_length - len(part))
+            parts.append(part)
+            offset += part_length
+
+        return b"".join(parts)
+
+    def write(self, data, offset):
+        length = len(data)
+        end = offset + length
+
+        if (
+            self.spill_file is None
+            and self.spill_threshold is not None
+            and end > self.spill_threshold
+        ):
+            self.__spill()
+
+        if self.spill_file is not None:
+            os.pwrite(self.spill_file.fileno(), data, offset)
+            self.size = max(self.size, end)
+            return length
+
+        data = memoryview(data)
+        position = 0
+        while position < length:
+            index, start = divmod(offset + position, self.chunk_size)
+            part_length = min(self.chunk_size - start, length - position)
+            part_end = start + part_length
+            chunk = self.chunks.get(index)
+            if chunk is None:
+                chunk = self.chunks[index] = bytearray(part_end)
+                self.__resident_bytes += part_end
+            elif len(chunk) < part_end:
+                self.__resident_bytes += part_end - len(chunk)
+                chunk.extend(bytes(part_end - len(chunk)))
+            chunk[start:part_end] = data[position : position + part_length]
+            position += part_length
+
+        self.size = max(self.size, end)
+        return length
+
+    def truncate(self, length):
+        if self.spill_file is not None:
+            self.spill_file.truncate(length)
+            self.size = length
+            return
+
+        if length < self.size:
+            last_index, last_length = divmod(length, self.chunk_size)
+            for index in [i for i in self.chunks if i > last_index]:
+                self.__resident_bytes -= len(self.chunks.pop(index))
+            # drop the tail of the last chunk, it would be read again if the
+            # buffer grows later
+            chunk = self.chunks.get(last_index)
+            if chunk is not None and len(chunk) > last_length:
+                self.__resident_bytes -= len(chunk) - last_length
+                del chunk[last_length:]
+
+        self.size = length
+
+    def close(self):
+        self.chunks = {}
+        self.size = 0
+        self.__resident_bytes = 0
+        if self.spill_file is not None:
+            self.spill_file.close()
+            self.spill_file = None
+
+    def __spill(self):
+        logger.debug("[ChunkedBuffer::spill] moving %d bytes to disk", self.size)
+        spill_file = tempfile.TemporaryFile(prefix="refs-")
+        for index, chunk in self.chunks.items():
+            offset = index * self.chunk_size
+            length = min(self.chunk_size, self.size - offset)
+            os.pwrite(spill_file.fileno(), chunk[:length], offset)
+        spill_file.truncate(self.size)
+        self.spill_file = spill_file
+        self.chunks = {}
+        self.__resident_bytes = 0
+
+
 class MemFile:
     """An in-memory file-like object.
 
     This is to support reading, writing, and basic file attributes. The file's
-    data is held in memory.
+    data is held in a :class:`ChunkedBuffer`, which moves to a temporary file
+    once it grows beyond ``spill_threshold`` bytes.
+
+    All methods are thread-safe. Callers hold ``lock`` to make several of
+    them atomic (e.g., checking ``loaded`` and loading the data).
     """
 
-    def __init__(self, attrs, data=None):
-        self.data = data if data is not None else bytearray(b"")
+    def __init__(self, attrs, data=None, spill_threshold=None):
+        self.lock = threading.RLock()
+        self.spill_threshold = spill_threshold
+        self.buffer = ChunkedBuffer(data or b"", spill_threshold)
+        self.loaded = data is not None
+        self.version = None
         self._attrs = attrs
         self.modified = False
+        self.open_count = 0
 
     @property
     def size(self):
-        return len(self.data)
+        with self.lock:
+            return self.buffer.size
+
+    @property
+    def resident_bytes(self):
+        # not locked, the budget reads this while holding its own lock
+        return self.buffer.resident_bytes
 
     @property
     def inode(self):
@@ -28,9 +174,11 @@ class MemFile:
 
     @property
     def attrs(self):
-        attrs = self._attrs
-        attrs.st_size = self.size
-        return attrs
+        with self.lock:
+            attrs = self._attrs
+            attrs.st_size = self.size
+            attrs.st_blocks = (self.size + 511) // 512
+            return attrs
 
     def read(self, length=None, offset=0):
         if length is None:
@@ -42,38 +190,48 @@ class MemFile:
             self.size,
         )
 
-        if offset < self.size:
-            if offset + length > self.size:
-                length = self.size - offset
-            data = self.data[offset : offset + length]
-        else:
-            data = bytearray(b"")
+        with self.lock:
+            data = self.buffer.read(offset, length)
 
         logger.debug("[MemFile::read] return %d bytes", len(data))
-        return bytes(data)
+        return data
 
     def write(self, data, offset=0):
         logger.debug("[MemFile::write] %d bytes @ %d", len(data), offset)
 
-        length = len(data)
-        diff = offset + length - self.size
-
-        if diff > 0:
-            # enlarge file
-            pad = bytearray(b" ") * diff
-            self.data += pad
-
-        self.data[offset : offset + length] = data
-        self.modified = True
+        with self.lock:
+            length = self.buffer.write(data, offset)
+            self.modified = True
 
         return length
 
     def truncate(self, length):
-        if length < self.size:
-            self.data = self.data[:length]
-            self.modified = True
+        with self.lock:
+            if length != self.size:
+                self.buffer.truncate(length)
+                self.modified = True
+
+    def load(self, data, version=None):
+        """Replace the data of this file."""
+        with self.lock:
+            self.buffer.close()
+            self.buffer = ChunkedBuffer(data, self.spill_threshold)
+            self.loaded = True
+            self.version = version
+            self.modified = False
+
+    def clear(self):
+        """Drop the data of this file."""
+        with self.lock:
+            self.buffer.close()
+            self.loaded = False
+            self.modified = False
 
     def update_attrs(self, fields, attrs):
+        with self.lock:
+            self.__update_attrs(fields, attrs)
+
+    def __update_attrs(self, fields, attrs):
         if fields.update_atime:
             self._attrs.st_atime_ns = attrs.st_atime_ns
         if fields.update_mtime:
@@ -85,4 +243,59 @@ class MemFile:
         if fields.update_gid:
             self._attrs.st_gid = attrs.st_gid
         if fields.update_size:
-            self._attrs.st_size = attrs.st_size
+            self.truncate(attrs.st_size)
+
+
+class MemoryBudget:
+    """Limits the memory used by the data of loaded :class:`MemFile`s.
+
+    Loaded files are kept in least-recently-used order. Whenever the budget is
+    exceeded, the data of the least recently used files is dropped, skipping
+    files that are currently open or have unsaved modifications.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.files = OrderedDict()
+        self.lock = threading.Lock()
+
+    @property
+    def resident_bytes(self):
+        """The number of bytes currently held by loaded files."""
+        with self.lock:
+            return sum(file.resident_bytes for file in self.files)
+
+    def touch(self, file):
+        """Mark a loaded file as most recently used."""
+        with self.lock:
+            self.files[file] = None
+            self.files.move_to_end(file)
+
+    def discard(self, file):
+        """Stop tracking a file."""
+        with self.lock:
+            self.files.pop(file, None)
+
+    def evict(self):
+        """Drop the data of unused files until the budget is met."""
+        with self.lock:
+            resident = sum(file.resident_bytes for file in self.files)
+            for file in list(self.files):
+                if resident <= self.max_bytes:
+                    break
+                # files locked by others are in use (and locking them here
+                # could deadlock with a thread that touches them)
+                if not file.lock.acquire(blocking=False):
+                    continue
+                try:
+                    if file.open_count > 0 or file.modified:
+                        continue
+                    logger.debug(
+                        "[MemoryBudget::evict] dropping %d bytes",
+                        file.resident_bytes,
+                    )
+                    resident -= file.resident_bytes
+                    file.clear()
+                    del self.files[file]
+                finally:
+                    file.lock.release()
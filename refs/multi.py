@@ -0,0 +1,231 @@
+import errno
+import logging
+import os
+import stat
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import llfuse
+
+from .cache import Caches, default_cache_dir
+from .memfile import MemoryBudget
+from .refs import ReFs
+from .trace import traced
+
+logger = logging.getLogger(__name__)
+
+
+class MultiReFs(llfuse.Operations):
+    """A FUSE filesystem serving several reMarkables, one per subdirectory.
+
+    ``devices`` is a dict from subdirectory names to the addresses of the
+    reMarkables. Each reMarkable is served by its own :class:`ReFs` (with its
+    own connection and inode range), but all of them share one thread pool
+    for transfers, the memory budget, and the on-disk caches of PDFs, pages,
+    and thumbnails. The metadata snapshot, journal, and indexes of each
+    reMarkable are kept in ``<cache_dir>/devices/<name>``.
+
+    All other arguments are passed on to each :class:`ReFs`.
+    """
+
+    # number of inodes reserved for each reMarkable
+    inodes_per_device = 2**40
+
+    def __init__(
+        self,
+        devices,
+        cache_dir=None,
+        memory_budget=512 * 1024**2,
+        transfer_threads=8,
+        **kwargs,
+    ):
+        super().__init__()
+
+        if cache_dir is None:
+            cache_dir = default_cache_dir()
+        cache_dir = Path(cache_dir)
+
+        self.caches = Caches(cache_dir)
+        self.executor = ThreadPoolExecutor(transfer_threads)
+        self.budget = MemoryBudget(memory_budget)
+
+        # map from subdirectory names to ReFs, and from inode ranges (by
+        # index) to ReFs
+        self.devices = {}
+        self.__devices_by_index = {}
+        for index, (name, address) in enumerate(sorted(devices.items()), start=1):
+            logger.info("[MultiReFs::__init__] mounting %s (%s)", name, address)
+            device = ReFs(
+                address,
+                cache_dir=cache_dir / "devices" / name,
+                caches=self.caches,
+                executor=self.executor,
+                budget=self.budget,
+                inode_base=index * self.inodes_per_device,
+                **kwargs,
+            )
+            self.devices[name] = device
+            self.__devices_by_index[index] = device
+
+    @traced
+    def statfs(self, context=None):
+        stat = llfuse.StatvfsData()
+        stat.f_bsize = 512
+        stat.f_frsize = 512
+        for device in self.devices.values():
+            device_stat = device.statfs(context)
+            for field in ["f_blocks", "f_bfree", "f_bavail", "f_files", "f_ffree"]:
+                total = getattr(stat, field) + getattr(device_stat, field)
+                setattr(stat, field, total)
+        stat.f_favail = stat.f_ffree
+        return stat
+
+    @traced
+    def destroy(self):
+        for device in self.devices.values():
+            device.destroy()
+        self.executor.shutdown(wait=False)
+
+    @traced
+    def lookup(self, parent_inode, name, ctx=None):
+        if parent_inode != llfuse.ROOT_INODE:
+            return self.__get_device(parent_inode).lookup(parent_inode, name, ctx)
+        device = self.devices.get(os.fsdecode(name))
+        if device is None:
+            raise llfuse.FUSEError(errno.ENOENT)
+        return device.getattr(device.root_inode, ctx)
+
+    @traced
+    def forget(self, inode_list):
+        by_device = {}
+        for inode, nlookup in inode_list:
+            if inode == llfuse.ROOT_INODE:
+                continue
+            device = self.__get_device(inode)
+            by_device.setdefault(device, []).append((inode, nlookup))
+        for device, device_inode_list in by_device.items():
+            device.forget(device_inode_list)
+
+    def add_lookup(self, inode):
+        if inode != llfuse.ROOT_INODE:
+            self.__get_device(inode).add_lookup(inode)
+
+    def set_invalidate_inode(self, invalidate_inode):
+        for device in self.devices.values():
+            device.set_invalidate_inode(invalidate_inode)
+
+    @traced
+    def getattr(self, inode, context=None):
+        if inode == llfuse.ROOT_INODE:
+            return self.__get_root_attrs()
+        return self.__get_device(inode).getattr(inode, context)
+
+    @traced
+    def setattr(self, inode, attr, fields, fh, ctx):
+        if inode == llfuse.ROOT_INODE:
+            raise llfuse.FUSEError(errno.EACCES)
+        return self.__get_device(inode).setattr(inode, attr, fields, fh, ctx)
+
+    def setxattr(self, inode, name, value, ctx):
+        pass
+
+    def getxattr(self, inode, name, ctx):
+        if inode == llfuse.ROOT_INODE:
+            raise llfuse.FUSEError(llfuse.ENOATTR)
+        return self.__get_device(inode).getxattr(inode, name, ctx)
+
+    def listxattr(self, inode, ctx):
+        if inode == llfuse.ROOT_INODE:
+            return []
+        return self.__get_device(inode).listxattr(inode, ctx)
+
+    @traced
+    def open(self, inode, flags, context):
+        return self.__get_device(inode).open(inode, flags, context)
+
+    @traced
+    def release(self, fh):
+        self.__get_device(fh).release(fh)
+
+    @traced
+    def flush(self, fh):
+        self.__get_device(fh).flush(fh)
+
+    @traced
+    def fsync(self, fh, datasync):
+        self.__get_device(fh).fsync(fh, datasync)
+
+    @traced
+    def opendir(self, inode, context=None):
+        return inode
+
+    @traced
+    def read(self, fh, offset, size):
+        return self.__get_device(fh).read(fh, offset, size)
+
+    @traced
+    def readdir(self, parent_inode, offset):
+        if parent_inode != llfuse.ROOT_INODE:
+            yield from self.__get_device(parent_inode).readdir(parent_inode, offset)
+            return
+
+        devices = sorted(self.devices.items())
+        for i, (name, device) in enumerate(devices[offset:]):
+            attrs = device.getattr(device.root_inode)
+            yield (os.fsencode(name), attrs, offset + i + 1)
+
+    @traced
+    def create(self, parent_inode, name, mode, flags, context=None):
+        if parent_inode == llfuse.ROOT_INODE:
+            raise llfuse.FUSEError(errno.EACCES)
+        device = self.__get_device(parent_inode)
+        return device.create(parent_inode, name, mode, flags, context)
+
+    @traced
+    def mkdir(self, parent_inode, name, mode, ctx):
+        if parent_inode == llfuse.ROOT_INODE:
+            raise llfuse.FUSEError(errno.EACCES)
+        return self.__get_device(parent_inode).mkdir(parent_inode, name, mode, ctx)
+
+    @traced
+    def write(self, fh, offset, data):
+        return self.__get_device(fh).write(fh, offset, data)
+
+    @traced
+    def rename(self, parent_inode_old, name_old, parent_inode_new, name_new, context):
+        if llfuse.ROOT_INODE in (parent_inode_old, parent_inode_new):
+            raise llfuse.FUSEError(errno.EACCES)
+        device = self.__get_device(parent_inode_old)
+        if self.__get_device(parent_inode_new) is not device:
+            # moving between reMarkables is a copy, let the caller do that
+            raise llfuse.FUSEError(errno.EXDEV)
+        device.rename(parent_inode_old, name_old, parent_inode_new, name_new, context)
+
+    @traced
+    def unlink(self, parent_inode, name, context):
+        if parent_inode == llfuse.ROOT_INODE:
+            raise llfuse.FUSEError(errno.EACCES)
+        self.__get_device(parent_inode).unlink(parent_inode, name, context)
+
+    @traced
+    def rmdir(self, parent_inode, name, context):
+        if parent_inode == llfuse.ROOT_INODE:
+            raise llfuse.FUSEError(errno.EACCES)
+        self.__get_device(parent_inode).rmdir(parent_inode, name, context)
+
+    def __get_device(self, inode):
+        """Get the ReFs an inode belongs to."""
+        device = self.__devices_by_index.get(inode // self.inodes_per_device)
+        if device is None:
+            raise llfuse.FUSEError(errno.ENOENT)
+        return device
+
+    def __get_root_attrs(self):
+        attrs = llfuse.EntryAttributes()
+        attrs.st_ino = llfuse.ROOT_INODE
+        attrs.st_mode = stat.S_IFDIR | 0o555
+        attrs.st_nlink = 2 + len(self.devices)
+        attrs.st_uid = os.getuid()
+        attrs.st_gid = os.getgid()
+        attrs.st_blksize = 512
+        return attrs
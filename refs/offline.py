@@ -0,0 +1,395 @@
+import errno
+import logging
+import os
+import posixpath
+import threading
+import time
+import uuid
+from pathlib import Path
+from stat import S_IFDIR, S_IFREG, S_ISREG
+
+import paramiko
+
+from .constants import ROOT_ID, TRASH_ID
+from .utils import from_json, to_json
+
+logger = logging.getLogger(__name__)
+
+
+class OfflineError(OSError):
+    """Raised for operations that need the reMarkable while it is offline."""
+
+    def __init__(self, path):
+        super().__init__(errno.EHOSTDOWN, "reMarkable is offline", path)
+
+
+class MetadataSnapshot:
+    """A persisted copy of the metadata and content of all entries.
+
+    Kept up-to-date while connected (see :meth:`update`), such that the entry
+    tree can be rebuilt without the reMarkable.
+    """
+
+    # save changes at most every ``save_interval`` seconds (see maybe_save)
+    save_interval = 30
+
+    def __init__(self, snapshot_file):
+        self.snapshot_file = Path(snapshot_file)
+        self.lock = threading.Lock()
+
+        # map from UIDs to (metadata, content)
+        self.entries = {}
+
+        self.__dirty = False
+        self.__last_save = time.monotonic()
+
+        try:
+            snapshot = from_json(self.snapshot_file.read_text())
+            self.entries = {
+                uid: (entry["metadata"], entry["content"])
+                for uid, entry in snapshot["entries"].items()
+            }
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError):
+            logger.error(
+                "Metadata snapshot %s is corrupt, ignoring", self.snapshot_file
+            )
+
+    def update(self, entry):
+        """Store the current metadata and content of an entry."""
+        if entry.uid in (ROOT_ID, TRASH_ID):
+            return
+        with self.lock:
+            self.entries[entry.uid] = (entry.metadata, entry.content)
+            self.__dirty = True
+        self.maybe_save()
+
+    def remove(self, uid):
+        """Remove an entry from the snapshot."""
+        with self.lock:
+            self.entries.pop(uid, None)
+            self.__dirty = True
+        self.maybe_save()
+
+    def update_all(self, entries):
+        """Replace the snapshot with the given entries."""
+        with self.lock:
+            self.entries = {
+                entry.uid: (entry.metadata, entry.content)
+                for entry in entries
+                if entry.uid not in (ROOT_ID, TRASH_ID)
+            }
+        self.save()
+
+    def maybe_save(self):
+        """Save the snapshot if it changed and was not saved recently."""
+        if self.__dirty and time.monotonic() - self.__last_save > self.save_interval:
+            self.save()
+
+    def save(self):
+        with self.lock:
+            snapshot = {
+                "entries": {
+                    uid: {"metadata": metadata, "content": content}
+                    for uid, (metadata, content) in self.entries.items()
+                }
+            }
+            self.__dirty = False
+            self.__last_save = time.monotonic()
+            self.snapshot_file.parent.mkdir(parents=True, exist_ok=True)
+            tmp_file = self.snapshot_file.with_suffix(".tmp")
+            tmp_file.write_text(to_json(snapshot))
+            os.replace(tmp_file, self.snapshot_file)
+
+
+class WriteJournal:
+    """A durable, append-only journal of writes made while offline.
+
+    Each record is one line of JSON in ``journal.jsonl``; the data of written
+    files is kept in separate blob files. Records and blobs are synced to
+    disk before a write returns. A record that was only partially written
+    (because of a crash) is ignored.
+    """
+
+    def __init__(self, journal_dir):
+        self.journal_dir = Path(journal_dir)
+        self.journal_file = self.journal_dir / "journal.jsonl"
+        self.blob_dir = self.journal_dir / "blobs"
+        self.lock = threading.Lock()
+
+    @property
+    def records(self):
+        """All complete records, in the order they were written."""
+        try:
+            lines = self.journal_file.read_text().split("\n")
+        except FileNotFoundError:
+            return []
+        # the last line is empty, or a partially written record
+        records = []
+        for line in lines[:-1]:
+            try:
+                records.append(from_json(line))
+            except ValueError:
+                logger.error("Skipping corrupt record in %s", self.journal_file)
+        return records
+
+    def append(self, op, remote, data=None, **kwargs):
+        """Append a record for operation ``op`` on ``remote``."""
+        record = dict(kwargs, op=op, remote=remote)
+        with self.lock:
+            self.blob_dir.mkdir(parents=True, exist_ok=True)
+            if data is not None:
+                record["blob"] = str(uuid.uuid4())
+                self.__write_durably(self.blob_dir / record["blob"], data)
+            with open(self.journal_file, "a") as f:
+                f.write(to_json(record) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+        return record
+
+    def read_blob(self, record):
+        return (self.blob_dir / record["blob"]).read_bytes()
+
+    def get_blob_size(self, record):
+        return (self.blob_dir / record["blob"]).stat().st_size
+
+    def replay(self, fs):
+        """Apply all records to filesystem ``fs`` and clear the journal.
+
+        If a record can not be applied, the journal keeps it and all records
+        after it, and the exception is re-raised.
+        """
+        records = self.records
+        if not records:
+            return False
+
+        logger.info("Replaying %d offline writes...", len(records))
+        for i, record in enumerate(records):
+            try:
+                self.__apply(fs, record)
+            except Exception:
+                logger.error("Could not replay %s %s", record["op"], record["remote"])
+                self.__rewrite(records[i:])
+                raise
+        self.__rewrite([])
+        logger.info("...done.")
+
+        return True
+
+    def __apply(self, fs, record):
+        op = record["op"]
+        remote = record["remote"]
+        if op == "write_file":
+            fs.write_file(self.read_blob(record), remote, record["overwrite"])
+        elif op == "make_dir":
+            fs.make_dir(remote)
+        elif op in ("remove_file", "remove_dir"):
+            try:
+                getattr(fs, op)(remote)
+            except FileNotFoundError:
+                pass
+        else:
+            raise RuntimeError(f"Unknown journal operation {op}")
+
+    def __rewrite(self, records):
+        with self.lock:
+            blobs = {record["blob"] for record in records if "blob" in record}
+            tmp_file = self.journal_file.with_suffix(".tmp")
+            with open(tmp_file, "w") as f:
+                f.write("".join(to_json(record) + "\n" for record in records))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, self.journal_file)
+            for blob in self.blob_dir.glob("*"):
+                if blob.name not in blobs:
+                    blob.unlink()
+
+    def __write_durably(self, path, data):
+        with open(path, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+
+class OfflineFileSystem:
+    """A stand-in for :class:`SshFileSystem` while the reMarkable is offline.
+
+    The ``.metadata`` and ``.content`` files of all entries are served from a
+    :class:`MetadataSnapshot`. Writes are recorded in a :class:`WriteJournal`
+    (to be replayed once the reMarkable is reachable again) and are visible
+    to later reads. Everything else raises :class:`OfflineError`.
+    """
+
+    def __init__(self, snapshot, journal):
+        self.snapshot = snapshot
+        self.journal = journal
+        self.lock = threading.Lock()
+
+        # map from paths written while offline to their journal records
+        self.__written = {}
+        for record in journal.records:
+            self.__record(record)
+
+    def put_file(self, local, remote, overwrite=False):
+        """Copy file ``local`` to ``remote`` (relative to document root)."""
+        with open(local, "rb") as f:
+            return self.write_file(f.read(), remote, overwrite)
+
+    def get_file(self, remote, local, overwrite=False):
+        """Copy file ``remote`` (relative to document root) to ``local``."""
+        if overwrite or not os.path.exists(local):
+            with open(local, "wb") as f:
+                f.write(self.read_file(remote, binary=True))
+            return True
+        return False
+
+    def read_file(self, remote, binary=False):
+        """Read file ``remote`` (relative to document root)."""
+        path = self.__normalize(remote)
+
+        with self.lock:
+            record = self.__written.get(path)
+        if record is not None:
+            if record["op"] != "write_file":
+                raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+            content = self.journal.read_blob(record)
+        else:
+            content = self.__read_snapshot(path).encode()
+
+        return content if binary else content.decode()
+
+    def read_range(self, remote, offset, length):
+        """Read ``length`` bytes at ``offset`` of file ``remote``."""
+        return self.read_file(remote, binary=True)[offset : offset + length]
+
+    def read_files(self, remotes, binary=False):
+        """Read several files (relative to document root)."""
+        contents = {}
+        for remote in remotes:
+            try:
+                contents[remote] = self.read_file(remote, binary)
+            except FileNotFoundError:
+                contents[remote] = None
+        return contents
+
+    def write_file(self, content, remote, overwrite=False):
+        """Record the creation of file ``remote`` with ``content``."""
+        if isinstance(content, str):
+            content = content.encode()
+        record = self.journal.append(
+            "write_file", self.__normalize(remote), content, overwrite=overwrite
+        )
+        self.__record(record)
+        return True
+
+    def update_file(self, content, remote):
+        """Record overwriting file ``remote`` with the given content."""
+        return self.write_file(content, remote, overwrite=True)
+
+    def make_dir(self, remote):
+        """Record the creation of directory ``remote``."""
+        self.__record(self.journal.append("make_dir", self.__normalize(remote)))
+        return True
+
+    def remove_file(self, remote):
+        self.__record(self.journal.append("remove_file", self.__normalize(remote)))
+
+    def remove_dir(self, remote):
+        self.__record(self.journal.append("remove_dir", self.__normalize(remote)))
+
+    def remove_all(self, uids):
+        """Fail, permanent deletion can't be recorded.
+
+        The files to remove are only known to the reMarkable.
+        """
+        raise OfflineError("/")
+
+    def list_annotated(self):
+        """Fail, the lines files are only known to the reMarkable."""
+        raise OfflineError("/")
+
+    def export_archive(self, output, uids=None):
+        """Backups are made on the reMarkable."""
+        raise OfflineError("/")
+
+    def import_archive(self, input):
+        """Backups are restored on the reMarkable."""
+        raise OfflineError("/")
+
+    def exists(self, remote):
+        """Check if ``remote`` is a file."""
+        try:
+            return S_ISREG(self.stat(remote).st_mode)
+        except FileNotFoundError:
+            return False
+
+    def stat(self, remote):
+        """Get the attributes of ``remote``.
+
+        Raises ``FileNotFoundError`` if ``remote`` does not exist.
+        """
+        path = self.__normalize(remote)
+
+        with self.lock:
+            record = self.__written.get(path)
+        if record is not None:
+            if record["op"] == "write_file":
+                size = self.journal.get_blob_size(record)
+                return self.__make_attrs(S_IFREG | 0o644, size)
+            if record["op"] == "make_dir":
+                return self.__make_attrs(S_IFDIR | 0o755, 0)
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+
+        return self.__make_attrs(S_IFREG | 0o644, len(self.__read_snapshot(path)))
+
+    def list(self, remote):
+        """List all entries in ``remote``."""
+        path = self.__normalize(remote)
+        if path != "":
+            raise OfflineError(remote)
+
+        names = set()
+        with self.snapshot.lock:
+            for uid in self.snapshot.entries:
+                names |= {uid + ".metadata", uid + ".content"}
+        with self.lock:
+            for written, record in self.__written.items():
+                if "/" in written:
+                    continue
+                if record["op"] in ("remove_file", "remove_dir"):
+                    names.discard(written)
+                else:
+                    names.add(written)
+        return list(names)
+
+    def invalidate(self, remote=None):
+        """Nothing is cached, nothing to invalidate."""
+        pass
+
+    def __record(self, record):
+        with self.lock:
+            self.__written[record["remote"]] = record
+
+    def __read_snapshot(self, path):
+        uid, ext = os.path.splitext(path)
+        if "/" not in path and ext in (".metadata", ".content"):
+            with self.snapshot.lock:
+                entry = self.snapshot.entries.get(uid)
+            if entry is not None:
+                metadata, content = entry
+                return to_json(metadata if ext == ".metadata" else content)
+        raise OfflineError(path)
+
+    def __normalize(self, remote):
+        path = posixpath.normpath(remote.lstrip("/"))
+        return "" if path == "." else path
+
+    def __make_attrs(self, mode, size):
+        attrs = paramiko.SFTPAttributes()
+        attrs.st_mode = mode
+        attrs.st_size = size
+        # constant, such that entries never appear changed (see
+        # RemarkableStore.refresh)
+        attrs.st_mtime = 0
+        return attrs
@@ -0,0 +1,141 @@
+import logging
+import os
+from pathlib import Path
+
+from .utils import from_json, to_json
+
+logger = logging.getLogger(__name__)
+
+
+def default_config_dir():
+    """Get the directory to store settings in."""
+    config_home = os.environ.get("XDG_CONFIG_HOME", os.path.expanduser("~/.config"))
+    return Path(config_home) / "refs"
+
+
+class TransportProfile:
+    """Tuning parameters for the SSH transport to the reMarkable.
+
+    Args:
+        name: The name of the profile.
+        ciphers: Ciphers to allow, or None for paramiko's defaults.
+        macs: MACs to allow, or None for paramiko's defaults.
+        compress: Whether to compress the SSH stream.
+        window_size: Window size of SFTP channels (in bytes), or None for
+            paramiko's default.
+        max_packet_size: Maximal packet size of SFTP channels (in bytes), or
+            None for paramiko's default.
+    """
+
+    def __init__(
+        self,
+        name,
+        ciphers=None,
+        macs=None,
+        compress=False,
+        window_size=None,
+        max_packet_size=None,
+    ):
+        self.name = name
+        self.ciphers = ciphers
+        self.macs = macs
+        self.compress = compress
+        self.window_size = window_size
+        self.max_packet_size = max_packet_size
+
+    def get_disabled_algorithms(self, security_options):
+        """Get the ``disabled_algorithms`` argument for paramiko.
+
+        Only the preferred ciphers and MACs are left enabled, of the ones in
+        ``security_options`` (see ``paramiko.Transport.get_security_options``).
+        """
+        disabled = {}
+        if self.ciphers is not None:
+            disabled["ciphers"] = [
+                c for c in security_options.ciphers if c not in self.ciphers
+            ]
+        if self.macs is not None:
+            disabled["macs"] = [
+                m for m in security_options.digests if m not in self.macs
+            ]
+        return disabled
+
+    def __repr__(self):
+        return f"PRF: {self.name}"
+
+
+PROFILES = {
+    profile.name: profile
+    for profile in [
+        TransportProfile("default"),
+        # cheap on the tablet's ARM CPU, for fast links (USB)
+        TransportProfile(
+            "usb",
+            ciphers=["aes128-ctr"],
+            macs=["hmac-sha1", "hmac-sha2-256"],
+            window_size=8 * 1024**2,
+            max_packet_size=32 * 1024,
+        ),
+        # larger windows to keep slow links busy despite latency (Wi-Fi)
+        TransportProfile(
+            "wifi",
+            ciphers=["aes128-ctr"],
+            macs=["hmac-sha1", "hmac-sha2-256"],
+            window_size=16 * 1024**2,
+            max_packet_size=32 * 1024,
+        ),
+        # trades tablet CPU for bandwidth, for slow links
+        TransportProfile(
+            "compressed",
+            ciphers=["aes128-ctr"],
+            compress=True,
+            window_size=16 * 1024**2,
+            max_packet_size=32 * 1024,
+        ),
+    ]
+}
+
+
+def get_profile(name=None, config_dir=None):
+    """Get a profile by name.
+
+    If no name is given, the profile stored with :func:`save_profile_name` is
+    returned (or the default profile, if the stored one doesn't exist).
+    """
+    if name is None:
+        name = load_profile_name(config_dir)
+        if name not in PROFILES:
+            logger.error("Stored transport profile %s is unknown, ignoring", name)
+            name = "default"
+    try:
+        return PROFILES[name]
+    except KeyError:
+        raise ValueError(
+            f"Unknown transport profile {name}, choose one of {', '.join(PROFILES)}"
+        )
+
+
+def load_profile_name(config_dir=None):
+    """Get the name of the stored profile, or ``"default"``."""
+    try:
+        return from_json(_get_profile_file(config_dir).read_text())["profile"]
+    except FileNotFoundError:
+        return "default"
+    except (ValueError, KeyError):
+        logger.error("Stored transport profile is corrupt, ignoring")
+        return "default"
+
+
+def save_profile_name(name, config_dir=None):
+    """Store the name of the profile to use by default."""
+    profile_file = _get_profile_file(config_dir)
+    profile_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = profile_file.with_suffix(".tmp")
+    tmp_file.write_text(to_json({"profile": name}))
+    os.replace(tmp_file, profile_file)
+
+
+def _get_profile_file(config_dir):
+    if config_dir is None:
+        config_dir = default_config_dir()
+    return Path(config_dir) / "transport.json"
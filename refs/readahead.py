@@ -0,0 +1,153 @@
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class ReadaheadStats:
+    """Counts how many reads were served from readahead.
+
+    Shared by all :class:`ReadaheadStream`s of a filesystem.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.prefetched_bytes = 0
+
+    @property
+    def hit_rate(self):
+        with self.lock:
+            reads = self.hits + self.misses
+            return self.hits / reads if reads else 0.0
+
+    def count(self, hit):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def count_prefetched(self, size):
+        with self.lock:
+            self.prefetched_bytes += size
+
+
+class ReadaheadStream:
+    """Reads of a single open file from a slow source, with adaptive readahead.
+
+    ``read_range(offset, length)`` reads from the source (e.g., the reMarkable).
+    Reads that continue where the previous one ended are considered sequential:
+    each of them grows the readahead window (from ``min_window`` up to
+    ``max_window`` bytes), and the data after them is fetched in the
+    background in ``executor``. Any other read (e.g., a viewer jumping to a
+    page) resets the window and fetches only the requested range.
+    """
+
+    def __init__(
+        self,
+        read_range,
+        size,
+        executor,
+        stats=None,
+        min_window=128 * 1024,
+        max_window=4 * 1024**2,
+    ):
+        self.read_range = read_range
+        self.size = size
+        self.executor = executor
+        self.stats = stats if stats is not None else ReadaheadStats()
+        self.min_window = min_window
+        self.max_window = max_window
+        self.lock = threading.Lock()
+
+        self.__window = min_window
+        self.__next_offset = 0
+        # contiguous prefetched ranges, as (offset, length, future)
+        self.__ahead = deque()
+
+    def read(self, offset, length):
+        with self.lock:
+            end = min(offset + length, self.size)
+            if offset >= end:
+                return b""
+
+            sequential = offset == self.__next_offset
+            self.__next_offset = end
+            if sequential:
+                self.__window = min(self.__window * 2, self.max_window)
+            else:
+                self.__window = self.min_window
+                self.__drop_ahead(keep_from=None)
+
+            data = self.__read_ahead(offset, end)
+            self.stats.count(hit=data is not None)
+            if data is None:
+                data = self.read_range(offset, end - offset)
+
+            if sequential:
+                self.__prefetch(end)
+            return data
+
+    def close(self):
+        """Cancel all pending readahead."""
+        with self.lock:
+            self.__drop_ahead(keep_from=None)
+
+    def __read_ahead(self, offset, end):
+        """Get ``[offset, end)`` from prefetched ranges.
+
+        What is missing at the end is read. Returns None if ``offset`` was not
+        prefetched.
+        """
+        self.__drop_ahead(keep_from=offset)
+        if not self.__ahead or self.__ahead[0][0] > offset:
+            return None
+
+        chunks = []
+        position = offset
+        for ahead_offset, ahead_length, future in list(self.__ahead):
+            if position >= end:
+                break
+            try:
+                data = future.result()
+            except Exception as e:
+                logger.debug("[ReadaheadStream::read] readahead failed: %s", e)
+                self.__drop_ahead(keep_from=None)
+                break
+            chunks.append(data[position - ahead_offset : end - ahead_offset])
+            position = min(ahead_offset + ahead_length, end)
+
+        if not chunks:
+            return None
+        if position < end:
+            chunks.append(self.read_range(position, end - position))
+        return b"".join(chunks)
+
+    def __prefetch(self, offset):
+        """Make sure a full window after ``offset`` is (being) fetched."""
+        if self.__ahead:
+            last_offset, last_length, _ = self.__ahead[-1]
+            start = last_offset + last_length
+        else:
+            start = offset
+        # fetch the next window once less than half of the current is left
+        if start - offset >= self.__window // 2 or start >= self.size:
+            return
+
+        length = min(self.__window, self.size - start)
+        logger.debug("[ReadaheadStream::prefetch] %d bytes @ %d", length, start)
+        future = self.executor.submit(self.read_range, start, length)
+        self.__ahead.append((start, length, future))
+        self.stats.count_prefetched(length)
+
+    def __drop_ahead(self, keep_from):
+        """Drop prefetched ranges that end before ``keep_from`` (all if None)."""
+        while self.__ahead:
+            ahead_offset, ahead_length, future = self.__ahead[0]
+            if keep_from is not None and ahead_offset + ahead_length > keep_from:
+                break
+            future.cancel()
+            self.__ahead.popleft()
@@ -1,61 +1,315 @@
 import errno
+import functools
+import inspect
 import logging
 import os
 import stat
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import llfuse
 from bidict import bidict
 
 from .client import RemarkableClient
-from .entries import Document, Folder, Pdf
-from .memfile import MemFile
+from .constants import FORMATS
+from .dedup import DuplicateContent
+from .entries import Document, EBook, Entry, Folder, Notebook, Pdf
+from .inodes import InodeTable
+from .memfile import MemFile, MemoryBudget
+from .offline import OfflineError
+from .readahead import ReadaheadStats, ReadaheadStream
+from .search import SearchIndex
+from .trace import traced
+from .views import ViewIndex
+from .virtual import (
+    PagesFolder,
+    RenderedPdfFile,
+    SearchFolder,
+    ThumbnailsFolder,
+    ViewFolder,
+    ViewGroupFolder,
+    VirtualFile,
+    VirtualFolder,
+)
+from .web import UploadNotFound
 
 logger = logging.getLogger(__name__)
 
 
+def report_os_errors(func):
+    """Decorator reporting ``OSError``s to the kernel.
+
+    Errors like a lost connection to the reMarkable would otherwise end the
+    FUSE main loop.
+    """
+
+    def report(e):
+        if e.errno is None:
+            raise e
+        logger.error("[ReFs::%s] %s", func.__name__, e)
+        raise llfuse.FUSEError(e.errno) from e
+
+    if inspect.isgeneratorfunction(func):
+
+        @functools.wraps(func)
+        def generator_wrapper(*args, **kwargs):
+            try:
+                return (yield from func(*args, **kwargs))
+            except OSError as e:
+                report(e)
+
+        return generator_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except OSError as e:
+            report(e)
+
+    return wrapper
+
+
 class ReFs(llfuse.Operations):
-    def __init__(self, remarkable_address, username="root", document_root=None):
+    """A FUSE filesystem exposing the documents of a reMarkable as PDFs.
+
+    The filesystem is usable right after mounting: entries are scanned in the
+    background, and operations on a folder only wait until that folder was
+    scanned.
+
+    Entries keep their inode numbers across mounts (see :class:`InodeTable`).
+    The inode of an entry that was removed from the reMarkable is reused once
+    the kernel forgot it, with an incremented generation.
+
+    The kernel is allowed to keep cached file data across opens (llfuse sets
+    ``keep_cache`` for every open). Cached data of a document is invalidated
+    only if the document changed on the reMarkable since it was loaded.
+    Attributes and directory entries are cached by the kernel for
+    ``attr_timeout`` and ``entry_timeout`` seconds.
+
+    The data of loaded documents is kept in memory up to ``memory_budget``
+    bytes. Beyond that, documents that are not open are dropped in
+    least-recently-used order (and reloaded from the PDF cache when opened
+    again). The current usage can be read from the extended attributes of the
+    mount's root directory. Files larger than ``spill_threshold`` bytes are
+    held in temporary files instead.
+
+    Next to each notebook, a read-only folder ``<name>.pages`` contains one
+    PNG image per page, rendered on demand at ``page_scale`` times the
+    resolution of the reMarkable. Each folder contains a read-only folder
+    ``.thumbnails`` with the thumbnails the reMarkable created for its
+    documents, such that previews don't need to render anything.
+
+    E-books without annotations are shown as their original ``<name>.epub``,
+    read straight from the reMarkable (no rendering, nothing held in memory),
+    with the rendered PDF next to them as a read-only ``<name>.pdf``. While an
+    EPUB is read sequentially, growing ranges after the last read are fetched
+    in the background (see :class:`ReadaheadStream`); the readahead hit rate
+    is one of the extended attributes of the root.
+    ``formats`` sets which of ``pdf`` and ``epub`` are shown for e-books: with
+    only ``epub``, all e-books are shown as EPUB (annotations are left out),
+    with only ``pdf``, as rendered PDFs. Other documents are always PDFs.
+
+    Looking up ``/.search/<terms>`` lists all entries whose name, tags, or
+    extra metadata (and, with ``index_content``, whose text) match the
+    terms, answered from a local search index.
+
+    The read-only folders ``/.recent`` (the ``recent_count`` most recently
+    modified documents), ``/.pinned``, ``/.by-type/<type>``, and
+    ``/.by-tag/<tag>`` show documents from indexes that are kept up-to-date
+    with every change in the store.
+
+    With ``allow_offline``, the filesystem can be mounted while the reMarkable
+    is not reachable. Entries are then read from the last metadata snapshot,
+    only documents with a cached PDF can be opened, and changes are replayed
+    the next time the reMarkable is mounted.
+
+    If the connection to the reMarkable is lost, it is re-established on the
+    next access and the entry tree is revalidated (only entries whose
+    ``.metadata`` changed are re-read). Operations that fail because the
+    reMarkable can't be reached report ``EHOSTDOWN``.
+
+    New PDFs are uploaded through the web interface of the reMarkable (if
+    connected via USB) and appear on the tablet right away. Other changes
+    need a restart of xochitl, which is done once when unmounting. Entries
+    deleted from ``/.trash`` are removed from the reMarkable for good. With
+    ``dedup``, new PDFs that are already on the reMarkable are not transferred
+    again (see :class:`RemarkableClient`).
+
+    To serve several reMarkables in one mount (see :class:`MultiReFs`), each
+    ReFs gets its own range of inodes starting at ``inode_base``, and can
+    share the ``caches``, ``executor``, and memory ``budget`` with the others.
+    """
+
+    def __init__(
+        self,
+        remarkable_address,
+        username="root",
+        document_root=None,
+        attr_timeout=300,
+        entry_timeout=300,
+        memory_budget=512 * 1024**2,
+        spill_threshold=256 * 1024**2,
+        page_scale=1.0,
+        index_content=False,
+        recent_count=50,
+        allow_offline=False,
+        profile=None,
+        dedup="off",
+        cache_dir=None,
+        caches=None,
+        executor=None,
+        budget=None,
+        inode_base=0,
+        formats=FORMATS,
+    ):
         super().__init__()
 
+        if not formats or set(formats) - set(FORMATS):
+            raise ValueError(f"Formats must be some of {', '.join(FORMATS)}")
+
+        self.attr_timeout = attr_timeout
+        self.entry_timeout = entry_timeout
+        if budget is None:
+            budget = MemoryBudget(memory_budget)
+        self.budget = budget
+        self.spill_threshold = spill_threshold
+        self.page_scale = page_scale
+        self.formats = list(formats)
+
+        # readahead of files read from the reMarkable
+        self.__own_executor = executor is None
+        if executor is None:
+            executor = ThreadPoolExecutor(4, thread_name_prefix="readahead")
+        self.executor = executor
+        self.readahead_stats = ReadaheadStats()
+
         logger.info("Connecting to reMarkable...")
         self.client = RemarkableClient(
-            remarkable_address, username=username, document_root=document_root
+            remarkable_address,
+            username=username,
+            document_root=document_root,
+            allow_offline=allow_offline,
+            profile=profile,
+            dedup=dedup,
+            cache_dir=cache_dir,
+            caches=caches,
+            executor=executor,
         )
         self.store = self.client.store
-        logger.info("Connected.")
+        if self.client.offline:
+            logger.info("Offline, serving cached documents only.")
+        else:
+            logger.info("Connected.")
+
+        self.search_index = SearchIndex(self.client.cache_dir / "search.json")
+        self.search_folder = SearchFolder(
+            self.search_index, self.store, self.__get_node_name
+        )
 
-        # map from inodes to entries and back
+        self.view_index = ViewIndex(self.store)
+        self.view_folders = [
+            ViewFolder(
+                ".recent",
+                self.store,
+                lambda: self.view_index.get_recent(recent_count),
+                self.__get_node_name,
+            ),
+            ViewFolder(
+                ".pinned", self.store, self.view_index.get_pinned, self.__get_node_name
+            ),
+            ViewGroupFolder(
+                ".by-type",
+                self.store,
+                self.view_index.get_types,
+                self.view_index.get_by_type,
+                self.__get_node_name,
+            ),
+            ViewGroupFolder(
+                ".by-tag",
+                self.store,
+                self.view_index.get_tags,
+                self.view_index.get_by_tag,
+                self.__get_node_name,
+            ),
+        ]
+
+        if index_content and not self.client.offline:
+            threading.Thread(target=self.__index_content, daemon=True).start()
+
+        # guards the maps below, which are also used by the scan thread (and
+        # by several workers with the pyfuse3 engine, see AsyncReFs)
+        self.lock = threading.RLock()
+        # how to make the kernel drop cached data of an inode, depends on the
+        # FUSE engine (see set_invalidate_inode)
+        self.invalidate_inode = llfuse.invalidate_inode
+
+        # map from inodes to entries and back, for entries with an inode
         self.entries = bidict()
+        # persistent inodes of store entries
+        self.inodes = InodeTable(
+            self.client.cache_dir / "inodes.json", llfuse.ROOT_INODE, inode_base
+        )
+        self.root_inode = inode_base + llfuse.ROOT_INODE
+        # map from inodes to their lookup counts in the kernel
+        self.__lookups = {}
 
-        # map from document entries to in-memory files
+        # map from document entries (and virtual files) to in-memory files
         self.files = {}
 
-        # setup initial maps
-        self.__next_inode = llfuse.ROOT_INODE
-        self.__fs_changed = False
-        self.__init_maps(self.store.root)
+        # map from notebooks to their virtual pages folders
+        self.__pages_folders = {}
+        # map from folders to their virtual thumbnails folders
+        self.__thumbnails_folders = {}
+        # map from e-books shown as EPUB to their virtual rendered PDFs
+        self.__rendered_pdfs = {}
+        # map from file handles to inodes, each open gets its own handle (in
+        # our inode range, see MultiReFs)
+        self.__handles = {}
+        self.__next_handle = inode_base + 1
+        # map from file handles of open EPUBs to their readahead streams
+        self.__streams = {}
 
-        logger.info("ReFs mounted")
+        self.__fs_changed = False
+        # documents created, but not written to the reMarkable yet
+        self.__created = set()
+        # all entries get their inode when they are first looked up
+        self.__get_inode(self.store.root)
+        self.store.add_listener(self.__entry_changed)
 
-    def __init_maps(self, entry):
-        """Recursively get all class:`Entry`s."""
-        inode = self.__next_inode
-        self.__next_inode += 1
+        # entries stream in while we are mounted already
+        self.client.scan(background=True)
+        threading.Thread(target=self.__prune_inodes, daemon=True).start()
 
-        self.entries[inode] = entry
+        logger.info("ReFs mounted")
 
-        if isinstance(entry, Folder):
-            for child in entry.children.values():
-                self.__init_maps(child)
-        else:
-            self.files[entry] = MemFile(attrs=self.__default_file_attrs(inode))
+    def __index_content(self):
+        self.store.wait_until_scanned()
+        self.search_index.index_content(
+            self.client, list(self.store.entries_by_uid.values())
+        )
 
+    def __prune_inodes(self):
+        """Release the inodes of entries removed while we were not mounted."""
+        self.store.wait_until_scanned()
+        if not self.store.scan_succeeded:
+            # entries might be missing from the store, keep their inodes
+            return
+        with self.lock:
+            self.inodes.prune(self.store.entries_by_uid, self.entries)
+
+    @traced
+    @report_os_errors
     def statfs(self, context=None):
         stat = llfuse.StatvfsData()
         stat.f_bsize = 512
         stat.f_frsize = 512
-        size = sum(f.size for f in self.files.values())
+        size = sum(
+            self.__get_size(document)[0]
+            for document in list(self.store.entries_by_uid.values())
+            if isinstance(document, Document)
+        )
         stat.f_blocks = size // stat.f_frsize
         stat.f_bfree = max(size // stat.f_frsize, 1024)
         stat.f_bavail = stat.f_bfree
@@ -65,28 +319,75 @@ class ReFs(llfuse.Operations):
         stat.f_favail = stat.f_ffree
         return stat
 
+    @traced
+    @report_os_errors
     def destroy(self):
         logger.debug("[ReFs::destroy] unmounting...")
 
-        if self.__fs_changed:
+        # all changes not made through the web interface need a single restart
+        if self.__fs_changed or self.__created or self.client.restart_pending:
             logger.debug("[ReFs::destroy] changes made, restarting xochitl...")
             self.client.restart()
 
+        self.inodes.save()
+        self.client.snapshot.save()
+        if self.__own_executor:
+            self.executor.shutdown(wait=False)
+
+    @traced
+    @report_os_errors
     def lookup(self, parent_inode, name, ctx=None):
         """Given parent inode and file name, return attributes."""
+        self.client.revalidate()
         name = os.fsdecode(name)
         entry = self.__get_entry(parent_inode, name)
-        return self.__get_attr(entry)
+        attrs = self.__get_attr(entry)
+        self.add_lookup(attrs.st_ino)
+        self.inodes.maybe_save()
+        self.client.snapshot.maybe_save()
+        return attrs
 
+    @traced
+    def forget(self, inode_list):
+        with self.lock:
+            for inode, nlookup in inode_list:
+                count = self.__lookups.get(inode, 0) - nlookup
+                if count > 0:
+                    self.__lookups[inode] = count
+                    continue
+                self.__lookups.pop(inode, None)
+                entry = self.entries.get(inode)
+                if isinstance(entry, Entry) and self.__is_removed(entry):
+                    self.__release_inode(inode)
+
+    def add_lookup(self, inode):
+        """Count a reference to an inode the kernel got from us.
+
+        For engines where listing a directory counts as a lookup of its
+        entries.
+        """
+        with self.lock:
+            self.__lookups[inode] = self.__lookups.get(inode, 0) + 1
+
+    def set_invalidate_inode(self, invalidate_inode):
+        """Set the function to invalidate cached data of an inode."""
+        self.invalidate_inode = invalidate_inode
+
+    @traced
+    @report_os_errors
     def getattr(self, inode, context=None):
         """Get attributes by inode."""
         entry = self.__get_entry(inode)
         return self.__get_attr(entry)
 
+    @traced
     def setattr(self, inode, attr, fields, fh, ctx):
         entry = self.__get_entry(inode)
         logger.debug("[ReFs::setattr] for %s", entry)
 
+        if isinstance(entry, (VirtualFile, VirtualFolder)):
+            raise llfuse.FUSEError(errno.EACCES)
+
         if isinstance(entry, Folder):
             # do nothing for folders
             return self.__default_dir_attrs(inode)
@@ -100,33 +401,157 @@ class ReFs(llfuse.Operations):
         # okay to do nothing here.
         pass
 
+    def getxattr(self, inode, name, ctx):
+        stats = self.__get_stats(inode)
+        try:
+            return str(stats[os.fsdecode(name)]).encode()
+        except KeyError:
+            raise llfuse.FUSEError(llfuse.ENOATTR)
+
+    def listxattr(self, inode, ctx):
+        return [os.fsencode(name) for name in self.__get_stats(inode)]
+
+    @traced
+    @report_os_errors
     def open(self, inode, flags, context):
         logger.debug("[ReFs::open] %s", inode)
-        document = self.__get_document_entry(inode)
-        self.__load_file(document)
-        return inode
+        self.client.revalidate()
+        document = self.__get_file_entry(inode)
+
+        file = self.__get_file(document)
+        passthrough = self.__shows_epub(document)
+        if isinstance(document, VirtualFile) or passthrough:
+            if flags & (os.O_WRONLY | os.O_RDWR):
+                raise llfuse.FUSEError(errno.EACCES)
 
+        # other handles of the same file wait until it is (re)loaded, instead
+        # of reading it while it is cleared
+        with file.lock:
+            if isinstance(document, VirtualFile):
+                changed = file.loaded and file.version != document.version
+            else:
+                changed = self.store.refresh(document) and not file.modified
+
+            if changed or (passthrough and file.loaded):
+                # changed, or loaded as PDF before and shown as EPUB now
+                logger.debug("[ReFs::open] %s changed, invalidating cache", document)
+                file.clear()
+                self.budget.discard(file)
+                self.invalidate_inode(inode)
+
+            if passthrough:
+                # nothing to load, EPUBs are read from the reMarkable (see read)
+                size = self.client.get_epub_size(document)
+                file.open_count += 1
+                fh = self.__open_handle(inode)
+                self.__streams[fh] = ReadaheadStream(
+                    functools.partial(self.client.read_epub, document),
+                    size,
+                    self.executor,
+                    self.readahead_stats,
+                )
+                return fh
+            file.open_count += 1
+            try:
+                self.__load_file(document)
+            except OfflineError as e:
+                file.open_count -= 1
+                logger.error(
+                    "[ReFs::open] %s is not cached, can't open offline", document
+                )
+                raise llfuse.FUSEError(e.errno)
+            except Exception:
+                file.open_count -= 1
+                raise
+
+        return self.__open_handle(inode)
+
+    @traced
+    @report_os_errors
+    def release(self, fh):
+        with self.lock:
+            inode = self.__handles.pop(fh)
+            stream = self.__streams.pop(fh, None)
+        if stream is not None:
+            stream.close()
+        document = self.__get_file_entry(inode)
+        logger.debug("[ReFs::release] %s", document)
+
+        file = self.files[document]
+        with file.lock:
+            file.open_count -= 1
+            if file.modified:
+                self.__write_back(document)
+        self.budget.evict()
+
+    @traced
+    @report_os_errors
+    def flush(self, fh):
+        # write back on close(), where errors (e.g., a refused duplicate,
+        # see DuplicateContent) still reach the caller, unlike in release
+        document = self.__get_file_entry(self.__get_handle_inode(fh))
+        if not isinstance(document, Document):
+            return
+        file = self.files[document]
+        with file.lock:
+            if file.modified:
+                self.__write_back(document)
+
+    @traced
+    @report_os_errors
+    def fsync(self, fh, datasync):
+        document = self.__get_document_entry(self.__get_handle_inode(fh))
+        file = self.files[document]
+        with file.lock:
+            if file.modified:
+                self.__write_back(document)
+
+    @traced
     def opendir(self, inode, context=None):
         return inode
 
-    def read(self, inode, offset, size):
-        logger.debug("[ReFs::read] %s, %d bytes @ %d", inode, size, offset)
+    @traced
+    @report_os_errors
+    def read(self, fh, offset, size):
+        logger.debug("[ReFs::read] %s, %d bytes @ %d", fh, size, offset)
 
-        document = self.__get_document_entry(inode)
+        document = self.__get_file_entry(self.__get_handle_inode(fh))
         file = self.files[document]
+        if isinstance(document, EBook) and not file.loaded:
+            # shown as EPUB, read from the reMarkable
+            stream = self.__streams.get(fh)
+            if stream is None:
+                return self.client.read_epub(document, offset, size)
+            return stream.read(offset, size)
+        self.budget.touch(file)
 
         return file.read(size, offset)
 
+    @traced
+    @report_os_errors
     def readdir(self, parent_inode, offset):
-        folder = self.__get_folder_entry(parent_inode)
+        if offset == 0:
+            self.client.revalidate()
+        folder = self.__get_folder_entry(parent_inode, virtual=True)
+
+        if isinstance(folder, VirtualFolder):
+            if offset == 0:
+                folder.prefetch()
+            children = sorted(folder.children.items())
+        else:
+            children = [
+                (self.__get_node_name(entry), entry)
+                for entry in sorted(folder.children.values())
+            ]
+            children += sorted(self.__get_virtual_children(folder).items())
 
-        child_entries = sorted(folder.children.values())
-        for i, entry in enumerate(child_entries[offset:]):
-            name = self.__get_node_name(entry)
+        for i, (name, entry) in enumerate(children[offset:]):
             attrs = self.__get_attr(entry)
             result = (os.fsencode(name), attrs, offset + i + 1)
             yield result
 
+    @traced
+    @report_os_errors
     def create(self, parent_inode, name, mode, flags, context=None):
         name = Path(os.fsdecode(name))
         parent = self.__get_folder_entry(parent_inode)
@@ -136,45 +561,51 @@ class ReFs(llfuse.Operations):
 
         name = self.__get_entry_name(name)
         entry = self.store.create(parent, name, Pdf)
-        inode = self.__next_inode
-        file = MemFile(attrs=self.__default_file_attrs(inode))
-        self.__next_inode += 1
+        inode = self.__get_inode(entry)
+        file = MemFile(
+            attrs=self.__default_file_attrs(inode),
+            data=b"",
+            spill_threshold=self.spill_threshold,
+        )
+        file.open_count += 1
 
-        self.entries[inode] = entry
         self.files[entry] = file
-        self.__fs_changed = True
+        self.add_lookup(inode)
+        self.__created.add(entry)
 
         logger.info("[ReFs::create] created empty PDF document %s", entry)
-        return (inode, file.attrs)
+        return (self.__open_handle(inode), file.attrs)
 
+    @traced
+    @report_os_errors
     def mkdir(self, parent_inode, name, mode, ctx):
         name = os.fsdecode(name)
         parent = self.__get_folder_entry(parent_inode)
         logger.debug("[ReFs::mkdir] %s in %s", name, parent)
 
         entry = self.store.create(parent, name, Folder)
-        inode = self.__next_inode
-        self.__next_inode += 1
-
-        self.entries[inode] = entry
+        attrs = self.__get_attr(entry)
+        self.add_lookup(attrs.st_ino)
         self.__fs_changed = True
 
         logger.info("[ReFs::mkdir] created folder %s", entry)
-        return self.__get_attr(entry)
+        return attrs
 
-    def write(self, inode, offset, data):
-        logger.debug("[ReFs::write] %s, %d bytes @ %d", inode, len(data), offset)
+    @traced
+    def write(self, fh, offset, data):
+        logger.debug("[ReFs::write] %s, %d bytes @ %d", fh, len(data), offset)
 
-        document = self.__get_document_entry(inode)
+        document = self.__get_document_entry(self.__get_handle_inode(fh))
         logger.debug("[ReFs::write] this is document %s", document)
         file = self.files[document]
-        self.__fs_changed = True
+        self.budget.touch(file)
         return file.write(data, offset)
 
+    @traced
+    @report_os_errors
     def rename(self, parent_inode_old, name_old, parent_inode_new, name_new, context):
         name_old = os.fsdecode(name_old)
         name_new = os.fsdecode(name_new)
-        entry_name_old = self.__get_entry_name(name_old)
         entry_name_new = self.__get_entry_name(name_new)
         parent_old = self.__get_folder_entry(parent_inode_old)
         parent_new = self.__get_folder_entry(parent_inode_new)
@@ -186,7 +617,13 @@ class ReFs(llfuse.Operations):
             name_new,
             parent_new,
         )
-        entry = parent_old.children[entry_name_old]
+        entry = self.__get_entry(parent_inode_old, name_old)
+        # virtual entries (e.g., the pages of a notebook) can't be moved, and
+        # nothing can be moved onto them
+        if isinstance(entry, (VirtualFile, VirtualFolder)):
+            raise llfuse.FUSEError(errno.EACCES)
+        if name_new in self.__get_virtual_children(parent_new):
+            raise llfuse.FUSEError(errno.EACCES)
 
         # delete target, if it exists
         if entry_name_new in parent_new.children:
@@ -204,14 +641,20 @@ class ReFs(llfuse.Operations):
 
         self.__fs_changed = True
 
+    @traced
+    @report_os_errors
     def unlink(self, parent_inode, name, context):
         name = os.fsdecode(name)
+        # no deletion through virtual folders
+        self.__get_folder_entry(parent_inode)
         document = self.__get_document_entry(parent_inode, name)
         inode = self.entries.inverse[document]
 
         logger.debug("[ReFs::unlink] %s", document)
         self.__delete(document, inode)
 
+    @traced
+    @report_os_errors
     def rmdir(self, parent_inode, name, context):
         name = os.fsdecode(name)
         folder = self.__get_folder_entry(parent_inode, name)
@@ -224,18 +667,135 @@ class ReFs(llfuse.Operations):
         self.__delete(folder, inode)
 
     def __get_attr(self, entry):
-        if isinstance(entry, Document):
-            file = self.files[entry]
+        if isinstance(entry, (Document, VirtualFile)):
+            file = self.__get_file(entry)
             attrs = file.attrs
-            if file.size == 0:
-                # sweet little lie if there is no data yet (this is to allow
-                # subsequent load-on-the-fly and read operations, which
-                # otherwise would be skipped)
-                attrs.st_size = 1024**3
+            if not file.loaded:
+                # no data loaded yet, report the size the file will have (if
+                # the size is only an estimate, the kernel will pick up the
+                # real size after loading, see __load_file)
+                attrs.st_size, _ = self.__get_size(entry)
+                attrs.st_blocks = (attrs.st_size + 511) // 512
             return attrs
         else:
-            inode = self.entries.inverse[entry]
-            return self.__default_dir_attrs(inode)
+            inode = self.__get_inode(entry)
+            attrs = self.__default_dir_attrs(inode)
+            if isinstance(entry, VirtualFolder):
+                attrs.st_mode = stat.S_IFDIR | 0o555
+            return attrs
+
+    def __get_size(self, document):
+        """Get the size of a document's data as a tuple ``(size, exact)``."""
+        file = self.files.get(document)
+        if file is not None and file.loaded:
+            return file.size, True
+        if isinstance(document, VirtualFile):
+            return document.get_size()
+        if self.__shows_epub(document):
+            return self.client.get_epub_size(document), True
+        return self.client.get_pdf_size(document)
+
+    def __get_inode(self, entry):
+        """Get the inode of an entry, assigning a new one if needed."""
+        with self.lock:
+            try:
+                return self.entries.inverse[entry]
+            except KeyError:
+                if isinstance(entry, Entry):
+                    inode = self.inodes.get_inode(entry.uid)
+                else:
+                    # virtual entries get a new inode on every mount
+                    inode = self.inodes.allocate()
+                self.entries[inode] = entry
+                return inode
+
+    def __entry_changed(self, entry):
+        """Keep the inode of an entry bound to its UID.
+
+        The UID can change (see RemarkableStore.adopt). The inode is released
+        once the entry is removed.
+        """
+        with self.lock:
+            inode = self.entries.inverse.get(entry)
+            if inode is None:
+                if self.__is_removed(entry):
+                    # never looked up in this mount, but maybe in an earlier
+                    self.inodes.release_uid(entry.uid)
+                return
+            if not self.__is_removed(entry):
+                self.inodes.bind(entry.uid, inode)
+            elif inode not in self.__lookups:
+                self.__release_inode(inode)
+
+    def __is_removed(self, entry):
+        return self.store.entries_by_uid.get(entry.uid) is not entry
+
+    def __release_inode(self, inode):
+        """Forget the entry of an inode, such that the inode can be reused."""
+        entry = self.entries.pop(inode)
+        logger.debug("[ReFs::__release_inode] releasing inode %d of %s", inode, entry)
+        file = self.files.pop(entry, None)
+        if file is not None:
+            self.budget.discard(file)
+        self.inodes.release(inode)
+
+    def __get_file(self, entry):
+        """Get the in-memory file of a document or virtual file."""
+        with self.lock:
+            try:
+                return self.files[entry]
+            except KeyError:
+                # all files get their in-memory file on first access
+                attrs = self.__default_file_attrs(self.__get_inode(entry))
+                if isinstance(entry, VirtualFile):
+                    attrs.st_mode = stat.S_IFREG | 0o444
+                file = MemFile(attrs=attrs, spill_threshold=self.spill_threshold)
+                self.files[entry] = file
+                return file
+
+    def __get_virtual_children(self, folder):
+        """Get the virtual folders shown next to the entries of a folder."""
+        children = {}
+        for entry in folder.documents.values():
+            # pages are rendered from the lines files on the reMarkable
+            if isinstance(entry, Notebook) and not self.client.offline:
+                if entry not in self.__pages_folders:
+                    self.__pages_folders[entry] = PagesFolder(
+                        self.client, entry, self.page_scale
+                    )
+                pages_folder = self.__pages_folders[entry]
+                children[pages_folder.name] = pages_folder
+            # the rendered PDF of e-books shown as EPUB
+            if "pdf" in self.formats and self.__shows_epub(entry):
+                if entry not in self.__rendered_pdfs:
+                    self.__rendered_pdfs[entry] = RenderedPdfFile(self.client, entry)
+                rendered_pdf = self.__rendered_pdfs[entry]
+                children[rendered_pdf.name] = rendered_pdf
+
+        if folder is self.store.root:
+            children[SearchFolder.name] = self.search_folder
+            for view_folder in self.view_folders:
+                children[view_folder.name] = view_folder
+
+        if folder not in self.__thumbnails_folders:
+            self.__thumbnails_folders[folder] = ThumbnailsFolder(self.client, folder)
+        children[ThumbnailsFolder.name] = self.__thumbnails_folders[folder]
+
+        return children
+
+    def __open_handle(self, inode):
+        """Get a new file handle for an inode."""
+        with self.lock:
+            fh = self.__next_handle
+            self.__next_handle += 1
+            self.__handles[fh] = inode
+            return fh
+
+    def __get_handle_inode(self, fh):
+        try:
+            return self.__handles[fh]
+        except KeyError:
+            raise llfuse.FUSEError(errno.EBADF)
 
     def __get_document_entry(self, inode, name=None):
         document = self.__get_entry(inode, name)
@@ -243,10 +803,21 @@ class ReFs(llfuse.Operations):
             raise llfuse.FUSEError(errno.ENOENT)
         return document
 
-    def __get_folder_entry(self, inode, name=None):
+    def __get_file_entry(self, inode):
+        entry = self.__get_entry(inode)
+        if not isinstance(entry, (Document, VirtualFile)):
+            raise llfuse.FUSEError(errno.ENOENT)
+        return entry
+
+    def __get_folder_entry(self, inode, name=None, virtual=False):
         folder = self.__get_entry(inode, name)
+        if isinstance(folder, VirtualFolder):
+            if virtual:
+                return folder
+            raise llfuse.FUSEError(errno.EACCES)
         if not isinstance(folder, Folder):
             raise llfuse.FUSEError(errno.ENOTDIR)
+        self.store.wait_until_scanned(folder)
         return folder
 
     def __get_entry(self, inode, name=None):
@@ -258,6 +829,22 @@ class ReFs(llfuse.Operations):
 
         if name is None:
             return entry
+
+        # virtual entries have their exact names
+        if isinstance(entry, VirtualFolder):
+            child = entry.lookup(name)
+            if child is None:
+                raise llfuse.FUSEError(errno.ENOENT)
+            return child
+        if not isinstance(entry, Folder):
+            raise llfuse.FUSEError(errno.ENOTDIR)
+        # only wait for the folder we look into, not the whole scan
+        self.store.wait_until_scanned(entry)
+
+        virtual_children = self.__get_virtual_children(entry)
+        if name in virtual_children:
+            return virtual_children[name]
+
         name = self.__get_entry_name(name)
 
         # inode is parent dir
@@ -278,9 +865,23 @@ class ReFs(llfuse.Operations):
         if isinstance(entry, Folder):
             return entry.name
 
-        # everything that is not a folder can be read as a PDF
+        if self.__shows_epub(entry):
+            return entry.name + ".epub"
+
+        # everything else that is not a folder can be read as a PDF
         return entry.name + ".pdf"
 
+    def __shows_epub(self, entry):
+        """Check whether an e-book is shown as its original EPUB."""
+        if (
+            not isinstance(entry, EBook)
+            or "epub" not in self.formats
+            or self.client.offline
+        ):
+            return False
+        # annotations are only in the rendered PDF
+        return "pdf" not in self.formats or self.client.is_plain_ebook(entry)
+
     def __validate_path(self, path):
         """Ensure that a file with this path is allowed to be on our filesystem."""
         if path.suffix != ".pdf":
@@ -294,9 +895,9 @@ class ReFs(llfuse.Operations):
     def __default_file_attrs(self, inode):
         attrs = llfuse.EntryAttributes()
         attrs.st_ino = inode
-        attrs.generation = 0
-        attrs.entry_timeout = 300
-        attrs.attr_timeout = 300
+        attrs.generation = self.inodes.get_generation(inode)
+        attrs.entry_timeout = self.entry_timeout
+        attrs.attr_timeout = self.attr_timeout
         attrs.st_mode = stat.S_IFREG | 0o666  # write by everyone
         attrs.st_nlink = 1
         attrs.st_uid = os.getuid()
@@ -310,18 +911,66 @@ class ReFs(llfuse.Operations):
         attrs.st_mode = stat.S_IFDIR | 0o755
         return attrs
 
+    @traced
     def __load_file(self, document):
-        logger.debug("[ReFs::__load_file] loading PDF data for %s", document)
+        """Load the data of a document, with the lock of its file held."""
+        logger.debug("[ReFs::__load_file] loading data for %s", document)
         file = self.files[document]
         # if not loaded yet
-        if file.size == 0:
-            data = self.client.get_pdf(document)
-            file.data = data
-            inode = self.entries.inverse[document]
-            llfuse.invalidate_inode(inode)
-
+        if not file.loaded:
+            _, exact = self.__get_size(document)
+            if isinstance(document, VirtualFile):
+                file.load(document.get_data(), version=document.version)
+            else:
+                file.load(self.client.get_pdf(document))
+            if not exact:
+                # the kernel still has the estimated size
+                inode = self.entries.inverse[document]
+                self.invalidate_inode(inode)
+        self.budget.touch(file)
+        self.budget.evict()
+
+    def __write_back(self, document):
+        """Store the modified data of a document on the reMarkable.
+
+        Called with the lock of its file held.
+        """
+        logger.info("[ReFs::__write_back] storing PDF data of %s", document)
+        file = self.files[document]
+        try:
+            self.client.put_pdf(file.read(), document=document)
+        except (DuplicateContent, UploadNotFound):
+            # the document was removed, don't try to write it again
+            file.modified = False
+            self.__created.discard(document)
+            raise
+        except NotImplementedError:
+            logger.error("Can not store PDF data of %s", document)
+            raise llfuse.FUSEError(errno.EACCES)
+        file.modified = False
+        self.__created.discard(document)
+
+    def __get_stats(self, inode):
+        """Get statistics exposed as extended attributes of the root."""
+        if inode != self.root_inode:
+            return {}
+        readahead = self.readahead_stats
+        return {
+            "user.refs.resident_bytes": self.budget.resident_bytes,
+            "user.refs.memory_budget": self.budget.max_bytes,
+            "user.refs.readahead_hits": readahead.hits,
+            "user.refs.readahead_misses": readahead.misses,
+            "user.refs.readahead_hit_rate": round(readahead.hit_rate, 3),
+            "user.refs.readahead_bytes": readahead.prefetched_bytes,
+        }
+
+    @traced
     def __delete(self, entry, inode):
-        self.store.delete(entry)
-        # TODO: only remove if permanently deleted, that needs support in store
-        # del self.entries[inode]
+        # deleted entries are moved to the trash and keep their inode, only
+        # entries removed from the store release it (see __entry_changed)
+        if self.store.in_trash(entry):
+            logger.info("[ReFs::__delete] removing %s from trash for good", entry)
+            self.store.remove(entry)
+        else:
+            self.store.delete(entry)
         self.__fs_changed = True
@@ -1,7 +1,18 @@
 import requests
 
+from .constants import WEB_INTERFACE_URL
+from .trace import span
 
-def render_document(document):
-    """Render a document into a PDF."""
-    response = requests.get(f"http://10.11.99.1/download/{document.uid}/pdf")
+
+def render_document(document, session=None):
+    """Render a document into a PDF.
+
+    If given, the request is made through the ``requests.Session``
+    ``session``.
+    """
+    if session is None:
+        session = requests
+    url = f"{WEB_INTERFACE_URL}/download/{document.uid}/pdf"
+    with span("http.get", url=url):
+        response = session.get(url)
     return response.content
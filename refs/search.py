@@ -0,0 +1,266 @@
+import bisect
+import io
+import logging
+import os
+import re
+import threading
+import zipfile
+import zlib
+from pathlib import Path
+
+from .entries import Document, EBook, Pdf
+from .trace import traced
+from .utils import from_json, to_json
+
+logger = logging.getLogger(__name__)
+
+TOKEN_PATTERN = re.compile(r"\w+")
+PDF_STREAM_PATTERN = re.compile(rb"stream\r?\n(.*?)\r?\nendstream", re.S)
+PDF_TEXT_OBJECT_PATTERN = re.compile(rb"BT(.*?)ET", re.S)
+PDF_STRING_PATTERN = re.compile(rb"\(((?:\\.|[^\\()])*)\)", re.S)
+HTML_TAG_PATTERN = re.compile(r"<[^>]+>")
+
+# folders next to documents that contain JSON with recognized or highlighted
+# text
+TEXT_FOLDERS = [".textconversion", ".highlights"]
+
+
+def tokenize(text):
+    """Get the set of lower-case words in ``text``."""
+    return set(TOKEN_PATTERN.findall(text.lower()))
+
+
+class SearchIndex:
+    """An incremental, persistent search index over entries.
+
+    Entries are indexed by their name, tags, and extra metadata, and
+    optionally by the text of their content. Each entry is only re-indexed if
+    its ``lastModified`` changed since it was last indexed. Once
+    :meth:`index_content` was called, the content of changed documents is
+    re-indexed in the background.
+    """
+
+    def __init__(self, index_file):
+        self.index_file = Path(index_file)
+        self.lock = threading.Lock()
+
+        # map from UIDs to the version they were indexed at
+        self.versions = {}
+        # map from UIDs to metadata and content tokens
+        self.metadata_tokens = {}
+        self.content_tokens = {}
+
+        # map from tokens to UIDs, and sorted tokens for prefix search
+        self.postings = {}
+        self.sorted_tokens = []
+        self.__sorted_tokens_valid = False
+
+        # the client to read content with, once content is indexed
+        self.__content_client = None
+
+        self.__load()
+
+    @traced
+    def update(self, entries):
+        """Re-index the metadata of entries that changed."""
+        changed = []
+        with self.lock:
+            for entry in entries:
+                if self.versions.get(entry.uid) == entry.last_modified:
+                    continue
+                self.__remove(entry.uid)
+                self.__set_metadata(entry, entry.last_modified)
+                self.content_tokens.pop(entry.uid, None)
+                self.__add(entry.uid)
+                changed.append(entry)
+            client = self.__content_client
+        if not changed:
+            return
+        self.save()
+
+        if client is not None:
+            # the content of changed documents is outdated now
+            threading.Thread(
+                target=self.index_content, args=(client, changed), daemon=True
+            ).start()
+
+    @traced
+    def index_content(self, client, entries):
+        """Index the content of documents that was not indexed yet.
+
+        Also re-indexes content that changed since it was indexed.
+        """
+        with self.lock:
+            self.__content_client = client
+
+        for entry in entries:
+            if not isinstance(entry, Document):
+                continue
+            version = entry.last_modified
+            with self.lock:
+                indexed = (
+                    entry.uid in self.content_tokens
+                    and self.versions.get(entry.uid) == version
+                )
+            if indexed:
+                continue
+
+            try:
+                text = _get_content_text(client, entry)
+            except Exception as e:
+                logger.error("Could not extract text of %s: %s", entry, e)
+                text = ""
+
+            with self.lock:
+                self.__remove(entry.uid)
+                if self.versions.get(entry.uid) != version:
+                    # not indexed yet (or outdated), update() would drop the
+                    # content again
+                    self.__set_metadata(entry, version)
+                self.content_tokens[entry.uid] = tokenize(text)
+                self.__add(entry.uid)
+
+        self.save()
+
+    def search(self, terms):
+        """Get the UIDs of entries matching all terms (as prefixes)."""
+        with self.lock:
+            if not self.__sorted_tokens_valid:
+                self.sorted_tokens = sorted(self.postings)
+                self.__sorted_tokens_valid = True
+
+            tokens = self.sorted_tokens
+            result = None
+            for term in tokenize(terms):
+                uids = set()
+                i = bisect.bisect_left(tokens, term)
+                while i < len(tokens) and tokens[i].startswith(term):
+                    uids |= self.postings[tokens[i]]
+                    i += 1
+                result = uids if result is None else result & uids
+
+        return result or set()
+
+    def save(self):
+        with self.lock:
+            index = {
+                "versions": self.versions,
+                "metadata": {u: sorted(t) for u, t in self.metadata_tokens.items()},
+                "content": {u: sorted(t) for u, t in self.content_tokens.items()},
+            }
+        self.index_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = self.index_file.with_suffix(".tmp")
+        tmp_file.write_text(to_json(index))
+        os.replace(tmp_file, self.index_file)
+
+    def __load(self):
+        try:
+            index = from_json(self.index_file.read_text())
+        except FileNotFoundError:
+            return
+        except ValueError:
+            logger.error("Search index %s is corrupt, ignoring", self.index_file)
+            return
+
+        self.versions = index["versions"]
+        self.metadata_tokens = {u: set(t) for u, t in index["metadata"].items()}
+        self.content_tokens = {u: set(t) for u, t in index["content"].items()}
+        for uid in self.versions:
+            self.__add(uid)
+
+    def __set_metadata(self, entry, version):
+        self.versions[entry.uid] = version
+        self.metadata_tokens[entry.uid] = tokenize(_get_metadata_text(entry))
+
+    def __add(self, uid):
+        for token in self.metadata_tokens.get(uid, ()):
+            self.postings.setdefault(token, set()).add(uid)
+        for token in self.content_tokens.get(uid, ()):
+            self.postings.setdefault(token, set()).add(uid)
+        self.__sorted_tokens_valid = False
+
+    def __remove(self, uid):
+        tokens = self.metadata_tokens.get(uid, set()) | self.content_tokens.get(
+            uid, set()
+        )
+        for token in tokens:
+            uids = self.postings.get(token)
+            if uids is None:
+                continue
+            uids.discard(uid)
+            if not uids:
+                del self.postings[token]
+        self.__sorted_tokens_valid = False
+
+
+def _get_metadata_text(entry):
+    texts = [entry.name]
+
+    content = entry.content if isinstance(entry.content, dict) else {}
+    for tag in content.get("tags", []):
+        texts.append(tag["name"] if isinstance(tag, dict) else str(tag))
+    for tag in content.get("pageTags", []):
+        texts.append(tag["name"] if isinstance(tag, dict) else str(tag))
+    texts += [str(value) for value in content.get("extraMetadata", {}).values()]
+
+    return " ".join(texts)
+
+
+def _get_content_text(client, document):
+    texts = []
+    fs = client.fs
+
+    if isinstance(document, Pdf):
+        texts.append(extract_pdf_text(fs.read_file(document.uid + ".pdf", True)))
+    elif isinstance(document, EBook):
+        texts.append(extract_epub_text(fs.read_file(document.uid + ".epub", True)))
+
+    for suffix in TEXT_FOLDERS:
+        folder = document.uid + suffix
+        if folder not in fs.list("/"):
+            continue
+        files = [f"{folder}/{f}" for f in fs.list(folder) if f.endswith(".json")]
+        for content in fs.read_files(files).values():
+            if content is not None:
+                texts += _get_json_strings(from_json(content))
+
+    return " ".join(texts)
+
+
+def extract_pdf_text(data):
+    """Extract (roughly) the text shown by a PDF.
+
+    This only considers literal strings in text objects of (possibly
+    compressed) content streams, which is enough for indexing most PDFs.
+    """
+    texts = []
+    for stream in PDF_STREAM_PATTERN.findall(data):
+        try:
+            stream = zlib.decompress(stream)
+        except zlib.error:
+            pass
+        for text_object in PDF_TEXT_OBJECT_PATTERN.findall(stream):
+            strings = PDF_STRING_PATTERN.findall(text_object)
+            texts.append(b"".join(strings).decode("latin-1"))
+    return " ".join(texts)
+
+
+def extract_epub_text(data):
+    """Extract the text of all (X)HTML documents in an EPUB."""
+    texts = []
+    with zipfile.ZipFile(io.BytesIO(data)) as epub:
+        for name in epub.namelist():
+            if name.endswith((".html", ".xhtml", ".htm")):
+                html = epub.read(name).decode("utf-8", errors="replace")
+                texts.append(HTML_TAG_PATTERN.sub(" ", html))
+    return " ".join(texts)
+
+
+def _get_json_strings(data):
+    if isinstance(data, str):
+        return [data]
+    if isinstance(data, dict):
+        data = list(data.values())
+    if isinstance(data, list):
+        return [s for value in data for s in _get_json_strings(value)]
+    return []
@@ -1,33 +1,103 @@
+import functools
 import logging
 import os
+import threading
 import uuid
+from collections import defaultdict, deque
 
 from .constants import (
     ROOT_ID,
     TRASH_ID,
 )
-from .entries import Entry, Folder, Pdf, DuplicateName
+from .entries import Document, Entry, Folder, Pdf, DuplicateName
+from .trace import traced
+from .utils import from_json
 
 logger = logging.getLogger(__name__)
 
 
+def locked(method):
+    """Decorator running a method of the store with its lock held."""
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
 class RemarkableStore:
-    """A store interface to the reMarkable entries (folders and documents)."""
+    """A store interface to the reMarkable entries (folders and documents).
+
+    Callbacks registered with :meth:`add_listener` are called with each entry
+    that was created, changed, moved, or deleted through (or detected by) the
+    store.
+
+    The store starts out with only the root and trash folder. :meth:`scan`
+    reads all entries, folder by folder (starting with the root), such that
+    it can run in the background while the store is used:
+    :meth:`wait_until_scanned` waits only until the children of a single
+    folder are known.
+
+    Changes to the entries (and their folders) are made with ``lock`` held,
+    such that several threads can use the store at the same time.
+    """
 
     def __init__(self, filesystem):
         self.fs = filesystem
-        self.root = None
-        self.trash = None
-        self.entries_by_uid = None
+        self.lock = threading.RLock()
+        self.root = Folder.create_root(self.fs)
+        self.trash = Folder.create_trash(self.fs)
+        self.root.add_folder(self.trash)
+        self.entries_by_uid = {ROOT_ID: self.root, TRASH_ID: self.trash}
         self.open_files = {}
-
-        self.__scan_entries()
+        self.listeners = []
+
+        # map from UIDs to modification times of their .metadata files
+        self.__metadata_mtimes = {}
+
+        # set when the children of a folder (by UID) or all entries are known
+        self.__scanned = {ROOT_ID: threading.Event(), TRASH_ID: threading.Event()}
+        self.scan_complete = threading.Event()
+        # whether the scan completed without errors
+        self.scan_succeeded = False
+
+    def scan(self):
+        """Read all entries from the reMarkable."""
+        try:
+            self.__scan_entries()
+            self.scan_succeeded = True
+        finally:
+            # don't let anybody wait for folders that failed to scan
+            for event in list(self.__scanned.values()):
+                event.set()
+            self.scan_complete.set()
+
+    def wait_until_scanned(self, folder=None, timeout=None):
+        """Wait until the children of ``folder`` (all entries if None) are known.
+
+        Returns ``False`` if the timeout expired.
+        """
+        if folder is None:
+            return self.scan_complete.wait(timeout)
+        event = self.__scanned.get(folder.uid)
+        if event is None:
+            # not found by the scan, but created later
+            return True
+        return event.wait(timeout)
+
+    def add_listener(self, listener):
+        """Call ``listener(entry)`` whenever an entry changes."""
+        self.listeners.append(listener)
 
     def list(self, folder):
         """List the contents of a folder."""
         assert isinstance(folder, Folder)
         yield from folder.children.values()
 
+    @traced
+    @locked
     def create(self, parent_folder, name, cls):
         """Create a new empty entry."""
         if cls not in [Pdf, Folder]:
@@ -41,9 +111,12 @@ class RemarkableStore:
         entry.parent_uid = parent_folder.uid
         parent_folder.add(entry)
         self.entries_by_uid[uid] = entry
+        self.__notify(entry)
 
         return entry
 
+    @traced
+    @locked
     def move(self, entry, folder):
         """Move an entry to another folder."""
         logger.info("Moving %s to %s...", entry, folder)
@@ -59,18 +132,232 @@ class RemarkableStore:
 
         # update entry metadata and store on reMarkable
         entry.parent_uid = folder.uid
+        self.__notify(entry)
 
+    @traced
     def delete(self, entry):
         """Delete an entry by moving it to the trash."""
         self.move(entry, self.trash)
 
+    @traced
+    @locked
     def rename(self, entry, name):
         """Change the name of an entry."""
         parent = self.entries_by_uid[entry.parent_uid]
         parent.remove(entry)
         entry.name = name
         parent.add(entry)
+        self.__notify(entry)
+
+    @traced
+    def remove(self, entry):
+        """Remove an entry from the reMarkable for good.
+
+        For folders, everything in it is removed as well. Nothing is moved to
+        the trash.
+        """
+        self.remove_all([entry])
+
+    @traced
+    @locked
+    def remove_all(self, entries):
+        """Remove several entries (and everything in them) for good.
+
+        The files of all entries are removed at once, see
+        :meth:`SshFileSystem.remove_all`. Returns the removed entries.
+        """
+        removed = {}
+        pending = list(entries)
+        while pending:
+            entry = pending.pop()
+            if entry.uid in removed or entry.uid in (ROOT_ID, TRASH_ID):
+                continue
+            removed[entry.uid] = entry
+            if isinstance(entry, Folder):
+                pending.extend(entry.children.values())
+        if not removed:
+            return []
+
+        logger.info("Removing %d entries...", len(removed))
+        self.fs.remove_all(list(removed))
+
+        for entry in removed.values():
+            parent = self.entries_by_uid.get(entry.parent_uid)
+            if parent is not None and parent.children.get(entry.name) is entry:
+                parent.remove(entry)
+            self.entries_by_uid.pop(entry.uid, None)
+            self.__metadata_mtimes.pop(entry.uid, None)
+        for entry in removed.values():
+            self.__notify(entry)
+
+        return list(removed.values())
+
+    def in_trash(self, entry):
+        """Check whether an entry is deleted, or inside a deleted folder."""
+        seen = set()
+        while entry is not None and entry.uid not in seen:
+            if entry.deleted:
+                return True
+            seen.add(entry.uid)
+            entry = self.entries_by_uid.get(entry.parent_uid)
+        return False
+
+    @traced
+    def purge_trash(self):
+        """Remove all entries in the trash for good.
+
+        Entries marked as deleted are removed as well. Returns the removed
+        entries.
+        """
+        # entries in trashed folders are only known after the full scan
+        self.wait_until_scanned()
+        return self.remove_all(
+            [entry for entry in list(self.entries_by_uid.values()) if entry.deleted]
+        )
+
+    @traced
+    @locked
+    def adopt(self, entry, uid):
+        """Replace an entry by the entry the reMarkable created for it.
+
+        ``uid`` is the UID of the created entry (e.g., from an upload).
+
+        The files of the original entry are removed, and ``entry`` continues
+        as the entry with the new UID.
+        """
+        logger.info("Replacing %s by entry %s", entry, uid)
+
+        parent = self.entries_by_uid.get(entry.parent_uid)
+        if parent is not None:
+            parent.remove(entry)
+
+        del self.entries_by_uid[entry.uid]
+        self.__metadata_mtimes.pop(entry.uid, None)
+        self.fs.remove_all([entry.uid])
+        self.__notify(entry)
+
+        adopted = Entry.create_from_fs(uid, self.fs)
+        entry.uid = uid
+        entry.metadata = adopted.metadata
+        entry.content = adopted.content
+        if isinstance(entry, Document):
+            entry.pages = adopted.pages
+        self.entries_by_uid[uid] = entry
+        self.__metadata_mtimes[uid] = self.fs.stat(uid + ".metadata").st_mtime
+
+        parent = self.entries_by_uid.get(entry.parent_uid)
+        if parent is not None:
+            self.__ensure_unique_name(parent, entry)
+            parent.add(entry)
+        self.__notify(entry)
+
+    @traced
+    def refresh(self, entry):
+        """Re-read an entry, if it was changed on the reMarkable.
+
+        Returns ``True`` if the entry changed.
+        """
+        # the cached attributes might not show a change made just now
+        self.fs.invalidate(entry.uid + ".metadata")
+        return self.__refresh(entry)
+
+    def __refresh(self, entry):
+        """Re-read an entry, if its cached attributes show a change."""
+        try:
+            mtime = self.fs.stat(entry.uid + ".metadata").st_mtime
+        except FileNotFoundError:
+            return False
+
+        if mtime == self.__metadata_mtimes.get(entry.uid):
+            return False
+        self.__metadata_mtimes[entry.uid] = mtime
+
+        try:
+            updated = Entry.create_from_fs(entry.uid, self.fs)
+        except (RuntimeError, KeyError, TypeError, ValueError) as e:
+            # e.g., changed to a type we don't know, keep what we have
+            logger.error("Failed to read entry with UID %s: %s", entry.uid, e)
+            return False
+        if updated.last_modified == entry.last_modified:
+            return False
+
+        logger.info("Entry %s changed on reMarkable", entry)
+
+        with self.lock:
+            parent = self.entries_by_uid.get(entry.parent_uid)
+            if parent is not None:
+                parent.remove(entry)
+
+            entry.metadata = updated.metadata
+            entry.content = updated.content
+            if isinstance(entry, Document):
+                entry.pages = updated.pages
+
+            parent = self.entries_by_uid.get(entry.parent_uid)
+            if parent is not None:
+                self.__ensure_unique_name(parent, entry, write=False)
+                parent.add(entry)
+
+            self.__notify(entry)
+        return True
+
+    @traced
+    @locked
+    def revalidate(self):
+        """Pick up entries that were created, changed, or removed.
+
+        Unchanged entries are not re-read.
+
+        Only the document root is listed; the modification times of the
+        ``.metadata`` files come with the listing.
+        """
+        logger.info("Revalidating documents...")
+        all_files = self.fs.list("/")
+        uids = {
+            basename
+            for basename, ext in map(os.path.splitext, all_files)
+            if ext == ".metadata"
+        }
+        known_uids = set(self.entries_by_uid) - {ROOT_ID, TRASH_ID}
+
+        for uid in known_uids - uids:
+            entry = self.entries_by_uid.pop(uid)
+            self.__metadata_mtimes.pop(uid, None)
+            logger.info("Entry %s was removed on reMarkable", entry)
+            parent = self.entries_by_uid.get(entry.parent_uid)
+            if parent is not None and parent.children.get(entry.name) is entry:
+                parent.remove(entry)
+            self.__notify(entry)
+
+        # the listing just cached the attributes of all .metadata files
+        for uid in known_uids & uids:
+            self.__refresh(self.entries_by_uid[uid])
+
+        # add new entries only after all of them are known, they might be
+        # each other's parents
+        new_entries = []
+        for uid in uids - known_uids:
+            try:
+                new_entries.append(Entry.create_from_fs(uid, self.fs))
+            except (RuntimeError, KeyError, TypeError, ValueError) as e:
+                # e.g., of a type we don't know, like in the scan
+                logger.error("Failed to read entry with UID %s: %s", uid, e)
+        for entry in new_entries:
+            self.entries_by_uid[entry.uid] = entry
+            self.__metadata_mtimes[entry.uid] = self.fs.stat(
+                entry.uid + ".metadata"
+            ).st_mtime
+        for entry in new_entries:
+            logger.info("Entry %s was created on reMarkable", entry)
+            parent = self.entries_by_uid.get(entry.parent_uid)
+            if parent is not None:
+                self.__ensure_unique_name(parent, entry, write=False)
+                parent.add(entry)
+            self.__notify(entry)
 
+        logger.info("...done.")
+
+    @traced
     def __scan_entries(self):
         logger.info("Scanning documents...")
         all_files = self.fs.list("/")
@@ -81,46 +368,68 @@ class RemarkableStore:
             if ext == ".metadata"
         ]
 
-        entries_by_uid = {uid: Entry.create_from_fs(uid, self.fs) for uid in uids}
-
-        root = Folder.create_root(self.fs)
-        trash = Folder.create_trash(self.fs)
-
-        # link entries to their parents
-        for uid, entry in entries_by_uid.items():
-            parent_uid = entry.parent_uid
-
-            if parent_uid == ROOT_ID:
-                parent = root
-            elif parent_uid == TRASH_ID:
-                logger.info("Entry %s found in trash", entry)
-                parent = trash
-            else:
-                try:
-                    parent = entries_by_uid[parent_uid]
-                except KeyError:
-                    logger.error(
-                        "Parent %s of entry %s does not exist (or is deleted)",
-                        parent_uid,
-                        entry,
-                    )
-                    continue
-
-            self.__ensure_unique_name(parent, entry)
-            parent.add(entry)
-
-        # remember the root and trash folder as well
-        entries_by_uid[ROOT_ID] = root
-        entries_by_uid[TRASH_ID] = trash
-
-        root.add_folder(trash)
-
-        self.root = root
-        self.trash = trash
-        self.entries_by_uid = entries_by_uid
+        # read all metadata at once, to know the parent of each entry
+        metadata_files = self.fs.read_files([uid + ".metadata" for uid in uids])
+        metadata = {}
+        children_uids = defaultdict(list)
+        for uid in uids:
+            try:
+                metadata[uid] = from_json(metadata_files[uid + ".metadata"])
+            except Exception:
+                logger.error("Failed to read metadata JSON for entry with UID %s", uid)
+                continue
+            self.__metadata_mtimes[uid] = self.fs.stat(uid + ".metadata").st_mtime
+            children_uids[metadata[uid].get("parent")].append(uid)
+
+        # add entries folder by folder, starting at the root
+        folders = deque([self.root, self.trash])
+        while folders:
+            folder = folders.popleft()
+            child_uids = children_uids.pop(folder.uid, [])
+            entries = self.__create_entries(child_uids, metadata)
+            with self.lock:
+                for entry in entries:
+                    if folder is self.trash:
+                        logger.info("Entry %s found in trash", entry)
+                    if isinstance(entry, Folder):
+                        self.__scanned[entry.uid] = threading.Event()
+                        folders.append(entry)
+                    self.__ensure_unique_name(folder, entry)
+                    folder.add(entry)
+                    self.__notify(entry)
+            self.__scanned[folder.uid].set()
+
+        # entries not reachable from the root are known, but not shown
+        for parent_uid, orphan_uids in children_uids.items():
+            for entry in self.__create_entries(orphan_uids, metadata):
+                logger.error(
+                    "Parent %s of entry %s does not exist (or is deleted)",
+                    parent_uid,
+                    entry,
+                )
 
         logger.info("...done.")
 
+    def __create_entries(self, uids, metadata):
+        """Create entries from their metadata, reading their content."""
+        content_files = self.fs.read_files([uid + ".content" for uid in uids])
+        entries = []
+        for uid in uids:
+            try:
+                content = content_files[uid + ".content"]
+                content = "" if content is None else from_json(content)
+                entry = Entry.create(uid, self.fs, metadata[uid], content)
+            except Exception as e:
+                logger.error("Failed to read entry with UID %s: %s", uid, e)
+                continue
+            self.entries_by_uid[uid] = entry
+            entries.append(entry)
+        return entries
+
+    def __notify(self, entry):
+        for listener in self.listeners:
+            listener(entry)
+
     def __create_new_uid(self):
         uid = str(uuid.uuid4())
         while uid in self.entries_by_uid:
@@ -128,12 +437,20 @@ class RemarkableStore:
 
         return uid
 
-    def __ensure_unique_name(self, folder, entry):
+    def __ensure_unique_name(self, folder, entry, write=True):
+        """Make the name of ``entry`` unique in ``folder``.
+
+        Without ``write``, the entry is only renamed here, not on the
+        reMarkable.
+        """
         while entry.name in folder.children:
             logger.debug("%s already in %s, changing name...", entry, folder)
             # crude strategy to resolve duplicate names (which we don't allow
             # to make things easier, but the reMarkable is fine with)
-            entry.name += "_"
+            if write:
+                entry.name += "_"
+            else:
+                entry.metadata["visibleName"] += "_"
 
     def __repr__(self):
         return self.__rec_repr(self.root)
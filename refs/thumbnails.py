@@ -0,0 +1,64 @@
+import hashlib
+import logging
+import os
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# freedesktop.org thumbnail sizes
+THUMBNAIL_SIZES = {"normal": 128, "large": 256}
+
+
+def populate_thumbnail_cache(mount_dir, thumbnail_dir=None):
+    """Store the thumbnails of the documents in a mounted ReFs.
+
+    They are stored in the freedesktop.org thumbnail cache.
+
+    The thumbnails are read from the ``.thumbnails`` folders of the mount,
+    such that file managers don't have to open (and render) every document to
+    show previews. Requires Pillow to convert the thumbnails to PNG.
+    """
+    try:
+        from PIL import Image, PngImagePlugin
+    except ImportError:
+        logger.error("Populating the thumbnail cache requires Pillow")
+        return
+
+    if thumbnail_dir is None:
+        cache_home = os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
+        thumbnail_dir = Path(cache_home) / "thumbnails"
+
+    logger.info("Populating thumbnail cache in %s...", thumbnail_dir)
+    count = 0
+
+    for dirpath, dirnames, filenames in os.walk(mount_dir):
+        # don't descend into virtual folders or the trash
+        dirnames[:] = [
+            d for d in dirnames if not d.startswith(".") and not d.endswith(".pages")
+        ]
+
+        for filename in filenames:
+            path = Path(dirpath) / filename
+            thumbnail = Path(dirpath) / ".thumbnails" / (path.stem + ".jpg")
+            if not thumbnail.exists():
+                continue
+
+            uri = path.absolute().as_uri()
+            info = PngImagePlugin.PngInfo()
+            info.add_text("Thumb::URI", uri)
+            info.add_text("Thumb::MTime", str(int(path.stat().st_mtime)))
+            name = hashlib.md5(uri.encode()).hexdigest() + ".png"
+
+            with Image.open(thumbnail) as image:
+                for size_name, size in THUMBNAIL_SIZES.items():
+                    target = Path(thumbnail_dir) / size_name / name
+                    target.parent.mkdir(parents=True, exist_ok=True)
+                    resized = image.copy()
+                    resized.thumbnail((size, size))
+                    tmp_target = target.with_suffix(".tmp")
+                    resized.save(tmp_target, "PNG", pnginfo=info)
+                    os.replace(tmp_target, target)
+
+            count += 1
+
+    logger.info("...stored %d thumbnails.", count)
@@ -0,0 +1,140 @@
+import functools
+import inspect
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager, nullcontext
+
+logger = logging.getLogger(__name__)
+
+
+class Tracer:
+    """Records nested, timed spans per thread.
+
+    Spans are stored as Chrome trace events ("complete" events with a start
+    and a duration), which can be opened in ``chrome://tracing`` or
+    https://ui.perfetto.dev. Nesting is implied by the timestamps of spans on
+    the same thread.
+
+    Only the last ``max_events`` spans are kept, such that long traced runs
+    don't use up all memory.
+    """
+
+    def __init__(self, max_events=1_000_000):
+        self.pid = os.getpid()
+        self.start_ns = time.perf_counter_ns()
+        self.events = deque(maxlen=max_events)
+        self.dropped = 0
+        self.thread_names = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name, **args):
+        start = time.perf_counter_ns()
+        try:
+            yield
+        except BaseException as e:
+            args["error"] = repr(e)
+            raise
+        finally:
+            self.record(name, start, time.perf_counter_ns(), args)
+
+    def record(self, name, start_ns, end_ns, args=None):
+        thread = threading.current_thread()
+        event = {
+            "name": name,
+            "cat": name.split(".")[0],
+            "ph": "X",
+            "ts": (start_ns - self.start_ns) / 1000,
+            "dur": (end_ns - start_ns) / 1000,
+            "pid": self.pid,
+            "tid": thread.ident,
+        }
+        if args:
+            event["args"] = args
+
+        with self.lock:
+            if len(self.events) == self.events.maxlen:
+                self.dropped += 1
+            self.events.append(event)
+            self.thread_names.setdefault(thread.ident, thread.name)
+
+    def save(self, filename):
+        """Write all recorded spans as Chrome trace-event JSON."""
+        with self.lock:
+            events = [
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": self.pid,
+                    "tid": tid,
+                    "args": {"name": name},
+                }
+                for tid, name in self.thread_names.items()
+            ]
+            events += self.events
+            dropped = self.dropped
+
+        with open(filename, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f, default=str)
+
+        logger.info("Wrote %d trace events to %s", len(events), filename)
+        if dropped:
+            logger.warning("Dropped the %d oldest trace events", dropped)
+
+
+_tracer = None
+
+
+def start_tracing(max_events=1_000_000):
+    """Start recording (up to the last ``max_events``) spans of all calls."""
+    global _tracer
+    _tracer = Tracer(max_events)
+
+
+def stop_tracing(filename):
+    """Stop recording spans and write them to ``filename``."""
+    global _tracer
+    tracer, _tracer = _tracer, None
+    if tracer is not None:
+        tracer.save(filename)
+
+
+def span(name, **args):
+    """Context manager recording a span, if tracing is enabled."""
+    if _tracer is None:
+        return nullcontext()
+    return _tracer.span(name, **args)
+
+
+def traced(func):
+    """Decorator recording a span for each call of ``func``.
+
+    The span is named after the qualified name of ``func``. Tracing is checked
+    at call time, so this is cheap when tracing is disabled. For generator
+    functions, the span covers the whole iteration.
+    """
+    name = func.__qualname__
+
+    if inspect.isgeneratorfunction(func):
+
+        @functools.wraps(func)
+        def generator_wrapper(*args, **kwargs):
+            if _tracer is None:
+                return (yield from func(*args, **kwargs))
+            with _tracer.span(name):
+                return (yield from func(*args, **kwargs))
+
+        return generator_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if _tracer is None:
+            return func(*args, **kwargs)
+        with _tracer.span(name):
+            return func(*args, **kwargs)
+
+    return wrapper
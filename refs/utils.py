@@ -7,3 +7,11 @@ def to_json(data):
 
 def from_json(data):
     return json.loads(data)
+
+
+def get_timestamp(entry):
+    """Get the ``lastModified`` time of an entry (in ms), or 0 if unknown."""
+    try:
+        return float(entry.last_modified)
+    except (TypeError, ValueError):
+        return 0.0
@@ -0,0 +1,117 @@
+import bisect
+import logging
+import threading
+
+from .entries import Document, EBook, Notebook, Pdf
+from .utils import get_timestamp
+
+logger = logging.getLogger(__name__)
+
+TYPE_NAMES = {Notebook: "notebook", Pdf: "pdf", EBook: "epub"}
+
+
+class ViewIndex:
+    """Secondary indexes over documents, for precomputed views.
+
+    Maintains the documents ordered by ``lastModified``, the pinned documents,
+    and the documents by type and by tag. The indexes are updated for single
+    entries whenever the store reports a change.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.lock = threading.Lock()
+
+        # (negated lastModified, UID) of all documents, most recent first
+        self.by_recency = []
+        self.pinned = set()
+        self.by_type = {}
+        self.by_tag = {}
+
+        # map from UIDs to their keys in the indexes above
+        self.__keys = {}
+
+        for entry in list(store.entries_by_uid.values()):
+            self.update(entry)
+        store.add_listener(self.update)
+
+    def update(self, entry):
+        """Update the indexes for a single entry."""
+        with self.lock:
+            self.__remove(entry.uid)
+
+            if not isinstance(entry, Document) or entry.deleted:
+                return
+            if self.store.entries_by_uid.get(entry.uid) is not entry:
+                return
+
+            recency = (-get_timestamp(entry), entry.uid)
+            pinned = entry.metadata.get("pinned", False)
+            type_name = TYPE_NAMES.get(type(entry))
+            tags = _get_tags(entry)
+
+            bisect.insort(self.by_recency, recency)
+            if pinned:
+                self.pinned.add(entry.uid)
+            if type_name is not None:
+                self.by_type.setdefault(type_name, set()).add(entry.uid)
+            for tag in tags:
+                self.by_tag.setdefault(tag, set()).add(entry.uid)
+
+            self.__keys[entry.uid] = (recency, pinned, type_name, tags)
+
+    def get_recent(self, count):
+        with self.lock:
+            return [uid for _, uid in self.by_recency[:count]]
+
+    def get_pinned(self):
+        with self.lock:
+            return set(self.pinned)
+
+    def get_types(self):
+        with self.lock:
+            return sorted(self.by_type)
+
+    def get_by_type(self, type_name):
+        with self.lock:
+            return set(self.by_type.get(type_name, ()))
+
+    def get_tags(self):
+        with self.lock:
+            return sorted(self.by_tag)
+
+    def get_by_tag(self, tag):
+        with self.lock:
+            return set(self.by_tag.get(tag, ()))
+
+    def __remove(self, uid):
+        keys = self.__keys.pop(uid, None)
+        if keys is None:
+            return
+        recency, _, type_name, tags = keys
+
+        i = bisect.bisect_left(self.by_recency, recency)
+        if i < len(self.by_recency) and self.by_recency[i] == recency:
+            del self.by_recency[i]
+        self.pinned.discard(uid)
+        if type_name is not None:
+            _discard(self.by_type, type_name, uid)
+        for tag in tags:
+            _discard(self.by_tag, tag, uid)
+
+
+def _get_tags(entry):
+    content = entry.content if isinstance(entry.content, dict) else {}
+    tags = content.get("tags", [])
+    return tuple(
+        sorted({tag["name"] if isinstance(tag, dict) else str(tag) for tag in tags})
+    )
+
+
+def _discard(index, key, uid):
+    uids = index.get(key)
+    if uids is None:
+        return
+    uids.discard(uid)
+    if not uids:
+        del index[key]
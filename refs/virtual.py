@@ -0,0 +1,336 @@
+import errno
+import logging
+import os
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+import llfuse
+
+logger = logging.getLogger(__name__)
+
+
+class VirtualFolder(ABC):
+    """Base class for read-only folders that are not stored on the reMarkable.
+
+    Subclasses provide ``children``, a dict from file names to virtual files
+    or folders.
+    """
+
+    @property
+    @abstractmethod
+    def children(self):
+        pass
+
+    def prefetch(self):
+        """Prepare the data of all children, called before listing them."""
+        pass
+
+    def lookup(self, name):
+        """Get the child with the given name, or None if it doesn't exist."""
+        return self.children.get(name)
+
+
+class VirtualFile(ABC):
+    """Base class for read-only files whose content is generated on demand."""
+
+    @property
+    def version(self):
+        """A value that changes whenever the content of this file changes."""
+        return None
+
+    @abstractmethod
+    def get_size(self):
+        """Get the size of the content as a tuple ``(size, exact)``."""
+
+    @abstractmethod
+    def get_data(self):
+        """Get the content."""
+
+
+class PagesFolder(VirtualFolder):
+    """A folder with one PNG image per page of a notebook."""
+
+    suffix = ".pages"
+
+    def __init__(self, client, notebook, scale):
+        self.client = client
+        self.notebook = notebook
+        self.scale = scale
+        self.__files = {}
+
+    @property
+    def name(self):
+        return self.notebook.name + self.suffix
+
+    @property
+    def children(self):
+        return {
+            f"{i + 1:04d}.png": self.__get_file(page_id)
+            for i, page_id in enumerate(self.notebook.pages)
+        }
+
+    def __get_file(self, page_id):
+        if page_id not in self.__files:
+            self.__files[page_id] = PageFile(
+                self.client, self.notebook, page_id, self.scale
+            )
+        return self.__files[page_id]
+
+    def __repr__(self):
+        return f"PGS: {self.name}"
+
+
+class PageFile(VirtualFile):
+    """A single page of a notebook, rendered as a PNG image."""
+
+    def __init__(self, client, notebook, page_id, scale):
+        self.client = client
+        self.notebook = notebook
+        self.page_id = page_id
+        self.scale = scale
+
+    @property
+    def version(self):
+        return self.client.get_page_version(self.notebook, self.page_id)
+
+    def get_size(self):
+        return self.client.get_page_png_size(self.notebook, self.page_id, self.scale)
+
+    def get_data(self):
+        try:
+            return self.client.get_page_png(self.notebook, self.page_id, self.scale)
+        except ValueError as e:
+            logger.error("Can not render page %s of %s: %s", self.page_id, self, e)
+            raise llfuse.FUSEError(errno.EIO)
+
+    def __repr__(self):
+        return f"PAG: {self.notebook.name} {self.page_id}"
+
+
+class ThumbnailsFolder(VirtualFolder):
+    """A folder with the thumbnails of the documents in a folder.
+
+    The thumbnails are the ones the reMarkable created.
+    """
+
+    name = ".thumbnails"
+
+    def __init__(self, client, folder):
+        self.client = client
+        self.folder = folder
+        self.__files = {}
+
+    @property
+    def children(self):
+        children = {}
+        for document in self.folder.documents.values():
+            if not self.client.has_thumbnail(document):
+                continue
+            if document not in self.__files:
+                self.__files[document] = ThumbnailFile(self.client, document)
+            children[document.name + ".jpg"] = self.__files[document]
+        return children
+
+    def prefetch(self):
+        self.client.prefetch_thumbnails(list(self.folder.documents.values()))
+
+    def __repr__(self):
+        return f"THS: {self.folder.name}"
+
+
+class ThumbnailFile(VirtualFile):
+    """The JPEG thumbnail of a document."""
+
+    def __init__(self, client, document):
+        self.client = client
+        self.document = document
+
+    @property
+    def version(self):
+        return self.document.last_modified
+
+    def get_size(self):
+        return self.client.get_thumbnail_size(self.document)
+
+    def get_data(self):
+        data = self.client.get_thumbnail(self.document)
+        if data is None:
+            raise llfuse.FUSEError(errno.ENOENT)
+        return data
+
+    def __repr__(self):
+        return f"THM: {self.document.name}"
+
+
+class RenderedPdfFile(VirtualFile):
+    """The rendered PDF of a document that is shown in another format.
+
+    E.g., an e-book shown as its original EPUB.
+    """
+
+    def __init__(self, client, document):
+        self.client = client
+        self.document = document
+
+    @property
+    def name(self):
+        return self.document.name + ".pdf"
+
+    @property
+    def version(self):
+        return self.document.last_modified
+
+    def get_size(self):
+        return self.client.get_pdf_size(self.document)
+
+    def get_data(self):
+        return self.client.get_pdf(self.document)
+
+    def __repr__(self):
+        return f"RPD: {self.document.name}"
+
+
+class SearchFolder(VirtualFolder):
+    """A folder in which each (looked up) name is a search query.
+
+    Looking up ``<terms>`` returns a folder with all entries matching the
+    terms. Recent queries are listed as children, once they have been listed
+    themselves (such that probes of file managers or shells don't replace them).
+    """
+
+    name = ".search"
+    max_queries = 20
+
+    def __init__(self, index, store, get_node_name):
+        self.index = index
+        self.store = store
+        self.get_node_name = get_node_name
+        self.__queries = OrderedDict()
+        # looked up, but not listed yet
+        self.__pending = OrderedDict()
+
+    @property
+    def children(self):
+        return dict(self.__queries)
+
+    def lookup(self, name):
+        # hidden files (.DS_Store, .git, ...) are not queries
+        if name.startswith("."):
+            return None
+        query = self.__queries.get(name)
+        if query is None:
+            query = self.__pending.get(name)
+        if query is None:
+            query = SearchResultsFolder(self, name)
+            self.__pending[name] = query
+            while len(self.__pending) > self.max_queries:
+                self.__pending.popitem(last=False)
+        return query
+
+    def remember(self, query):
+        """Add a query to the recent queries."""
+        self.__pending.pop(query.terms, None)
+        self.__queries[query.terms] = query
+        self.__queries.move_to_end(query.terms)
+        while len(self.__queries) > self.max_queries:
+            self.__queries.popitem(last=False)
+
+    def __repr__(self):
+        return "SRC"
+
+
+class SearchResultsFolder(VirtualFolder):
+    """A folder with all entries matching a search query."""
+
+    def __init__(self, search_folder, terms):
+        self.search_folder = search_folder
+        self.terms = terms
+
+    @property
+    def children(self):
+        search_folder = self.search_folder
+        entries_by_uid = search_folder.store.entries_by_uid
+
+        search_folder.index.update(
+            entry
+            for entry in entries_by_uid.values()
+            if entry not in (search_folder.store.root, search_folder.store.trash)
+        )
+        uids = search_folder.index.search(self.terms)
+        entries = sorted(
+            entries_by_uid[uid]
+            for uid in uids
+            if uid in entries_by_uid and not entries_by_uid[uid].deleted
+        )
+
+        return _name_entries(entries, search_folder.get_node_name)
+
+    def prefetch(self):
+        self.search_folder.remember(self)
+
+    def __repr__(self):
+        return f"SRS: {self.terms}"
+
+
+class ViewFolder(VirtualFolder):
+    """A folder showing the entries with the UIDs returned by ``get_uids``."""
+
+    def __init__(self, name, store, get_uids, get_node_name):
+        self.name = name
+        self.store = store
+        self.get_uids = get_uids
+        self.get_node_name = get_node_name
+
+    @property
+    def children(self):
+        entries_by_uid = self.store.entries_by_uid
+        entries = sorted(
+            entries_by_uid[uid] for uid in self.get_uids() if uid in entries_by_uid
+        )
+        return _name_entries(entries, self.get_node_name)
+
+    def __repr__(self):
+        return f"VIW: {self.name}"
+
+
+class ViewGroupFolder(VirtualFolder):
+    """A folder with one :class:`ViewFolder` for each key of ``get_keys``."""
+
+    def __init__(self, name, store, get_keys, get_uids, get_node_name):
+        self.name = name
+        self.store = store
+        self.get_keys = get_keys
+        self.get_uids = get_uids
+        self.get_node_name = get_node_name
+        self.__views = {}
+
+    @property
+    def children(self):
+        children = {}
+        for key in self.get_keys():
+            if key not in self.__views:
+                self.__views[key] = ViewFolder(
+                    key,
+                    self.store,
+                    lambda key=key: self.get_uids(key),
+                    self.get_node_name,
+                )
+            children[key.replace("/", "_")] = self.__views[key]
+        return children
+
+    def __repr__(self):
+        return f"VWG: {self.name}"
+
+
+def _name_entries(entries, get_node_name):
+    """Get a dict from unique file names to entries."""
+    children = {}
+    for entry in entries:
+        name = get_node_name(entry)
+        stem, suffix = os.path.splitext(name)
+        i = 1
+        while name in children:
+            i += 1
+            name = f"{stem} ({i}){suffix}"
+        children[name] = entry
+    return children
@@ -0,0 +1,85 @@
+import errno
+import logging
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .constants import WEB_INTERFACE_URL
+from .trace import span
+
+logger = logging.getLogger(__name__)
+
+
+class UploadNotFound(OSError):
+    """Raised when an uploaded document does not show up on the reMarkable."""
+
+    def __init__(self, name):
+        super().__init__(errno.EIO, "Uploaded, but not found on reMarkable", name)
+
+
+class WebInterface:
+    """Client for the web interface of the reMarkable (only reachable via USB).
+
+    All requests go through one pooled HTTP session, such that connections
+    are reused. Documents uploaded through the web interface are picked up by
+    xochitl right away, without a restart.
+    """
+
+    # how long (in seconds) to remember whether the web interface is reachable
+    availability_ttl = 30
+
+    def __init__(self, url=WEB_INTERFACE_URL, timeout=60):
+        self.url = url
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=4))
+
+        # (timestamp, available) of the last availability check
+        self.__availability = None
+
+    @property
+    def available(self):
+        """Whether the web interface can be reached."""
+        if self.__availability is not None:
+            timestamp, available = self.__availability
+            if time.monotonic() - timestamp < self.availability_ttl:
+                return available
+
+        try:
+            self.__post(f"{self.url}/documents/", timeout=2)
+            available = True
+        except requests.RequestException as e:
+            logger.debug("Web interface not available: %s", e)
+            available = False
+
+        self.__availability = (time.monotonic(), available)
+        return available
+
+    def upload(self, folder_uid, filename, data, content_type="application/pdf"):
+        """Upload a document into the folder with UID ``folder_uid``.
+
+        The reMarkable names the document after ``filename`` (without
+        extension) and assigns it a new UID. Returns ``True`` on success.
+        """
+        try:
+            with span("http.upload", filename=filename, size=len(data)):
+                # uploads go to the folder that was listed last
+                self.__post(f"{self.url}/documents/{folder_uid}")
+                self.__post(
+                    f"{self.url}/upload",
+                    files={"file": (filename, data, content_type)},
+                )
+        except requests.RequestException as e:
+            logger.error("Could not upload %s: %s", filename, e)
+            self.__availability = None
+            return False
+
+        return True
+
+    def __post(self, url, timeout=None, **kwargs):
+        if timeout is None:
+            timeout = self.timeout
+        response = self.session.post(url, timeout=timeout, **kwargs)
+        response.raise_for_status()
+        return response